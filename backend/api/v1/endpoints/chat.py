@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Request, Depends, BackgroundTasks, Body, Path, Query, HTTPException, status
+from fastapi import APIRouter, Request, Depends, BackgroundTasks, Body, Path, Query, Header, HTTPException, status
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 import json
+import asyncio
 from typing import Optional, List, Dict, Any
-from datetime import datetime
+from datetime import date, datetime
 import uuid
 
 from backend.schemas.chat import (
@@ -27,12 +28,127 @@ from backend.utils.logging import api_logger
 from backend.core.config import settings
 from backend.utils.id_converter import IDConverter
 
-from openai import AsyncOpenAI
+from backend.services.openai_client import openai_client_service
+from backend.services.context_builder import context_builder
+from backend.services.usage_service import usage_service
+from backend.services.stream_cancellation import StreamHandle, stream_cancellation_registry, persist_partial_response
+from backend.services.stream_replay import stream_replay_registry, format_sse_event
+from backend.services.chat_job_runner import chat_job_runner, ChatJobRejected
+from backend.services.title_queue import title_queue
+from backend.db.session import get_async_session
 from backend.services.memory import redis_client, memory_service
 from backend.schemas.common import PaginationParams, PaginationResponse
 
 router = APIRouter()
 
+def _stream_event_data(
+    message: Dict[str, Any],
+    full_content: str,
+    session_id,
+    agent_info: Optional[Dict[str, Any]],
+    request_id: Optional[str],
+    done: bool = False,
+    tool_status: Optional[Dict[str, Any]] = None,
+    session_title: Optional[str] = None
+) -> str:
+    """构造流式事件的JSON数据"""
+    data = {
+        "message": message,
+        "full_content": full_content,
+        "session_id": session_id or 0,
+        "done": done
+    }
+    if tool_status is not None:
+        data["tool_status"] = tool_status
+    if session_title is not None:
+        data["session_title"] = session_title
+    data["agent_info"] = agent_info
+    return json.dumps({
+        "code": 200,
+        "msg": "成功",
+        "data": data,
+        "errors": None,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "request_id": request_id
+    }, ensure_ascii=False)
+
+
+def _release_stream(handle: Optional[StreamHandle]) -> None:
+    """SSE连接结束时处理未完成的生成：可恢复时在后台继续，否则取消
+
+    仍在工作池中排队的生成还没有任务，同样需要取消，取消时会被移出队列。
+    """
+    if handle is None or (handle.task is not None and handle.task.done()):
+        return
+    if settings.CHAT_STREAM_RESUMABLE:
+        api_logger.info(f"客户端断开，生成在后台继续: session_id={handle.session_id}")
+    else:
+        # 不可恢复时客户端断开即取消上游生成
+        handle.cancel("client_disconnected")
+
+
+def _stream_error_data(error: Exception, session_id, agent_info: Optional[Dict[str, Any]], request_id: Optional[str]) -> str:
+    """构造流式错误事件的JSON数据"""
+    return json.dumps({
+        "code": 500,
+        "msg": f"流式响应失败: {str(error)}",
+        "data": {
+            "message": {
+                "content": f"抱歉，AI助手出错了: {str(error)}"
+            },
+            "full_content": f"抱歉，AI助手出错了: {str(error)}",
+            "session_id": session_id or 0,
+            "done": True,
+            "agent_info": agent_info
+        },
+        "errors": None,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "request_id": request_id
+    }, ensure_ascii=False)
+
+
+def _parse_stream_chunk(chunk_data):
+    """解析生成流程产出的数据，返回 (content, session_id, reasoning_content, tool_status)"""
+    content = ""
+    stream_session_id = None
+    reasoning_content = ""
+    tool_status = None
+    
+    if isinstance(chunk_data, tuple):
+        if len(chunk_data) == 4:
+            # 四元组：(content, session_id, reasoning_content, tool_status)
+            content, stream_session_id, reasoning_content, tool_status = chunk_data
+        elif len(chunk_data) == 3:
+            # 三元组：(content, reasoning_content, tool_status) 或 (content, session_id, reasoning_content/tool_status)
+            first, second, third = chunk_data
+            content = first
+            if isinstance(second, int):
+                # 格式：(content, session_id, reasoning_content/tool_status)
+                stream_session_id = second
+                # 判断第三个参数类型
+                if isinstance(third, dict):
+                    tool_status = third
+                else:
+                    reasoning_content = third or ""
+            else:
+                # 格式：(content, reasoning_content, tool_status)
+                reasoning_content = second or ""
+                if isinstance(third, dict):
+                    tool_status = third
+        elif len(chunk_data) == 2:
+            # 二元组：(content, session_id) 或 (content, reasoning_content)
+            first, second = chunk_data
+            content = first
+            if isinstance(second, int):
+                stream_session_id = second
+            else:
+                reasoning_content = second or ""
+    else:
+        # 单个内容
+        content = chunk_data
+    
+    return content or "", stream_session_id, reasoning_content or "", tool_status
+
 
 @router.post("/chat", response_model=ChatCompletionResponse)
 async def chat(
@@ -446,13 +562,35 @@ async def stop_and_save_response(
                 detail="会话不存在或无权访问"
             )
         
+        # 会话仍在生成时，取消服务端生成并由服务端保存已生成的内容
+        handle = stream_cancellation_registry.cancel(session_id, current_user.id, "stopped_by_user")
+        if handle is not None:
+            await handle.wait(settings.CHAT_STOP_SAVE_TIMEOUT)
+            saved_length = handle.saved_content_length or 0
+            api_logger.info(f"已取消服务端生成: session_id={session_id}, 保存内容长度: {saved_length}")
+            return {
+                "code": 200,
+                "msg": "成功保存停止时的响应内容",
+                "data": {
+                    "session_id": session_id,
+                    "content_saved": saved_length > 0,
+                    "content_length": saved_length,
+                    "user_content_saved": False,
+                    "saved_by_server": True
+                },
+                "errors": None,
+                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "request_id": request_id
+            }
+        
         # 如果有内容需要保存，保存Agent消息
         if current_content.strip():
             from backend.crud.chat import add_message
             
-            # 计算token数量（简单估算）
-            tokens = len(current_content) // 4
-            prompt_tokens = len(user_content) // 4 if user_content else 0
+            # 计算token数量（客户端提交的内容没有接口返回的用量，使用分词器统计）
+            token_counter = context_builder.counter(openai_client_service.model)
+            tokens = token_counter.count_text(current_content)
+            prompt_tokens = token_counter.count_text(user_content)
             total_tokens = tokens + prompt_tokens
             
             # 如果提供了用户内容，且会话中还没有用户消息，先保存用户消息
@@ -490,6 +628,12 @@ async def stop_and_save_response(
                 agent_id=agent_id
             )
             
+            # 累加到用量汇总
+            if ai_message:
+                await usage_service.record_message_usage(
+                    db, current_user.id, ai_message.session_id, ai_message.agent_id, prompt_tokens, tokens
+                )
+            
             # 添加到记忆服务
             from backend.services.memory import memory_service
             memory_service.add_assistant_message(session_id, current_content, current_user.id)
@@ -499,7 +643,7 @@ async def stop_and_save_response(
             # 如果只有用户内容没有Agent响应，也要保存用户消息
             from backend.crud.chat import add_message
             
-            prompt_tokens = len(user_content) // 4
+            prompt_tokens = context_builder.counter(openai_client_service.model).count_text(user_content)
             
             # 检查会话中最新的消息是否是用户消息
             existing_messages = await get_chat_messages(db, session_id)
@@ -556,23 +700,11 @@ async def test_openai_api(
     result = {"success": False, "message": "", "content": ""}
     
     try:
-        # 获取配置
-        api_key = settings.OPENAI_API_KEY
-        base_url = settings.OPENAI_BASE_URL
-        model = settings.OPENAI_MODEL
-        
-        # 确保base_url以/v1结尾
-        if base_url and not base_url.endswith('/v1'):
-            base_url = base_url.rstrip() + '/v1'
-            api_logger.info(f"修正后的BASE URL: {base_url}")
+        model = openai_client_service.model
         
-        api_logger.info(f"测试OpenAI API连接 - BASE URL: {base_url}")
-        
-        # 初始化客户端
-        async_client = AsyncOpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
+        # 使用共享连接池的异步客户端
+        async_client = openai_client_service.async_client
+        api_logger.info(f"测试OpenAI API连接 - BASE URL: {async_client.base_url}")
         
         api_logger.info(f"客户端初始化完成, 实际URL: {async_client.base_url}")
         
@@ -593,6 +725,7 @@ async def test_openai_api(
         result["message"] = "API连接测试成功"
         result["content"] = content
         result["response_type"] = str(type(response))
+        result["endpoints"] = openai_client_service.gateway.get_stats()
         
         api_logger.info(f"[测试API响应] OpenAI API测试成功，返回内容长度: {len(content)}")
         
@@ -678,8 +811,13 @@ async def stream_chat(
                 "model": actual_model  # 使用实际使用的模型
             }
     
+    # 工作池模式下先做准入检查，队列已满时直接返回429
+    if settings.CHAT_JOB_RUNNER_ENABLED:
+        chat_job_runner.check_admission(current_user.id)
+    
     # 创建流式响应
     async def event_generator():
+        handle = None
         try:
             # 跟踪生成的完整内容
             full_content = ""
@@ -757,154 +895,130 @@ async def stream_chat(
                 else:
                     api_logger.info("没有提供笔记ID，跳过笔记关联")
             
-            async for chunk_data in generate_chat_stream(
-                chat_request=chat_request,
-                db=db,
-                user_id=current_user.id
-            ):
-                # 处理不同格式的响应数据
-                content = ""
-                reasoning_content = ""
-                tool_status = None
-                
-                if isinstance(chunk_data, tuple):
-                    if len(chunk_data) == 4:
-                        # 四元组：(content, session_id, reasoning_content, tool_status)
-                        content, stream_session_id, reasoning_content, tool_status = chunk_data
-                        if stream_session_id and session_id is None:
-                            session_id = stream_session_id
-                    elif len(chunk_data) == 3:
-                        # 三元组：(content, reasoning_content, tool_status) 或 (content, session_id, reasoning_content/tool_status)
-                        first, second, third = chunk_data
-                        if isinstance(second, int):
-                            # 格式：(content, session_id, reasoning_content/tool_status)
-                            content = first
-                            stream_session_id = second
-                            if stream_session_id and session_id is None:
-                                session_id = stream_session_id
-                            
-                            # 判断第三个参数类型
-                            if isinstance(third, dict):
-                                tool_status = third
-                            else:
-                                reasoning_content = third or ""
-                        else:
-                            # 格式：(content, reasoning_content, tool_status)
-                            content = first
-                            reasoning_content = second or ""
-                            if isinstance(third, dict):
-                                tool_status = third
-                    elif len(chunk_data) == 2:
-                        # 二元组：(content, session_id) 或 (content, reasoning_content)
-                        first, second = chunk_data
-                        content = first
-                        if isinstance(second, int):
-                            stream_session_id = second
-                            if stream_session_id and session_id is None:
-                                session_id = stream_session_id
-                        else:
-                            reasoning_content = second or ""
-                else:
-                    # 单个内容
-                    content = chunk_data
-                
-                # 确保reasoning_content是字符串
-                if reasoning_content and not isinstance(reasoning_content, str):
-                    reasoning_content = str(reasoning_content)
-                
-                # 累积内容
-                if content:
-                    full_content += content
-                
-                # 如果有工具状态信息，发送工具状态事件
-                if tool_status:
-                    tool_response_data = {
-                        "code": 200,
-                        "msg": "成功",
-                        "data": {
-                            "message": {
-                                "content": ""
-                            },
-                            "full_content": full_content,
-                            "session_id": session_id or 0,
-                            "done": False,
-                            "tool_status": tool_status,
-                            "agent_info": agent_info
-                        },
-                        "errors": None,
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "request_id": request_id
-                    }
+            # 生成过程在独立任务中运行，事件写入回放缓冲区：
+            # 停止接口可以随时取消生成，开启可恢复流时客户端断开不影响生成
+            handle = stream_cancellation_registry.create(current_user.id, request_id)
+            replay = stream_replay_registry.create(current_user.id, settings.CHAT_STREAM_REPLAY_MAX_EVENTS)
+            stream_cancellation_registry.bind(handle, chat_request.session_id)
+            stream_replay_registry.bind(replay, chat_request.session_id)
+            
+            async def generate(gen_db: AsyncSession):
+                nonlocal full_content, session_id
+                async for chunk_data in generate_chat_stream(
+                    chat_request=chat_request,
+                    db=gen_db,
+                    user_id=current_user.id
+                ):
+                    content, stream_session_id, reasoning_content, tool_status = _parse_stream_chunk(chunk_data)
+                    if stream_session_id and session_id is None:
+                        session_id = stream_session_id
+                        stream_cancellation_registry.bind(handle, session_id)
+                        stream_replay_registry.bind(replay, session_id)
                     
-                    yield f"data: {json.dumps(tool_response_data, ensure_ascii=False)}\n\n"
-                
-                # 如果有内容，发送内容事件
-                if content or reasoning_content:
-                    # 构造响应数据
-                    response_data = {
-                        "code": 200,
-                        "msg": "成功",
-                        "data": {
-                            "message": {
+                    # 确保reasoning_content是字符串
+                    if reasoning_content and not isinstance(reasoning_content, str):
+                        reasoning_content = str(reasoning_content)
+                    
+                    # 累积内容
+                    handle.append(content, reasoning_content)
+                    if content:
+                        full_content += content
+                    
+                    # 如果有工具状态信息，发送工具状态事件
+                    if tool_status:
+                        replay.publish(_stream_event_data(
+                            {"content": ""}, full_content, session_id, agent_info, request_id,
+                            tool_status=tool_status
+                        ))
+                    
+                    # 如果有内容，发送内容事件
+                    if content or reasoning_content:
+                        replay.publish(_stream_event_data(
+                            {
                                 "content": content,
                                 "reasoning_content": reasoning_content  # 添加思考内容字段
                             },
-                            "full_content": full_content,
-                            "session_id": session_id or 0,
-                            "done": False,
-                            "agent_info": agent_info
-                        },
-                        "errors": None,
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "request_id": request_id
-                    }
-                    
-                    yield f"data: {json.dumps(response_data, ensure_ascii=False)}\n\n"
+                            full_content, session_id, agent_info, request_id
+                        ))
             
-            # 发送最终响应，标记完成
-            final_response_data = {
-                "code": 200,
-                "msg": "成功",
-                "data": {
-                    "message": {
-                        "content": ""
-                    },
-                    "full_content": full_content,
-                    "session_id": session_id or 0,
-                    "done": True,
-                    "agent_info": agent_info
-                },
-                "errors": None,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "request_id": request_id
-            }
+            async def push_title(title_future: asyncio.Future):
+                # 标题在后台生成，回答完成后在同一个流中追加推送，超时则由客户端下次拉取会话列表获得
+                # 完成事件已经发送过，标题事件不再标记done，避免客户端重复执行完成回调
+                try:
+                    title = await title_queue.wait(title_future, settings.CHAT_TITLE_EVENT_WAIT)
+                    if title:
+                        replay.publish(_stream_event_data(
+                            {"content": ""}, full_content, session_id, agent_info, request_id,
+                            session_title=title
+                        ))
+                finally:
+                    stream_replay_registry.release(replay, settings.CHAT_STREAM_REPLAY_TTL)
             
-            yield f"data: {json.dumps(final_response_data, ensure_ascii=False)}\n\n"
+            async def produce():
+                try:
+                    if handle.cancelled:
+                        # 排队期间已被停止
+                        raise asyncio.CancelledError()
+                    if settings.CHAT_STREAM_RESUMABLE or settings.CHAT_JOB_RUNNER_ENABLED:
+                        # 使用独立的数据库会话，生成不依赖HTTP请求的生命周期
+                        async for gen_db in get_async_session():
+                            await generate(gen_db)
+                            break
+                    else:
+                        await generate(db)
+                    
+                    # 发送最终响应，标记完成
+                    replay.publish(_stream_event_data(
+                        {"content": ""}, full_content, session_id, agent_info, request_id, done=True
+                    ))
+                    api_logger.info(f"流式聊天完成: session_id={session_id}, content_length={len(full_content)}")
+                except asyncio.CancelledError:
+                    # 上游流和工具任务已随取消关闭，保存已生成的部分内容
+                    await persist_partial_response(handle)
+                    replay.publish(_stream_event_data(
+                        {"content": ""}, full_content, session_id, agent_info, request_id, done=True
+                    ))
+                    raise
+                except Exception as e:
+                    api_logger.error(f"流式响应生成失败: {str(e)}", exc_info=True)
+                    replay.publish(_stream_error_data(e, session_id, agent_info, request_id))
+                finally:
+                    stream_cancellation_registry.unregister(handle)
+                    if handle.title_future is not None and not handle.cancelled and settings.CHAT_TITLE_EVENT_WAIT > 0:
+                        asyncio.create_task(push_title(handle.title_future))
+                    else:
+                        stream_replay_registry.release(replay, settings.CHAT_STREAM_REPLAY_TTL)
+            
+            if settings.CHAT_JOB_RUNNER_ENABLED:
+                # 提交到工作池，排队时先通知客户端
+                try:
+                    ahead = chat_job_runner.submit(current_user.id, handle, produce)
+                except ChatJobRejected:
+                    stream_cancellation_registry.unregister(handle)
+                    stream_replay_registry.release(replay, 0)
+                    raise
+                if ahead:
+                    replay.publish(_stream_event_data(
+                        {"content": ""}, full_content, session_id, agent_info, request_id,
+                        tool_status={"type": "generation_queued", "status": "queued", "position": ahead}
+                    ))
+            else:
+                handle.start(produce())
             
-            api_logger.info(f"流式聊天完成: session_id={session_id}, content_length={len(full_content)}")
+            async for event in replay.subscribe(0, settings.CHAT_DISCONNECT_POLL_INTERVAL):
+                if event is None:
+                    if await request.is_disconnected():
+                        break
+                    continue
+                yield format_sse_event(*event)
             
         except Exception as e:
             api_logger.error(f"流式响应生成失败: {str(e)}", exc_info=True)
             
             # 发送错误响应
-            error_response_data = {
-                "code": 500,
-                "msg": f"流式响应失败: {str(e)}",
-                "data": {
-                    "message": {
-                        "content": f"抱歉，AI助手出错了: {str(e)}"
-                    },
-                    "full_content": f"抱歉，AI助手出错了: {str(e)}",
-                    "session_id": session_id or 0,
-                    "done": True,
-                    "agent_info": agent_info
-                },
-                "errors": None,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "request_id": request_id
-            }
-            
-            yield f"data: {json.dumps(error_response_data, ensure_ascii=False)}\n\n"
+            yield f"data: {_stream_error_data(e, session_id, agent_info, request_id)}\n\n"
+        finally:
+            _release_stream(handle)
     
     return StreamingResponse(
         event_generator(),
@@ -912,6 +1026,50 @@ async def stream_chat(
     )
 
 
+@router.get("/stream/{session_id}/resume")
+async def resume_chat_stream(
+    request: Request,
+    session_id: str = Path(..., description="会话ID"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    after: Optional[int] = Query(None, description="从该事件ID之后开始回放（无法设置请求头时使用）"),
+    current_user: User = Depends(get_current_active_user),
+):
+    """
+    恢复流式聊天：回放断线期间错过的事件，然后继续接收实时事件
+    """
+    replay = stream_replay_registry.get(session_id)
+    if not replay or replay.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="没有可恢复的流式响应"
+        )
+    
+    after_id = after if after is not None else 0
+    if last_event_id and last_event_id.isdigit():
+        after_id = int(last_event_id)
+    
+    if replay.has_gap(after_id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="回放缓冲区已覆盖请求的事件，请重新加载会话历史"
+        )
+    
+    api_logger.info(f"恢复流式聊天: session_id={session_id}, last_event_id={after_id}, 最新事件ID: {replay.last_event_id}")
+    
+    async def replay_generator():
+        async for event in replay.subscribe(after_id, settings.CHAT_DISCONNECT_POLL_INTERVAL):
+            if event is None:
+                if await request.is_disconnected():
+                    break
+                continue
+            yield format_sse_event(*event)
+    
+    return StreamingResponse(
+        replay_generator(),
+        media_type="text/event-stream"
+    )
+
+
 @router.post("/sessions", response_model=ChatResponseModel)
 async def create_chat_session(
     request: Request,
@@ -1059,6 +1217,38 @@ async def delete_chat_session(
     )
 
 
+@router.get("/usage/summary")
+async def get_usage_summary(
+    request: Request,
+    group_by: str = Query("total", description="汇总维度: total/session/agent/day"),
+    start_date: Optional[date] = Query(None, description="开始日期（含）"),
+    end_date: Optional[date] = Query(None, description="结束日期（含）"),
+    session_id: Optional[str] = Query(None, description="只统计指定会话"),
+    agent_id: Optional[str] = Query(None, description="只统计指定Agent"),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+):
+    """
+    获取当前用户的token用量汇总（读取增量维护的汇总表）
+    """
+    if group_by not in ("total", "session", "agent", "day"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"不支持的汇总维度: {group_by}"
+        )
+    
+    rows = await usage_service.get_rollup(
+        db, current_user.id, group_by, start_date, end_date, session_id, agent_id, limit
+    )
+    
+    return SuccessResponse(
+        data={"group_by": group_by, "items": rows},
+        msg="获取用量汇总成功",
+        request_id=getattr(request.state, "request_id", None)
+    )
+
+
 @router.get("/memory/health")
 async def check_memory_health(
     request: Request,
@@ -38,8 +38,7 @@ class ToolsManager:
             List: MCP工具列表
         """
         try:
-            from backend.services.mcp_service import MCPService
-            mcp_service = MCPService()
+            from backend.services.mcp_service import mcp_service
             
             # 确保MCP服务已初始化
             if not mcp_service.is_enabled():
@@ -48,7 +47,7 @@ class ToolsManager:
                 await mcp_service.ensure_user_servers_loaded(user_id)
             
             # 获取MCP工具
-            mcp_tools = await mcp_service.get_available_tools_for_chat()
+            mcp_tools = await mcp_service.get_available_tools_for_chat(user_id)
             return mcp_tools
             
         except Exception as e:
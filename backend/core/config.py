@@ -54,6 +54,63 @@ class Settings(BaseSettings):
     OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL", "")
     OPENAI_MODEL: str = os.getenv("OPENAI_MODEL", "gpt-4.1-2025-04-14")
     
+    # LLM HTTP连接池配置（所有LLM调用共享同一个连接池）
+    LLM_HTTP_MAX_CONNECTIONS: int = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+    LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    LLM_HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保活秒数
+    LLM_HTTP_CONNECT_TIMEOUT: float = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", "10"))
+    LLM_HTTP_READ_TIMEOUT: float = float(os.getenv("LLM_HTTP_READ_TIMEOUT", "120"))  # 流式响应中两个数据块之间的最长等待
+    LLM_HTTP_WRITE_TIMEOUT: float = float(os.getenv("LLM_HTTP_WRITE_TIMEOUT", "30"))
+    LLM_HTTP_POOL_TIMEOUT: float = float(os.getenv("LLM_HTTP_POOL_TIMEOUT", "10"))  # 等待空闲连接的最长时间
+    LLM_HTTP2_ENABLED: bool = os.getenv("LLM_HTTP2_ENABLED", "true").lower() == "true"  # 需要安装h2
+    
+    # LLM网关配置
+    # 多端点JSON列表，例如 [{"name": "a", "base_url": "...", "api_key": "...", "models": ["gpt-4o"], "max_concurrency": 16}]
+    # 为空时只使用 OPENAI_BASE_URL
+    LLM_ENDPOINTS: str = os.getenv("LLM_ENDPOINTS", "")
+    LLM_ENDPOINT_MAX_CONCURRENCY: int = int(os.getenv("LLM_ENDPOINT_MAX_CONCURRENCY", "32"))
+    LLM_ENDPOINT_COOLDOWN: float = float(os.getenv("LLM_ENDPOINT_COOLDOWN", "30"))  # 连续失败后的冷却秒数
+    LLM_GATEWAY_QUEUE_TIMEOUT: float = float(os.getenv("LLM_GATEWAY_QUEUE_TIMEOUT", "30"))  # 端点满载时的排队超时
+    LLM_STREAM_INCLUDE_USAGE: bool = os.getenv("LLM_STREAM_INCLUDE_USAGE", "true").lower() == "true"  # 流式请求要求返回用量（stream_options.include_usage）
+    
+    # 流式聊天配置
+    CHAT_DISCONNECT_POLL_INTERVAL: float = float(os.getenv("CHAT_DISCONNECT_POLL_INTERVAL", "1.0"))  # 检测客户端断开的间隔秒数
+    CHAT_STOP_SAVE_TIMEOUT: float = float(os.getenv("CHAT_STOP_SAVE_TIMEOUT", "5"))  # 停止接口等待服务端保存的最长时间
+    CHAT_STREAM_RESUMABLE: bool = os.getenv("CHAT_STREAM_RESUMABLE", "true").lower() == "true"  # 客户端断开后继续生成，可通过Last-Event-ID恢复
+    CHAT_STREAM_REPLAY_MAX_EVENTS: int = int(os.getenv("CHAT_STREAM_REPLAY_MAX_EVENTS", "5000"))  # 每个流保留的最大事件数
+    CHAT_STREAM_REPLAY_TTL: float = float(os.getenv("CHAT_STREAM_REPLAY_TTL", "300"))  # 生成结束后回放缓冲区的保留秒数
+    CHAT_TITLE_EVENT_WAIT: float = float(os.getenv("CHAT_TITLE_EVENT_WAIT", "10"))  # 回答完成后保持连接等待标题事件的最长秒数，0表示不推送
+    
+    # 标题生成队列配置
+    TITLE_QUEUE_CONCURRENCY: int = int(os.getenv("TITLE_QUEUE_CONCURRENCY", "4"))  # 同时进行的标题生成数
+    TITLE_QUEUE_MAX: int = int(os.getenv("TITLE_QUEUE_MAX", "1000"))  # 排队上限，超出时使用简单标题
+    TITLE_BATCH_ENABLED: bool = os.getenv("TITLE_BATCH_ENABLED", "false").lower() == "true"  # 多个待生成标题合并为一次LLM调用
+    TITLE_BATCH_MAX: int = int(os.getenv("TITLE_BATCH_MAX", "8"))  # 单次批量生成的会话数上限
+    TITLE_BATCH_WINDOW: float = float(os.getenv("TITLE_BATCH_WINDOW", "0.5"))  # 收集批量任务的等待秒数
+    
+    # 聊天生成工作池配置（开启后流式聊天的生成任务由进程内工作池执行）
+    CHAT_JOB_RUNNER_ENABLED: bool = os.getenv("CHAT_JOB_RUNNER_ENABLED", "false").lower() == "true"
+    CHAT_JOB_WORKERS: int = int(os.getenv("CHAT_JOB_WORKERS", "32"))  # 同时执行的生成任务数
+    CHAT_JOB_QUEUE_MAX: int = int(os.getenv("CHAT_JOB_QUEUE_MAX", "200"))  # 等待队列上限，超出时拒绝
+    CHAT_JOB_PER_USER_LIMIT: int = int(os.getenv("CHAT_JOB_PER_USER_LIMIT", "2"))  # 单用户同时执行的任务数
+    CHAT_JOB_PER_USER_PENDING_MAX: int = int(os.getenv("CHAT_JOB_PER_USER_PENDING_MAX", "5"))  # 单用户排队任务上限
+    
+    # 上下文窗口配置
+    # 各模型上下文窗口JSON，支持前缀匹配，例如 {"gpt-4.1": 1047576, "gpt-4o": 128000}
+    MODEL_CONTEXT_WINDOWS: str = os.getenv("MODEL_CONTEXT_WINDOWS", "")
+    DEFAULT_MODEL_CONTEXT_WINDOW: int = int(os.getenv("DEFAULT_MODEL_CONTEXT_WINDOW", "128000"))
+    CONTEXT_SAFETY_MARGIN: int = int(os.getenv("CONTEXT_SAFETY_MARGIN", "512"))  # 计数误差的安全余量
+    CONTEXT_MIN_COMPLETION_TOKENS: int = int(os.getenv("CONTEXT_MIN_COMPLETION_TOKENS", "1024"))  # 至少为回复预留的token数
+    
+    # 会话摘要配置（动态上下文压缩）
+    CONVERSATION_SUMMARY_ENABLED: bool = os.getenv("CONVERSATION_SUMMARY_ENABLED", "true").lower() == "true"
+    CONVERSATION_SUMMARY_MODEL: str = os.getenv("CONVERSATION_SUMMARY_MODEL", "")  # 为空时使用当前对话的模型
+    CONVERSATION_SUMMARY_MAX_TOKENS: int = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "800"))  # 摘要长度上限
+    CONVERSATION_SUMMARY_TRIGGER_RATIO: float = float(os.getenv("CONVERSATION_SUMMARY_TRIGGER_RATIO", "0.75"))  # 历史占预算比例超过该值时开始折叠
+    CONVERSATION_SUMMARY_TARGET_RATIO: float = float(os.getenv("CONVERSATION_SUMMARY_TARGET_RATIO", "0.5"))  # 折叠后历史占预算的目标比例
+    CONVERSATION_SUMMARY_KEEP_TURNS: int = int(os.getenv("CONVERSATION_SUMMARY_KEEP_TURNS", "2"))  # 始终保留原文的最近轮次
+    CONVERSATION_SUMMARY_CHUNK_TOKENS: int = int(os.getenv("CONVERSATION_SUMMARY_CHUNK_TOKENS", "6000"))  # 单次摘要请求的对话长度上限
+    
     # 默认Agent配置
     DEFAULT_AGENT_MODEL: str = os.getenv("DEFAULT_AGENT_MODEL", "gpt-4.1-2025-04-14")
     DEFAULT_AGENT_SYSTEM_PROMPT: str = os.getenv(
@@ -88,6 +145,10 @@ class Settings(BaseSettings):
     # Tavily API配置
     TAVILY_API_KEY: Optional[str] = None
     
+    # 工具调用配置
+    TOOL_SINGLE_FLIGHT_ENABLED: bool = os.getenv("TOOL_SINGLE_FLIGHT_ENABLED", "true").lower() == "true"  # 合并相同的并发工具调用
+    TAVILY_EXTRACT_CONCURRENCY: int = int(os.getenv("TAVILY_EXTRACT_CONCURRENCY", "3"))  # 流式提取时同时请求的URL数
+    
     # MCP配置
     MCP_ENABLED: bool = os.getenv("MCP_ENABLED", "true").lower() == "true"
     MCP_SERVERS: Dict[str, Any] = {}
@@ -95,9 +156,44 @@ class Settings(BaseSettings):
     MCP_REQUEST_TIMEOUT: int = int(os.getenv("MCP_REQUEST_TIMEOUT", "60"))  # 请求超时时间(秒)
     MCP_RETRY_ATTEMPTS: int = int(os.getenv("MCP_RETRY_ATTEMPTS", "3"))  # 重试次数
     MCP_RETRY_DELAY: float = float(os.getenv("MCP_RETRY_DELAY", "1.0"))  # 重试延迟(秒)
+    MCP_COALESCE_TOOL_CALLS: bool = os.getenv("MCP_COALESCE_TOOL_CALLS", "true").lower() == "true"  # 合并相同的并发工具调用
+    MCP_MAX_INFLIGHT_REQUESTS: int = int(os.getenv("MCP_MAX_INFLIGHT_REQUESTS", "32"))  # 单个连接同时进行的请求数上限
+    
+    # MCP连接池配置
+    MCP_MAX_SERVERS_PER_USER: int = int(os.getenv("MCP_MAX_SERVERS_PER_USER", "10"))  # 每个用户同时连接的服务器上限
+    MCP_MAX_LIVE_SERVERS: int = int(os.getenv("MCP_MAX_LIVE_SERVERS", "200"))  # 全局用户服务器连接上限，超出时按LRU淘汰空闲连接
+    MCP_SERVER_IDLE_TIMEOUT: int = int(os.getenv("MCP_SERVER_IDLE_TIMEOUT", "1800"))  # 用户服务器空闲多久后断开(秒)，0表示不断开
+    MCP_USER_RELOAD_TTL: int = int(os.getenv("MCP_USER_RELOAD_TTL", "60"))  # 用户服务器配置重新加载间隔(秒)
+    MCP_LIST_TIMEOUT: float = float(os.getenv("MCP_LIST_TIMEOUT", "10"))  # 并发获取工具/资源/提示列表时单个服务器的超时(秒)
+    MCP_STDIO_READ_CHUNK: int = int(os.getenv("MCP_STDIO_READ_CHUNK", "262144"))  # stdio传输每次读取的字节数
+    MCP_STDIO_MAX_MESSAGE_BYTES: int = int(os.getenv("MCP_STDIO_MAX_MESSAGE_BYTES", str(64 * 1024 * 1024)))  # stdio传输单条消息的最大字节数
+    MCP_LIST_BUDGET: float = float(os.getenv("MCP_LIST_BUDGET", "15"))  # 并发获取列表的总时间预算(秒)，超时的服务器返回部分结果
+    
+    # MCP HTTP传输配置（sse / streamable_http）
+    MCP_HTTP_MAX_CONNECTIONS: int = int(os.getenv("MCP_HTTP_MAX_CONNECTIONS", "100"))  # 共享HTTP连接池最大连接数
+    MCP_HTTP_MAX_KEEPALIVE: int = int(os.getenv("MCP_HTTP_MAX_KEEPALIVE", "20"))  # 共享HTTP连接池保持的空闲连接数
+    MCP_HTTP_RECONNECT_ATTEMPTS: int = int(os.getenv("MCP_HTTP_RECONNECT_ATTEMPTS", "5"))  # 事件流断开后的最大连续重连次数
+    MCP_HTTP_RECONNECT_BASE_DELAY: float = float(os.getenv("MCP_HTTP_RECONNECT_BASE_DELAY", "0.5"))  # 重连退避的初始等待(秒)
+    MCP_HTTP_RECONNECT_MAX_DELAY: float = float(os.getenv("MCP_HTTP_RECONNECT_MAX_DELAY", "30"))  # 重连退避的最大等待(秒)
+    
+    # MCP健康检查配置
+    MCP_HEALTH_CHECK_ENABLED: bool = os.getenv("MCP_HEALTH_CHECK_ENABLED", "true").lower() == "true"  # 后台定时检查服务器并自动重连
+    MCP_HEALTH_CHECK_INTERVAL: float = float(os.getenv("MCP_HEALTH_CHECK_INTERVAL", "30"))  # 健康检查间隔(秒)
+    MCP_HEALTH_PING_TIMEOUT: float = float(os.getenv("MCP_HEALTH_PING_TIMEOUT", "5"))  # 健康检查ping超时(秒)
+    MCP_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("MCP_BREAKER_FAILURE_THRESHOLD", "3"))  # 连续失败多少次后熔断
+    MCP_BREAKER_RESET_TIMEOUT: float = float(os.getenv("MCP_BREAKER_RESET_TIMEOUT", "30"))  # 熔断后多久允许试探调用(秒)
+    MCP_RECONNECT_BASE_DELAY: float = float(os.getenv("MCP_RECONNECT_BASE_DELAY", "1"))  # 自动重连退避的初始等待(秒)
+    MCP_RECONNECT_MAX_DELAY: float = float(os.getenv("MCP_RECONNECT_MAX_DELAY", "300"))  # 自动重连退避的最大等待(秒)
+    
+    # MCP预热池配置（预先启动并初始化常用的stdio服务器）
+    MCP_WARM_POOL_ENABLED: bool = os.getenv("MCP_WARM_POOL_ENABLED", "false").lower() == "true"
+    MCP_WARM_POOL_SIZE: int = int(os.getenv("MCP_WARM_POOL_SIZE", "1"))  # 每种配置预热的实例数
+    MCP_WARM_POOL_MAX_TEMPLATES: int = int(os.getenv("MCP_WARM_POOL_MAX_TEMPLATES", "10"))  # 除系统级服务器外最多预热的配置数
+    MCP_WARM_POOL_MIN_DEMAND: int = int(os.getenv("MCP_WARM_POOL_MIN_DEMAND", "2"))  # 配置被连接多少次后开始预热
     
     # MCP内置服务器配置
     MCP_NOTE_ENABLED: bool = os.getenv("MCP_NOTE_ENABLED", "true").lower() == "true"
+    MCP_NOTE_IN_PROCESS: bool = os.getenv("MCP_NOTE_IN_PROCESS", "true").lower() == "true"  # 在API进程内直接调用笔记服务器，false时使用stdio子进程
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -116,12 +212,18 @@ class Settings(BaseSettings):
         
         # 如果没有配置外部服务器，使用默认内置服务器配置
         if not self.MCP_SERVERS:
+            if self.MCP_NOTE_IN_PROCESS:
+                note_transport = {"type": "inprocess", "server": "note"}
+            else:
+                note_transport = {
+                    "type": "stdio",
+                    "command": "python",
+                    "args": ["-m", "backend.mcp.servers.note_server"],
+                }
             self.MCP_SERVERS = {
                 "note": {
                     "enabled": self.MCP_NOTE_ENABLED,
-                    "type": "stdio", 
-                    "command": "python",
-                    "args": ["-m", "backend.mcp.servers.note_server"],
+                    **note_transport,
                     "description": "笔记阅读和编辑服务",
                     "name": "note-server"
                 }
@@ -358,7 +358,14 @@ async def get_latest_chat(db: AsyncSession, user_id: int) -> Optional[Chat]:
         return None
 
 
-async def update_message_content(db: AsyncSession, message_id: str, new_content: str) -> bool:
+async def update_message_content(
+    db: AsyncSession,
+    message_id: str,
+    new_content: str,
+    tokens: Optional[int] = None,
+    prompt_tokens: Optional[int] = None,
+    total_tokens: Optional[int] = None
+) -> bool:
     """
     更新消息内容
     
@@ -366,6 +373,9 @@ async def update_message_content(db: AsyncSession, message_id: str, new_content:
         db: 数据库会话
         message_id: 消息public_id
         new_content: 新内容
+        tokens: 消息token数量（为None时不修改）
+        prompt_tokens: 提示词token数量（为None时不修改）
+        total_tokens: 总token数量（为None时不修改）
         
     Returns:
         更新是否成功
@@ -376,7 +386,11 @@ async def update_message_content(db: AsyncSession, message_id: str, new_content:
         if not db_message_id:
             return False
             
-        stmt = update(ChatMessage).where(ChatMessage.id == db_message_id).values(content=new_content)
+        values = {"content": new_content}
+        for key, value in (("tokens", tokens), ("prompt_tokens", prompt_tokens), ("total_tokens", total_tokens)):
+            if value is not None:
+                values[key] = value
+        stmt = update(ChatMessage).where(ChatMessage.id == db_message_id).values(**values)
         result = await db.execute(stmt)
         await db.commit()
         
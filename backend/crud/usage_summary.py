@@ -0,0 +1,108 @@
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.models.base import BeijingTimestampText
+from backend.models.usage_summary import UsageSummary
+from backend.utils.logging import db_logger
+from backend.utils.random_util import RandomUtil
+
+
+# 支持的汇总维度
+ROLLUP_GROUPS = {
+    "total": [],
+    "session": [UsageSummary.session_id],
+    "agent": [UsageSummary.agent_id],
+    "day": [UsageSummary.day],
+}
+
+
+async def add_usage(
+    db: AsyncSession,
+    user_id: int,
+    session_id: int,
+    agent_id: Optional[int],
+    prompt_tokens: int,
+    completion_tokens: int,
+    total_tokens: int,
+    cached_tokens: int = 0,
+    request_count: int = 0,
+    message_count: int = 1,
+    day: Optional[date] = None
+) -> None:
+    """将一次用量累加到对应的汇总行（不存在时创建）"""
+    values = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "cached_tokens": cached_tokens,
+        "request_count": request_count,
+        "message_count": message_count,
+    }
+    stmt = insert(UsageSummary).values(
+        public_id=RandomUtil.generate_usage_summary_id(),
+        user_id=user_id,
+        session_id=session_id,
+        agent_id=agent_id or 0,
+        day=day or date.today(),
+        is_deleted=False,
+        created_at=BeijingTimestampText(),
+        updated_at=BeijingTimestampText(),
+        **values
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_usage_summaries_session_agent_day",
+        set_={
+            **{key: getattr(UsageSummary.__table__.c, key) + stmt.excluded[key] for key in values},
+            "updated_at": BeijingTimestampText(),
+        }
+    )
+    await db.execute(stmt)
+    await db.commit()
+    db_logger.debug(f"用量汇总已累加: session_id={session_id}, total_tokens={total_tokens}")
+
+
+async def get_usage_rollup(
+    db: AsyncSession,
+    user_id: int,
+    group_by: str = "total",
+    start_day: Optional[date] = None,
+    end_day: Optional[date] = None,
+    session_id: Optional[int] = None,
+    agent_id: Optional[int] = None,
+    limit: int = 100
+) -> List[Dict[str, Any]]:
+    """按维度汇总用户的用量，直接读取汇总表"""
+    group_columns = ROLLUP_GROUPS[group_by]
+    stmt = select(
+        *group_columns,
+        func.coalesce(func.sum(UsageSummary.prompt_tokens), 0).label("prompt_tokens"),
+        func.coalesce(func.sum(UsageSummary.completion_tokens), 0).label("completion_tokens"),
+        func.coalesce(func.sum(UsageSummary.total_tokens), 0).label("total_tokens"),
+        func.coalesce(func.sum(UsageSummary.cached_tokens), 0).label("cached_tokens"),
+        func.coalesce(func.sum(UsageSummary.request_count), 0).label("request_count"),
+        func.coalesce(func.sum(UsageSummary.message_count), 0).label("message_count"),
+    ).where(UsageSummary.user_id == user_id, UsageSummary.is_deleted == False)
+
+    if start_day:
+        stmt = stmt.where(UsageSummary.day >= start_day)
+    if end_day:
+        stmt = stmt.where(UsageSummary.day <= end_day)
+    if session_id is not None:
+        stmt = stmt.where(UsageSummary.session_id == session_id)
+    if agent_id is not None:
+        stmt = stmt.where(UsageSummary.agent_id == agent_id)
+
+    if group_columns:
+        stmt = stmt.group_by(*group_columns)
+        if group_by == "day":
+            stmt = stmt.order_by(UsageSummary.day.desc())
+        else:
+            stmt = stmt.order_by(func.sum(UsageSummary.total_tokens).desc())
+        stmt = stmt.limit(limit)
+
+    result = await db.execute(stmt)
+    return [dict(row._mapping) for row in result]
@@ -331,6 +331,28 @@ async def shutdown_event():
         app_logger.info("MCP服务已关闭")
     except Exception as e:
         app_logger.error(f"关闭MCP服务失败: {e}")
+    
+    # 停止聊天生成工作池
+    try:
+        from backend.services.chat_job_runner import chat_job_runner
+        await chat_job_runner.shutdown()
+    except Exception as e:
+        app_logger.error(f"停止聊天生成工作池失败: {e}")
+    
+    # 停止标题生成队列
+    try:
+        from backend.services.title_queue import title_queue
+        await title_queue.shutdown()
+    except Exception as e:
+        app_logger.error(f"停止标题生成队列失败: {e}")
+    
+    # 关闭LLM共享连接池
+    try:
+        from backend.services.openai_client import openai_client_service
+        await openai_client_service.close()
+        app_logger.info("LLM连接池已关闭")
+    except Exception as e:
+        app_logger.error(f"关闭LLM连接池失败: {e}")
 
 
 if __name__ == "__main__":
@@ -2,11 +2,16 @@
 
 from .mcp_client import MCPClient
 from .session_manager import MCPSessionManager
+from .health import MCPHealthSupervisor, CircuitBreaker
+from .warm_pool import MCPWarmPool
 from .transport import StdioTransport, SSETransport
 
 __all__ = [
     "MCPClient",
     "MCPSessionManager",
+    "MCPHealthSupervisor",
+    "CircuitBreaker",
+    "MCPWarmPool",
     "StdioTransport", 
     "SSETransport",
 ] 
\ No newline at end of file
@@ -0,0 +1,360 @@
+"""
+MCP服务器健康监督
+
+- 后台定时ping已连接的服务器，记录每个服务器的调用延迟和错误
+- 每个服务器一个熔断器：连续失败达到阈值后熔断，调用直接失败而不是等到超时；
+  熔断一段时间后放行一次试探调用（或由健康检查ping试探），成功则恢复
+- 连接已断开（如stdio服务器进程崩溃）或熔断后ping仍失败的服务器，在后台按指数退避自动重连
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, Optional
+
+from .transport import backoff_delay
+from ..schemas.exceptions import MCPCircuitOpenError, MCPConnectionError, MCPTimeoutError
+from backend.core.config import settings
+from backend.utils.logging import app_logger
+
+if TYPE_CHECKING:
+    from .session_manager import MCPSessionManager
+
+
+# 计入熔断的错误：连接和超时类错误。服务器正常返回的业务错误说明服务器可用，不计入
+FAILURE_ERRORS = (MCPConnectionError, MCPTimeoutError, asyncio.TimeoutError, ConnectionError, OSError)
+# 计算延迟分位数使用的最近调用数
+LATENCY_WINDOW = 100
+
+
+class CircuitBreaker:
+    """单个服务器的熔断器"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    __slots__ = ("failure_threshold", "reset_timeout", "state", "failures", "opened_at", "_probing")
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """是否放行调用；熔断超过reset_timeout后进入半开状态，只放行一次试探调用"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败，返回是否因此进入熔断"""
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            return self.trip()
+        return False
+
+    def trip(self) -> bool:
+        """立即熔断，返回之前是否未熔断"""
+        opened = self.state != self.OPEN
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self._probing = False
+        return opened
+
+    def abandon(self) -> None:
+        """试探调用被取消，允许下一次试探"""
+        self._probing = False
+
+
+class ServerMetrics:
+    """单个服务器的调用指标"""
+    __slots__ = (
+        "calls", "errors", "rejected", "latencies", "last_error", "last_error_at",
+        "ping_failures", "last_ping_ms", "last_check_at", "reconnects", "reconnect_failures"
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[float] = None
+        self.ping_failures = 0
+        self.last_ping_ms: Optional[float] = None
+        self.last_check_at: Optional[float] = None
+        self.reconnects = 0
+        self.reconnect_failures = 0
+
+    def record(self, latency: float, error: Optional[BaseException] = None) -> None:
+        self.calls += 1
+        self.latencies.append(latency)
+        if error is not None:
+            self.errors += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            self.last_error_at = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.calls, 4) if self.calls else 0.0,
+            "rejected": self.rejected,
+            "latency_avg_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            "latency_p50_ms": percentile(0.5),
+            "latency_p95_ms": percentile(0.95),
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+            "ping_failures": self.ping_failures,
+            "last_ping_ms": self.last_ping_ms,
+            "last_check_at": self.last_check_at,
+            "reconnects": self.reconnects,
+            "reconnect_failures": self.reconnect_failures,
+        }
+
+
+class ReconnectState:
+    """等待后台重连的服务器"""
+    __slots__ = ("config", "user_id", "attempts", "next_at")
+
+    def __init__(self, config: Dict[str, Any], user_id: Optional[int]):
+        self.config = config
+        self.user_id = user_id
+        self.attempts = 0
+        self.next_at = time.monotonic()
+
+
+class MCPHealthSupervisor:
+    """MCP服务器健康监督：定时检查、熔断和自动重连"""
+
+    def __init__(self, manager: "MCPSessionManager"):
+        self.manager = manager
+        self._breakers: Dict[int, CircuitBreaker] = {}
+        self._metrics: Dict[int, ServerMetrics] = {}
+        self._reconnects: Dict[int, ReconnectState] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def _breaker(self, server_id: int) -> CircuitBreaker:
+        breaker = self._breakers.get(server_id)
+        if breaker is None:
+            breaker = self._breakers[server_id] = CircuitBreaker(
+                settings.MCP_BREAKER_FAILURE_THRESHOLD, settings.MCP_BREAKER_RESET_TIMEOUT
+            )
+        return breaker
+
+    def _metrics_of(self, server_id: int) -> ServerMetrics:
+        metrics = self._metrics.get(server_id)
+        if metrics is None:
+            metrics = self._metrics[server_id] = ServerMetrics()
+        return metrics
+
+    # ---- 调用路径 ----
+
+    def before_call(self, server_id: int) -> None:
+        """服务器已熔断时直接失败"""
+        if not self._breaker(server_id).allow():
+            self._metrics_of(server_id).rejected += 1
+            raise MCPCircuitOpenError(f"MCP服务器暂不可用（已熔断）: ID {server_id}")
+
+    def record_call(self, server_id: int, latency: float, error: Optional[BaseException] = None) -> None:
+        """记录一次调用的结果"""
+        breaker = self._breaker(server_id)
+        if isinstance(error, asyncio.CancelledError):
+            breaker.abandon()
+            return
+        self._metrics_of(server_id).record(latency, error)
+        if isinstance(error, FAILURE_ERRORS):
+            self._on_failure(server_id, breaker)
+        else:
+            breaker.record_success()
+
+    def report_disconnected(self, server_id: int) -> None:
+        """调用时发现连接已断开，立即安排重连"""
+        self._breaker(server_id).trip()
+        self._schedule_reconnect(server_id)
+
+    def _on_failure(self, server_id: int, breaker: CircuitBreaker) -> None:
+        if breaker.record_failure():
+            app_logger.warning(f"MCP服务器连续失败 {breaker.failures} 次，已熔断: ID {server_id}")
+        client = self.manager.get_client(server_id)
+        if client is not None and not client.is_connected:
+            self._schedule_reconnect(server_id)
+
+    # ---- 连接池事件 ----
+
+    def on_connected(self, server_id: int) -> None:
+        """服务器（重新）连接成功"""
+        self._reconnects.pop(server_id, None)
+        breaker = self._breakers.get(server_id)
+        if breaker is not None:
+            breaker.record_success()
+
+    def forget(self, server_id: int) -> None:
+        """服务器被移除或淘汰，不再监督"""
+        self._breakers.pop(server_id, None)
+        self._metrics.pop(server_id, None)
+        self._reconnects.pop(server_id, None)
+
+    def forget_user(self, user_id: int, keep: Iterable[int] = ()) -> None:
+        """用户已禁用或删除的服务器不再重连"""
+        keep = set(keep)
+        for server_id, state in list(self._reconnects.items()):
+            if state.user_id == user_id and server_id not in keep:
+                self.forget(server_id)
+
+    def _schedule_reconnect(self, server_id: int) -> None:
+        if server_id in self._reconnects:
+            return
+        entry = self.manager._entries.get(server_id)
+        if entry is None:
+            return
+        self._reconnects[server_id] = ReconnectState(entry.config, entry.user_id)
+        app_logger.info(f"MCP服务器连接异常，安排后台重连: ID {server_id}")
+        if self._wake is not None:
+            self._wake.set()
+
+    # ---- 后台任务 ----
+
+    def start(self) -> None:
+        """在当前事件循环中启动后台检查"""
+        if not settings.MCP_HEALTH_CHECK_ENABLED or (self._task is not None and not self._task.done()):
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="mcp-health-supervisor")
+        app_logger.info(f"MCP健康检查已启动，间隔: {settings.MCP_HEALTH_CHECK_INTERVAL}秒")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._breakers.clear()
+        self._metrics.clear()
+        self._reconnects.clear()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                app_logger.error(f"MCP健康检查异常: {e}", exc_info=True)
+
+            # 等到下一次检查或最早的重连时间；有新的重连任务时提前唤醒
+            timeout = settings.MCP_HEALTH_CHECK_INTERVAL
+            if self._reconnects:
+                next_at = min(state.next_at for state in self._reconnects.values())
+                timeout = max(0.0, min(timeout, next_at - time.monotonic()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def check_all(self) -> None:
+        """检查所有服务器，并重连到期的服务器"""
+        clients = dict(self.manager._clients)
+        # 清理已不在连接池中、也不等待重连的服务器
+        for server_id in list(self._metrics):
+            if server_id not in clients and server_id not in self._reconnects:
+                self.forget(server_id)
+
+        await asyncio.gather(
+            *(self._check(server_id, client) for server_id, client in clients.items() if server_id not in self._reconnects),
+            return_exceptions=True
+        )
+
+        now = time.monotonic()
+        due = [server_id for server_id, state in self._reconnects.items() if state.next_at <= now]
+        await asyncio.gather(*(self._reconnect(server_id) for server_id in due), return_exceptions=True)
+
+    async def _check(self, server_id: int, client) -> None:
+        metrics = self._metrics_of(server_id)
+        metrics.last_check_at = time.time()
+        breaker = self._breaker(server_id)
+        if not client.is_connected:
+            breaker.trip()
+            self._schedule_reconnect(server_id)
+            return
+
+        started = time.monotonic()
+        try:
+            ok = await asyncio.wait_for(client.ping(), settings.MCP_HEALTH_PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            ok = False
+        if ok:
+            metrics.last_ping_ms = round((time.monotonic() - started) * 1000, 1)
+            # ping成功只作为熔断后的试探：服务器可能能响应ping但工具调用持续超时，
+            # 未熔断时不清零调用失败计数
+            if breaker.state != CircuitBreaker.CLOSED and breaker.allow():
+                breaker.record_success()
+            return
+
+        metrics.ping_failures += 1
+        self._on_failure(server_id, breaker)
+        # 已熔断的服务器ping仍然失败，连接可能已经卡死，重新连接
+        if breaker.state == CircuitBreaker.OPEN:
+            self._schedule_reconnect(server_id)
+
+    async def _reconnect(self, server_id: int) -> None:
+        state = self._reconnects.get(server_id)
+        if state is None:
+            return
+        metrics = self._metrics_of(server_id)
+        metrics.reconnects += 1
+        try:
+            await self.manager.reconnect_server(server_id, state.config, state.user_id)
+            self.on_connected(server_id)
+            app_logger.info(f"MCP服务器自动重连成功: ID {server_id}，第 {state.attempts + 1} 次尝试")
+        except Exception as e:
+            metrics.reconnect_failures += 1
+            state.attempts += 1
+            delay = backoff_delay(state.attempts, settings.MCP_RECONNECT_BASE_DELAY, settings.MCP_RECONNECT_MAX_DELAY)
+            state.next_at = time.monotonic() + delay
+            # 重连失败时服务器已从连接池移除，保留重连状态继续重试
+            self._reconnects[server_id] = state
+            app_logger.warning(f"MCP服务器自动重连失败: ID {server_id}，{delay:.1f}秒后重试: {e}")
+
+    # ---- 指标 ----
+
+    def get_metrics(self, server_id: int) -> Dict[str, Any]:
+        """单个服务器的健康指标"""
+        breaker = self._breakers.get(server_id)
+        state = self._reconnects.get(server_id)
+        metrics = self._metrics.get(server_id)
+        return {
+            **(metrics.as_dict() if metrics is not None else ServerMetrics().as_dict()),
+            "breaker": breaker.state if breaker is not None else CircuitBreaker.CLOSED,
+            "consecutive_failures": breaker.failures if breaker is not None else 0,
+            "reconnect_pending": state is not None,
+            "reconnect_attempts": state.attempts if state is not None else 0,
+        }
+
+    def get_all_metrics(self) -> Dict[int, Dict[str, Any]]:
+        """所有被监督服务器（包括等待重连的）的健康指标"""
+        server_ids = set(self.manager._clients) | set(self._reconnects)
+        return {server_id: self.get_metrics(server_id) for server_id in sorted(server_ids)}
@@ -11,6 +11,7 @@ MCP客户端核心实现
 
 import asyncio
 import json
+import logging
 import time
 import uuid
 from typing import Any, Dict, List, Optional, Union, Callable, AsyncIterator
@@ -31,6 +32,17 @@ from ..schemas.exceptions import (
     create_mcp_error_from_code
 )
 from backend.utils.logging import app_logger
+from backend.core.config import settings
+
+
+# 列表变更通知对应的缓存类型
+LIST_CHANGED_KINDS = {
+    NotificationType.TOOL_LIST_CHANGED.value: "tools",
+    NotificationType.RESOURCE_LIST_CHANGED.value: "resources",
+    NotificationType.PROMPT_LIST_CHANGED.value: "prompts",
+}
+# 不受并发请求数限制的请求，避免连接繁忙时握手和健康检查排队超时
+UNLIMITED_METHODS = (RequestMethod.INITIALIZE, RequestMethod.PING)
 
 
 class MCPClient:
@@ -64,15 +76,26 @@ class MCPClient:
         self.server_capabilities: Optional[Dict[str, Any]] = None
         self.protocol_version: Optional[str] = None
         
-        # 缓存
-        self._tools_cache: List[Tool] = []
-        self._resources_cache: List[Resource] = []
-        self._prompts_cache: List[Prompt] = []
+        # 缓存：None表示需要重新获取；服务器发送list_changed通知时只失效对应的缓存
+        self._tools_cache: Optional[List[Tool]] = None
+        self._resources_cache: Optional[List[Resource]] = None
+        self._prompts_cache: Optional[List[Prompt]] = None
+        # 各列表的版本号，每次变更通知加一，下游缓存以此为键
+        self.list_versions: Dict[str, int] = {"tools": 0, "resources": 0, "prompts": 0}
+        self._list_changed_listeners: List[Callable[[str], None]] = []
         
         # 消息处理
         self._request_id_counter = 0
+        # 单个连接上同时进行的请求数上限
+        self.max_inflight = max(1, settings.MCP_MAX_INFLIGHT_REQUESTS)
+        self._inflight = asyncio.Semaphore(self.max_inflight)
         self._pending_requests: Dict[Union[str, int], asyncio.Future] = {}
         self._notification_handlers: Dict[str, List[Callable]] = {}
+        # 进度回调：progressToken -> 回调函数
+        self._progress_callbacks: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+        self.add_notification_handler(NotificationType.PROGRESS.value, self._handle_progress)
+        for notification_type in LIST_CHANGED_KINDS:
+            self.add_notification_handler(notification_type, self._handle_list_changed)
         
         # 后台任务
         self._message_handler_task: Optional[asyncio.Task] = None
@@ -87,12 +110,17 @@ class MCPClient:
             config["timeout"] = self.timeout
             self.transport = create_transport(transport_type, **config)
             
+            # 支持直接分发的传输层在读取任务中回调，响应到达即唤醒等待的请求
+            direct_dispatch = self.transport.set_handlers(self._dispatch_message, self._on_transport_closed)
+            self.transport.set_error_handler(self._on_transport_error)
+            
             # 建立连接
             await self.transport.connect()
             self.connected = True
             
-            # 启动消息处理任务
-            self._message_handler_task = asyncio.create_task(self._handle_messages())
+            # 不支持直接分发时启动消息处理任务
+            if not direct_dispatch:
+                self._message_handler_task = asyncio.create_task(self._handle_messages())
             
             # 执行初始化握手
             await self._initialize()
@@ -115,6 +143,7 @@ class MCPClient:
                 await self._message_handler_task
             except asyncio.CancelledError:
                 pass
+            self._message_handler_task = None
         
         # 清理待处理的请求
         for future in self._pending_requests.values():
@@ -147,34 +176,56 @@ class MCPClient:
     
     async def list_tools(self, force_refresh: bool = False) -> List[Tool]:
         """获取可用工具列表"""
-        if not force_refresh and self._tools_cache:
-            app_logger.debug(f"使用缓存的工具列表，共 {len(self._tools_cache)} 个工具")
+        if not force_refresh and self._tools_cache is not None:
             return self._tools_cache
         
         try:
-            app_logger.info(f"向服务器 {self.name} 发送工具列表请求")
+            app_logger.debug(f"向服务器 {self.name} 发送工具列表请求")
+            version = self.list_versions["tools"]
             # 为工具列表请求使用更长的超时时间（60秒）
             response = await self._send_request(RequestMethod.LIST_TOOLS, params={}, timeout=60.0)
-            app_logger.info(f"收到工具列表响应: {response}")
             
             tools_data = response.get("tools", [])
-            app_logger.info(f"解析到 {len(tools_data)} 个工具数据")
-            self._tools_cache = [Tool(**tool) for tool in tools_data]
-            app_logger.info(f"成功解析 {len(self._tools_cache)} 个工具")
-            return self._tools_cache
+            tools = [Tool(**tool) for tool in tools_data]
+            # 请求期间收到变更通知时不写入缓存，下次重新获取
+            if self.list_versions["tools"] == version:
+                self._tools_cache = tools
+            app_logger.info(f"服务器 {self.name} 返回 {len(tools)} 个工具")
+            return tools
         except Exception as e:
             app_logger.error(f"获取工具列表失败: {e}")
             import traceback
             app_logger.error(f"详细错误信息: {traceback.format_exc()}")
             raise
     
-    async def call_tool(self, name: str, arguments: Dict[str, Any] = None) -> ToolResult:
-        """调用工具"""
+    def cached_tool(self, name: str) -> Optional[Tool]:
+        """从已缓存的工具列表中查找工具，未缓存时返回None（不发起请求）"""
+        for tool in self._tools_cache or ():
+            if tool.name == name:
+                return tool
+        return None
+    
+    async def call_tool(
+        self,
+        name: str,
+        arguments: Dict[str, Any] = None,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> ToolResult:
+        """调用工具
+        
+        传入progress_callback时会在请求中携带progressToken，
+        服务器发出的notifications/progress会实时回调。
+        """
+        progress_token = None
         try:
             params = {
                 "name": name,
                 "arguments": arguments or {}
             }
+            if progress_callback is not None:
+                progress_token = uuid.uuid4().hex
+                params["_meta"] = {"progressToken": progress_token}
+                self._progress_callbacks[progress_token] = progress_callback
             
             response = await self._send_request(RequestMethod.CALL_TOOL, params)
             return ToolResult(**response)
@@ -182,17 +233,23 @@ class MCPClient:
         except Exception as e:
             app_logger.error(f"调用工具失败 {name}: {e}")
             raise
+        finally:
+            if progress_token is not None:
+                self._progress_callbacks.pop(progress_token, None)
     
     async def list_resources(self, force_refresh: bool = False) -> List[Resource]:
         """获取可用资源列表"""
-        if not force_refresh and self._resources_cache:
+        if not force_refresh and self._resources_cache is not None:
             return self._resources_cache
         
         try:
+            version = self.list_versions["resources"]
             response = await self._send_request(RequestMethod.LIST_RESOURCES, params={}, timeout=60.0)
             resources_data = response.get("resources", [])
-            self._resources_cache = [Resource(**resource) for resource in resources_data]
-            return self._resources_cache
+            resources = [Resource(**resource) for resource in resources_data]
+            if self.list_versions["resources"] == version:
+                self._resources_cache = resources
+            return resources
         except Exception as e:
             app_logger.error(f"获取资源列表失败: {e}")
             raise
@@ -209,14 +266,17 @@ class MCPClient:
     
     async def list_prompts(self, force_refresh: bool = False) -> List[Prompt]:
         """获取可用提示列表"""
-        if not force_refresh and self._prompts_cache:
+        if not force_refresh and self._prompts_cache is not None:
             return self._prompts_cache
         
         try:
+            version = self.list_versions["prompts"]
             response = await self._send_request(RequestMethod.LIST_PROMPTS, params={}, timeout=60.0)
             prompts_data = response.get("prompts", [])
-            self._prompts_cache = [Prompt(**prompt) for prompt in prompts_data]
-            return self._prompts_cache
+            prompts = [Prompt(**prompt) for prompt in prompts_data]
+            if self.list_versions["prompts"] == version:
+                self._prompts_cache = prompts
+            return prompts
         except Exception as e:
             app_logger.error(f"获取提示列表失败: {e}")
             raise
@@ -250,6 +310,24 @@ class MCPClient:
             except ValueError:
                 pass
     
+    def add_list_changed_listener(self, listener: Callable[[str], None]) -> None:
+        """注册列表变更监听器，参数为变更的列表类型（tools / resources / prompts）"""
+        self._list_changed_listeners.append(listener)
+    
+    def _handle_list_changed(self, notification: MCPNotification) -> None:
+        """服务器通知列表已变更：失效对应缓存并增加版本号"""
+        kind = LIST_CHANGED_KINDS.get(notification.method)
+        if kind is None:
+            return
+        setattr(self, f"_{kind}_cache", None)
+        self.list_versions[kind] += 1
+        app_logger.info(f"MCP服务器 {self.name} 的{kind}列表已变更，版本: {self.list_versions[kind]}")
+        for listener in self._list_changed_listeners:
+            try:
+                listener(kind)
+            except Exception as e:
+                app_logger.error(f"列表变更监听器异常: {e}")
+    
     async def _initialize(self) -> None:
         """执行初始化握手"""
         app_logger.info("开始MCP初始化握手")
@@ -297,39 +375,52 @@ class MCPClient:
         if not self.transport or not self.connected:
             raise MCPConnectionError("未连接到MCP服务器")
         
+        actual_timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + actual_timeout
+        
         request_id = self._generate_request_id()
         request = create_request(request_id, method, params)
         
         # 创建Future等待响应
-        future = asyncio.Future()
+        future = loop.create_future()
         self._pending_requests[request_id] = future
         
+        acquired = False
         try:
+            # 等待并发许可的时间计入请求超时；有空闲许可时直接获取，不创建超时任务
+            if method not in UNLIMITED_METHODS:
+                if self._inflight.locked():
+                    await asyncio.wait_for(self._inflight.acquire(), actual_timeout)
+                else:
+                    await self._inflight.acquire()
+                acquired = True
+            
             # 发送请求
-            app_logger.info(f"发送MCP请求: {method}, ID: {request_id}")
+            if app_logger.isEnabledFor(logging.DEBUG):
+                app_logger.debug(f"发送MCP请求: {method}, ID: {request_id}")
             await self.transport.send(request)
             
             # 等待响应
-            actual_timeout = timeout or self.timeout
-            app_logger.info(f"等待响应，超时时间: {actual_timeout}秒")
-            response = await asyncio.wait_for(future, timeout=actual_timeout)
-            
-            app_logger.info(f"收到响应: {type(response).__name__}")
-            if response.error:
-                error = response.error
-                app_logger.error(f"MCP请求错误: {error.code} - {error.message}")
-                raise create_mcp_error_from_code(error.code, error.message, error.data)
-            
-            result = response.result or {}
-            app_logger.info(f"请求成功，结果类型: {type(result)}, 内容: {result}")
-            return result
+            response = await asyncio.wait_for(future, timeout=max(0.0, deadline - loop.time()))
+            return self._unwrap_response(response)
             
         except asyncio.TimeoutError:
-            app_logger.error(f"MCP请求超时: {method}, 超时时间: {timeout or self.timeout}秒")
+            app_logger.error(f"MCP请求超时: {method}, 超时时间: {actual_timeout}秒")
             raise MCPTimeoutError(f"请求超时: {method}")
         finally:
+            if acquired:
+                self._inflight.release()
             self._pending_requests.pop(request_id, None)
     
+    @staticmethod
+    def _unwrap_response(response: MCPResponse) -> Dict[str, Any]:
+        if response.error:
+            error = response.error
+            app_logger.error(f"MCP请求错误: {error.code} - {error.message}")
+            raise create_mcp_error_from_code(error.code, error.message, error.data)
+        return response.result or {}
+    
     async def _send_notification(self, method: str, params: Optional[Dict[str, Any]] = None) -> None:
         """发送通知"""
         if not self.transport or not self.connected:
@@ -354,11 +445,44 @@ class MCPClient:
                         await self._handle_request(message)
                 except Exception as e:
                     app_logger.error(f"处理MCP消息失败: {e}")
+            
+            # 消息流结束（如子进程退出）
+            self._on_transport_closed()
                     
         except Exception as e:
             app_logger.error(f"消息处理循环异常: {e}")
             self.connected = False
     
+    def _dispatch_message(self, message: Union[MCPRequest, MCPResponse, MCPNotification]) -> None:
+        """由传输层读取任务直接调用：响应立即交给等待的请求，通知交给处理器"""
+        if isinstance(message, MCPResponse):
+            future = self._pending_requests.get(message.id)
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif isinstance(message, MCPNotification):
+            handlers = self._notification_handlers.get(message.method)
+            if handlers:
+                asyncio.create_task(self._handle_notification(message))
+        elif isinstance(message, MCPRequest):
+            asyncio.create_task(self._handle_request(message))
+    
+    def _on_transport_closed(self) -> None:
+        """消息流结束（如子进程退出），标记为断开，连接池下次使用时会重新连接"""
+        if self.connected:
+            app_logger.warning(f"MCP消息流已结束: {self.name}")
+        self.connected = False
+        for future in self._pending_requests.values():
+            if not future.done():
+                future.set_exception(MCPConnectionError("连接已断开"))
+    
+    def _on_transport_error(self, request_id: Optional[Union[str, int]], error: Exception) -> None:
+        """传输层丢弃了无法处理的响应（如超长消息）：对应请求立即失败；无法确定请求时所有等待中的请求失败"""
+        future = self._pending_requests.get(request_id) if request_id is not None else None
+        futures = [future] if future is not None else list(self._pending_requests.values())
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+    
     async def _handle_response(self, response: MCPResponse) -> None:
         """处理响应消息"""
         request_id = response.id
@@ -381,6 +505,18 @@ class MCPClient:
                 except Exception as e:
                     app_logger.error(f"通知处理器异常 {method}: {e}")
     
+    def _handle_progress(self, notification: MCPNotification) -> None:
+        """将进度通知分发给对应请求的回调"""
+        params = notification.params or {}
+        callback = self._progress_callbacks.get(params.get("progressToken"))
+        if callback is None:
+            return
+        callback({
+            "progress": params.get("progress"),
+            "total": params.get("total"),
+            "message": params.get("message")
+        })
+    
     async def _handle_request(self, request: MCPRequest) -> None:
         """处理请求消息(客户端通常不需要处理请求)"""
         # 客户端通常不处理来自服务器的请求
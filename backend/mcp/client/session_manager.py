@@ -5,21 +5,73 @@ MCP会话管理器
 """
 
 import asyncio
-from typing import Dict, List, Optional, Any, Union
+import contextlib
+import functools
+import hashlib
+import json
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Any, Set, Tuple, Union
 from .mcp_client import MCPClient
+from .health import MCPHealthSupervisor
+from .warm_pool import MCPWarmPool
 from ..schemas.protocol import Tool, Resource, Prompt, ToolResult, ResourceContent, PromptResult
 from ..schemas.exceptions import MCPError, MCPConnectionError
 from backend.utils.logging import app_logger
+from backend.utils.single_flight import SingleFlight, make_call_key
 from backend.core.config import settings
 
 
+# 数据库和控制字段，不传给传输层
+TRANSPORT_EXCLUDED_FIELDS = (
+    "enabled", "type", "description", "transport_type",
+    "auto_start", "is_public", "share_link", "config", "tags",
+    "retry_attempts", "retry_delay", "name"  # 这些已经在MCPClient构造函数中处理
+)
+
+
+class PooledServer:
+    """连接池中的服务器"""
+    __slots__ = ("user_id", "config", "fingerprint", "last_used", "active_calls")
+
+    def __init__(self, user_id: Optional[int], config: Dict[str, Any], fingerprint: str):
+        self.user_id = user_id  # None表示系统级服务器，不参与淘汰
+        self.config = config
+        self.fingerprint = fingerprint
+        self.last_used = time.monotonic()
+        self.active_calls = 0
+
+    def touch(self) -> None:
+        self.last_used = time.monotonic()
+
+
 class MCPSessionManager:
     """MCP会话管理器"""
     
     def __init__(self):
         self._clients: Dict[int, MCPClient] = {}
+        # 连接池信息：所属用户、配置指纹、最近使用时间
+        self._entries: Dict[int, PooledServer] = {}
         self._connection_locks: Dict[int, asyncio.Lock] = {}
+        # 用户服务器最近一次加载时间，以及防止同一用户并发加载的锁
+        self._user_loaded_at: Dict[int, float] = {}
+        self._user_load_locks: Dict[int, asyncio.Lock] = {}
+        # 按用户划分的服务器命名空间（None为系统级服务器）
+        self._user_servers: Dict[Optional[int], Set[int]] = {}
+        # 各命名空间的工具索引：工具名 -> (服务器ID, 工具)，服务器或工具列表变化时重建
+        self._tool_index: Dict[Optional[int], Dict[str, Tuple[int, Tool]]] = {}
+        self._tool_index_versions: Dict[Optional[int], int] = {}
         self._initialized = False
+        # 合并相同服务器、相同工具、相同参数的并发调用
+        self._tool_call_flight = SingleFlight("mcp_tools")
+        # 健康检查、熔断和自动重连
+        self.health = MCPHealthSupervisor(self)
+        # 预先启动的stdio服务器实例
+        self.warm_pool = MCPWarmPool(
+            enabled=settings.MCP_WARM_POOL_ENABLED,
+            size=settings.MCP_WARM_POOL_SIZE,
+            max_templates=settings.MCP_WARM_POOL_MAX_TEMPLATES,
+            min_demand=settings.MCP_WARM_POOL_MIN_DEMAND
+        )
     
     async def initialize(self, user_id: int = None) -> None:
         """初始化会话管理器"""
@@ -33,25 +85,39 @@ class MCPSessionManager:
                 app_logger.info("MCP功能已禁用")
                 return
             
-            # 初始化系统级配置的MCP服务器（如果有）
+            # 初始化系统级配置的MCP服务器（如果有），各服务器并发连接
+            system_servers = {}
             for server_key, server_config in settings.MCP_SERVERS.items():
                 if server_config.get("enabled", False):
-                    try:
-                        # 对于配置文件中的服务器，使用负数ID来区分
-                        # 这样就不会与数据库ID冲突
-                        server_id = hash(server_key) % 1000000  # 生成一个正数ID
-                        if server_id in self._clients:
-                            server_id = -server_id  # 如果冲突，使用负数
-                        await self._connect_server(server_id, server_config)
-                    except Exception as e:
-                        app_logger.error(f"连接系统级MCP服务器失败 {server_key}: {e}")
-                        # 继续尝试连接其他服务器
-                        continue
+                    # 对于配置文件中的服务器，使用负数ID来区分
+                    # 这样就不会与数据库ID冲突
+                    server_id = hash(server_key) % 1000000  # 生成一个正数ID
+                    if server_id in self._clients or server_id in system_servers:
+                        server_id = -server_id  # 如果冲突，使用负数
+                    system_servers[server_id] = (server_key, server_config)
+                    if server_config.get("type", "stdio") == "stdio":
+                        self.warm_pool.register(
+                            self.warm_key(server_config),
+                            self._transport_config(server_config),
+                            server_config.get("name", server_key),
+                            pinned=True
+                        )
+            
+            results = await asyncio.gather(
+                *(self.ensure_server(server_id, config) for server_id, (_, config) in system_servers.items()),
+                return_exceptions=True
+            )
+            for (server_key, _), result in zip(system_servers.values(), results):
+                if isinstance(result, BaseException):
+                    # 单个服务器失败不影响其他服务器
+                    app_logger.error(f"连接系统级MCP服务器失败 {server_key}: {result}")
             
             # 如果提供了user_id，加载用户的服务器
             if user_id is not None:
                 await self._load_user_servers(user_id)
             
+            self.health.start()
+            self.warm_pool.start()
             self._initialized = True
             app_logger.info(f"MCP会话管理器初始化完成，已连接 {len(self._clients)} 个服务器")
             
@@ -59,26 +125,71 @@ class MCPSessionManager:
             app_logger.error(f"初始化MCP会话管理器失败: {e}")
             raise
     
-    async def _load_user_servers(self, user_id: int) -> None:
-        """加载用户的MCP服务器"""
-        try:
-            from backend.db.session import get_async_session
-            from backend.crud.mcp_server import mcp_server
+    async def _load_user_servers(self, user_id: int, force: bool = False) -> None:
+        """加载用户的MCP服务器
+        
+        已连接且配置未变的服务器直接复用；配置变更或连接失效的服务器重新连接；
+        用户已禁用或删除的服务器断开。在 MCP_USER_RELOAD_TTL 内重复调用不再查询数据库。
+        """
+        if not force and self._user_servers_fresh(user_id):
+            return
+        
+        lock = self._user_load_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            # 等待锁期间其他请求可能已完成加载
+            if not force and self._user_servers_fresh(user_id):
+                return
             
-            async for db in get_async_session():
-                # 获取用户启用且自动启动的服务器
-                servers = await mcp_server.get_user_servers(db, user_id=user_id, skip=0, limit=1000)
+            await self._evict_idle()
+            try:
+                from backend.db.session import get_async_session
+                from backend.crud.mcp_server import mcp_server
                 
-                for server in servers:
-                    if server.enabled and server.auto_start:
-                        try:
-                            await self._connect_server(server.id, server.to_config_dict())
-                        except Exception as e:
-                            app_logger.error(f"连接用户MCP服务器失败 ID {server.id} ({server.name}): {e}")
-                            continue
-                break
-        except Exception as e:
-            app_logger.error(f"加载用户MCP服务器失败: {e}")
+                async for db in get_async_session():
+                    # 获取用户启用且自动启动的服务器
+                    servers = await mcp_server.get_user_servers(db, user_id=user_id, skip=0, limit=1000)
+                    wanted = [server for server in servers if server.enabled and server.auto_start]
+                    if len(wanted) > settings.MCP_MAX_SERVERS_PER_USER:
+                        app_logger.warning(
+                            f"用户 {user_id} 启用的MCP服务器数 {len(wanted)} 超过上限 "
+                            f"{settings.MCP_MAX_SERVERS_PER_USER}，只连接前 {settings.MCP_MAX_SERVERS_PER_USER} 个"
+                        )
+                        wanted = sorted(wanted, key=lambda server: server.id)[:settings.MCP_MAX_SERVERS_PER_USER]
+                    
+                    # 断开用户已禁用或删除的服务器
+                    wanted_ids = {server.id for server in wanted}
+                    self.health.forget_user(user_id, keep=wanted_ids)
+                    for server_id, entry in list(self._entries.items()):
+                        if entry.user_id == user_id and server_id not in wanted_ids:
+                            await self.remove_server(server_id)
+                    
+                    # 各服务器并发连接，耗时取决于最慢的服务器
+                    results = await asyncio.gather(
+                        *(self.ensure_server(server.id, server.to_config_dict(), user_id=user_id) for server in wanted),
+                        return_exceptions=True
+                    )
+                    for server, result in zip(wanted, results):
+                        if isinstance(result, BaseException):
+                            app_logger.error(f"连接用户MCP服务器失败 ID {server.id} ({server.name}): {result}")
+                    break
+                self._user_loaded_at[user_id] = time.monotonic()
+            except Exception as e:
+                app_logger.error(f"加载用户MCP服务器失败: {e}")
+
+    def _user_servers_fresh(self, user_id: int) -> bool:
+        """用户服务器在重新加载间隔内已加载，且连接都正常"""
+        loaded_at = self._user_loaded_at.get(user_id)
+        if loaded_at is None or time.monotonic() - loaded_at >= settings.MCP_USER_RELOAD_TTL:
+            return False
+        for server_id, entry in self._entries.items():
+            client = self._clients.get(server_id)
+            if entry.user_id == user_id and (client is None or not client.is_connected):
+                return False
+        return True
+
+    def invalidate_user(self, user_id: int) -> None:
+        """用户的服务器配置已变更，下次使用时重新加载"""
+        self._user_loaded_at.pop(user_id, None)
 
     async def load_user_servers_for_user(self, user_id: int) -> None:
         """为特定用户加载MCP服务器（动态调用）"""
@@ -90,6 +201,8 @@ class MCPSessionManager:
     async def shutdown(self) -> None:
         """关闭所有连接"""
         app_logger.info("关闭MCP会话管理器")
+        await self.health.stop()
+        await self.warm_pool.shutdown()
         
         disconnect_tasks = []
         for client in self._clients.values():
@@ -98,13 +211,139 @@ class MCPSessionManager:
         if disconnect_tasks:
             await asyncio.gather(*disconnect_tasks, return_exceptions=True)
         
+        # 关闭HTTP类传输共享的连接池
+        from .transport import http_client_pool
+        await http_client_pool.close()
+        
         self._clients.clear()
+        self._entries.clear()
+        self._user_servers.clear()
+        self._tool_index.clear()
         self._connection_locks.clear()
+        self._user_load_locks.clear()
+        self._user_loaded_at.clear()
         self._initialized = False
         
         app_logger.info("MCP会话管理器已关闭")
     
-    async def _connect_server(self, server_id: int, server_config: Dict[str, Any]) -> None:
+    @staticmethod
+    def _transport_config(server_config: Dict[str, Any]) -> Dict[str, Any]:
+        """过滤掉数据库和控制字段，只保留传输层需要的参数"""
+        return {
+            key: value for key, value in server_config.items()
+            if key not in TRANSPORT_EXCLUDED_FIELDS
+        }
+    
+    @classmethod
+    def config_fingerprint(cls, server_config: Dict[str, Any]) -> str:
+        """连接相关配置的指纹，指纹不变的服务器可以复用已有连接"""
+        data = {
+            "type": server_config.get("type", "stdio"),
+            "name": server_config.get("name"),
+            "transport": cls._transport_config(server_config),
+            "retry_attempts": server_config.get("retry_attempts"),
+            "retry_delay": server_config.get("retry_delay"),
+        }
+        raw = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    
+    @classmethod
+    def warm_key(cls, server_config: Dict[str, Any]) -> str:
+        """预热池的配置键：与配置指纹相同，但不区分服务器名称"""
+        return cls.config_fingerprint({**server_config, "name": None})
+    
+    def _get_lock(self, server_id: int) -> asyncio.Lock:
+        lock = self._connection_locks.get(server_id)
+        if lock is None:
+            lock = self._connection_locks[server_id] = asyncio.Lock()
+        return lock
+    
+    async def ensure_server(
+        self,
+        server_id: int,
+        server_config: Dict[str, Any],
+        user_id: Optional[int] = None
+    ) -> Optional[MCPClient]:
+        """确保服务器已按当前配置连接（幂等）
+        
+        已有连接正常且配置指纹相同时直接复用，否则断开旧连接后重新连接。
+        """
+        fingerprint = self.config_fingerprint(server_config)
+        async with self._get_lock(server_id):
+            client = self._clients.get(server_id)
+            entry = self._entries.get(server_id)
+            if client is not None and entry is not None and entry.fingerprint == fingerprint and client.is_connected:
+                entry.touch()
+                return client
+            
+            if client is not None:
+                reason = "配置已变更" if entry is not None and entry.fingerprint != fingerprint else "连接已失效"
+                app_logger.info(f"MCP服务器{reason}，重新连接: ID {server_id}")
+                await self._drop(server_id)
+            
+            if user_id is not None:
+                await self._make_room(server_id, user_id)
+            return await self._connect_server(server_id, server_config, user_id=user_id, fingerprint=fingerprint)
+    
+    async def _drop(self, server_id: int) -> None:
+        """从连接池移除并断开服务器（调用方负责加锁）"""
+        client = self._clients.pop(server_id, None)
+        entry = self._entries.pop(server_id, None)
+        if entry is not None:
+            self._user_servers.get(entry.user_id, set()).discard(server_id)
+            self._invalidate_namespace(entry.user_id)
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                app_logger.warning(f"断开MCP服务器失败 ID {server_id}: {e}")
+    
+    def _evictable(self, server_id: int, entry: "PooledServer") -> bool:
+        """用户服务器没有进行中的调用且未在连接中时可以淘汰"""
+        lock = self._connection_locks.get(server_id)
+        return entry.user_id is not None and entry.active_calls == 0 and not (lock is not None and lock.locked())
+    
+    async def _make_room(self, server_id: int, user_id: int) -> None:
+        """连接新服务器前检查用户和全局上限，全局已满时按LRU淘汰其他用户的空闲连接"""
+        user_count = sum(1 for sid, e in self._entries.items() if e.user_id == user_id and sid != server_id)
+        if user_count >= settings.MCP_MAX_SERVERS_PER_USER:
+            raise MCPConnectionError(f"用户 {user_id} 的MCP服务器连接数已达上限 {settings.MCP_MAX_SERVERS_PER_USER}")
+        
+        pooled = [(sid, e) for sid, e in self._entries.items() if e.user_id is not None]
+        overflow = len(pooled) + 1 - settings.MCP_MAX_LIVE_SERVERS
+        if overflow <= 0:
+            return
+        victims = sorted(
+            ((sid, e) for sid, e in pooled if e.user_id != user_id and self._evictable(sid, e)),
+            key=lambda item: item[1].last_used
+        )[:overflow]
+        if len(victims) < overflow:
+            raise MCPConnectionError(f"MCP服务器连接数已达上限 {settings.MCP_MAX_LIVE_SERVERS}，且没有可淘汰的空闲连接")
+        for sid, entry in victims:
+            app_logger.info(f"MCP连接数已满，淘汰最久未使用的服务器: ID {sid} (user_id={entry.user_id})")
+            self.invalidate_user(entry.user_id)
+            self.health.forget(sid)
+            await self._drop(sid)
+    
+    async def _evict_idle(self) -> None:
+        """断开空闲超时的用户服务器，下次使用时重新连接"""
+        if settings.MCP_SERVER_IDLE_TIMEOUT <= 0:
+            return
+        deadline = time.monotonic() - settings.MCP_SERVER_IDLE_TIMEOUT
+        for server_id, entry in list(self._entries.items()):
+            if entry.last_used < deadline and self._evictable(server_id, entry):
+                app_logger.info(f"MCP服务器空闲超时，断开连接: ID {server_id} (user_id={entry.user_id})")
+                self.invalidate_user(entry.user_id)
+                self.health.forget(server_id)
+                await self._drop(server_id)
+    
+    async def _connect_server(
+        self,
+        server_id: int,
+        server_config: Dict[str, Any],
+        user_id: Optional[int] = None,
+        fingerprint: Optional[str] = None
+    ) -> Optional[MCPClient]:
         """连接单个MCP服务器"""
         server_name = server_config.get("name", f"server_{server_id}")
         app_logger.info(f"连接MCP服务器: {server_name} (ID: {server_id})")
@@ -127,36 +366,45 @@ class MCPSessionManager:
             
             if requires_key and not has_env_vars:
                 app_logger.warning(f"跳过MCP服务器连接 {server_name} (ID: {server_id}): 缺少必要的环境变量")
-                return
-        
-        client = MCPClient(
-            name=server_name,
-            version="1.0.0",
-            timeout=settings.MCP_CONNECTION_TIMEOUT,
-            retry_attempts=settings.MCP_RETRY_ATTEMPTS,
-            retry_delay=settings.MCP_RETRY_DELAY
-        )
-        
-        # 准备连接参数
-        # 过滤掉数据库和控制字段，只保留传输层需要的参数
-        excluded_fields = [
-            "enabled", "type", "description", "transport_type", 
-            "auto_start", "is_public", "share_link", "config", "tags",
-            "retry_attempts", "retry_delay", "name"  # 这些已经在MCPClient构造函数中处理
-        ]
-        transport_config = {
-            key: value for key, value in server_config.items()
-            if key not in excluded_fields
-        }
+                return None
+        
+        # stdio服务器优先使用预热池中已初始化的实例
+        client = None
+        if transport_type == "stdio" and self.warm_pool.enabled:
+            warm_key = self.warm_key(server_config)
+            self.warm_pool.note_demand(warm_key, self._transport_config(server_config), server_name)
+            client = self.warm_pool.take(warm_key)
+            if client is not None:
+                client.name = server_name
+                app_logger.info(f"使用预热的MCP服务器实例: {server_name} (ID: {server_id})")
+        
+        if client is None:
+            client = MCPClient(
+                name=server_name,
+                version="1.0.0",
+                timeout=settings.MCP_CONNECTION_TIMEOUT,
+                retry_attempts=settings.MCP_RETRY_ATTEMPTS,
+                retry_delay=settings.MCP_RETRY_DELAY
+            )
+        
+        # 工具列表变更时重建所在命名空间的工具索引
+        client.add_list_changed_listener(functools.partial(self._on_list_changed, server_id, client))
         
         # 连接
-        await client.connect(transport_type, **transport_config)
+        if not client.is_connected:
+            await client.connect(transport_type, **self._transport_config(server_config))
         
-        # 保存客户端和锁，使用数据库ID作为key
+        # 保存客户端，使用数据库ID作为key
         self._clients[server_id] = client
-        self._connection_locks[server_id] = asyncio.Lock()
+        self._entries[server_id] = PooledServer(
+            user_id, server_config, fingerprint or self.config_fingerprint(server_config)
+        )
+        self._user_servers.setdefault(user_id, set()).add(server_id)
+        self._invalidate_namespace(user_id)
+        self.health.on_connected(server_id)
         
         app_logger.info(f"MCP服务器连接成功: {server_name} (ID: {server_id})")
+        return client
     
     def _requires_api_key(self, server_config: Dict[str, Any]) -> bool:
         """检查服务器是否需要API密钥"""
@@ -214,14 +462,10 @@ class MCPSessionManager:
         # 默认情况下，如果不是已知需要API密钥的服务，允许连接
         return True
     
-    async def add_server(self, server_id: int, server_config: Dict[str, Any]) -> None:
-        """动态添加MCP服务器"""
-        if server_id in self._clients:
-            app_logger.warning(f"MCP服务器已存在: ID {server_id}")
-            return
-        
+    async def add_server(self, server_id: int, server_config: Dict[str, Any], user_id: Optional[int] = None) -> None:
+        """动态添加MCP服务器，已按相同配置连接时直接复用"""
         try:
-            await self._connect_server(server_id, server_config)
+            await self.ensure_server(server_id, server_config, user_id=user_id)
             app_logger.info(f"动态添加MCP服务器成功: ID {server_id}")
         except Exception as e:
             app_logger.error(f"动态添加MCP服务器失败 ID {server_id}: {e}")
@@ -229,61 +473,51 @@ class MCPSessionManager:
     
     async def remove_server(self, server_id: int) -> None:
         """移除MCP服务器"""
+        # 等待后台重连的服务器不在连接池中，也需要停止重连
+        self.health.forget(server_id)
         if server_id not in self._clients:
             app_logger.warning(f"MCP服务器不存在: ID {server_id}")
             return
         
         try:
-            client = self._clients[server_id]
-            await client.disconnect()
-            
-            del self._clients[server_id]
-            del self._connection_locks[server_id]
+            async with self._get_lock(server_id):
+                await self._drop(server_id)
+            self._connection_locks.pop(server_id, None)
             
             app_logger.info(f"移除MCP服务器成功: ID {server_id}")
         except Exception as e:
             app_logger.error(f"移除MCP服务器失败 ID {server_id}: {e}")
             raise
     
-    async def reconnect_server(self, server_id: int) -> None:
-        """重连MCP服务器"""
-        if server_id not in self._clients:
-            app_logger.error(f"MCP服务器不存在: ID {server_id}")
-            return
+    async def reconnect_server(
+        self,
+        server_id: int,
+        server_config: Optional[Dict[str, Any]] = None,
+        user_id: Optional[int] = None
+    ) -> None:
+        """重连MCP服务器
+        
+        未传入配置时使用连接池中记录的配置（服务器已被淘汰时必须传入配置）。
+        """
+        entry = self._entries.get(server_id)
+        if server_config is None:
+            if entry is None:
+                app_logger.error(f"找不到MCP服务器配置: ID {server_id}")
+                return
+            server_config = entry.config
+        if user_id is None and entry is not None:
+            user_id = entry.user_id
         
-        async with self._connection_locks[server_id]:
-            try:
-                client = self._clients[server_id]
-                
-                # 如果已连接，先断开
-                if client.is_connected:
-                    await client.disconnect()
-                
-                # 获取原始配置重新连接
-                server_config = settings.MCP_SERVERS.get(server_id)
-                if not server_config:
-                    app_logger.error(f"找不到MCP服务器配置: ID {server_id}")
-                    return
-                
-                # 重新连接
-                transport_type = server_config.get("type", "stdio")
-                # 过滤掉数据库和控制字段，只保留传输层需要的参数
-                excluded_fields = [
-                    "enabled", "type", "description", "transport_type", 
-                    "auto_start", "is_public", "share_link", "config", "tags",
-                    "retry_attempts", "retry_delay", "name"  # 这些已经在MCPClient构造函数中处理
-                ]
-                transport_config = {
-                    key: value for key, value in server_config.items()
-                    if key not in excluded_fields
-                }
-                
-                await client.connect(transport_type, **transport_config)
-                app_logger.info(f"MCP服务器重连成功: ID {server_id}")
-                
-            except Exception as e:
-                app_logger.error(f"MCP服务器重连失败 ID {server_id}: {e}")
-                raise
+        try:
+            async with self._get_lock(server_id):
+                await self._drop(server_id)
+                if user_id is not None:
+                    await self._make_room(server_id, user_id)
+                await self._connect_server(server_id, server_config, user_id=user_id)
+            app_logger.info(f"MCP服务器重连成功: ID {server_id}")
+        except Exception as e:
+            app_logger.error(f"MCP服务器重连失败 ID {server_id}: {e}")
+            raise
     
     def get_client(self, server_id: int) -> Optional[MCPClient]:
         """获取MCP客户端"""
@@ -365,86 +599,239 @@ class MCPSessionManager:
         
         return status
     
-    async def list_all_tools(self, force_refresh: bool = False) -> Dict[int, List[Tool]]:
-        """获取所有服务器的工具列表"""
-        all_tools = {}
-        
-        for server_id, client in self._clients.items():
-            if not client.is_connected:
-                app_logger.warning(f"服务器 ID {server_id} 未连接，跳过工具列表获取")
-                continue
-            
+    def _visible_servers(self, user_id: Optional[int] = None) -> List[int]:
+        """用户可见的服务器：用户自己的服务器在前，其后是系统级服务器"""
+        servers = sorted(self._user_servers.get(user_id, ())) if user_id is not None else []
+        return servers + sorted(self._user_servers.get(None, ()))
+    
+    def _invalidate_namespace(self, namespace: Optional[int]) -> None:
+        self._tool_index.pop(namespace, None)
+        self._tool_index_versions[namespace] = self._tool_index_versions.get(namespace, 0) + 1
+    
+    def _on_list_changed(self, server_id: int, client: MCPClient, kind: str) -> None:
+        """服务器通知列表变更；连接已被替换时忽略"""
+        if kind == "tools" and self._clients.get(server_id) is client:
+            self.invalidate_tools(server_id)
+    
+    def get_tools_version(self, user_id: Optional[int] = None) -> Tuple[int, ...]:
+        """用户可见工具的版本，可见服务器增减或工具列表变化时改变，供下游缓存作为键
+        
+        未指定用户时范围是全部服务器，使用所有命名空间版本之和（各版本只增不减）。
+        """
+        if user_id is None:
+            return (sum(self._tool_index_versions.values()),)
+        return self._tool_index_versions.get(user_id, 0), self._tool_index_versions.get(None, 0)
+    
+    def invalidate_tools(self, server_id: int) -> None:
+        """服务器的工具列表已变化，重建所在命名空间的工具索引"""
+        entry = self._entries.get(server_id)
+        if entry is not None:
+            self._invalidate_namespace(entry.user_id)
+    
+    async def _get_tool_index(self, namespace: Optional[int]) -> Dict[str, Tuple[int, Tool]]:
+        """获取命名空间的工具索引，不存在时根据各服务器缓存的工具列表构建"""
+        index = self._tool_index.get(namespace)
+        if index is not None:
+            return index
+        
+        version = self._tool_index_versions.get(namespace, 0)
+        server_tools, status = await self._fan_out(
+            sorted(self._user_servers.get(namespace, ())),
+            lambda client: client.list_tools(),
+            "工具列表"
+        )
+        index = {}
+        for server_id, tools in server_tools.items():
+            for tool in tools:
+                if tool.name in index:
+                    app_logger.warning(f"工具名冲突，使用服务器 ID {index[tool.name][0]} 的工具: {tool.name}")
+                    continue
+                index[tool.name] = (server_id, tool)
+        
+        # 构建期间命名空间发生变化或有服务器失败时不缓存，下次重新构建
+        complete = all(item["status"] in ("ok", "disconnected") for item in status.values())
+        if complete and self._tool_index_versions.get(namespace, 0) == version:
+            self._tool_index[namespace] = index
+        return index
+    
+    async def _fan_out(
+        self,
+        server_ids: List[int],
+        fetch: Callable[[MCPClient], Awaitable[List[Any]]],
+        label: str
+    ) -> Tuple[Dict[int, List[Any]], Dict[int, Dict[str, Any]]]:
+        """并发向多个服务器获取列表
+        
+        每个服务器受 MCP_LIST_TIMEOUT 限制，整体受 MCP_LIST_BUDGET 限制，
+        失败或超时的服务器不影响其他服务器。返回成功的结果和每个服务器的状态。
+        """
+        results: Dict[int, List[Any]] = {}
+        status: Dict[int, Dict[str, Any]] = {}
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        
+        async def fetch_one(server_id: int, client: MCPClient) -> None:
             try:
-                app_logger.info(f"开始获取服务器 ID {server_id} 的工具列表")
-                tools = await client.list_tools(force_refresh)
-                all_tools[server_id] = tools
-                app_logger.info(f"成功获取服务器 ID {server_id} 的 {len(tools)} 个工具")
+                results[server_id] = await asyncio.wait_for(fetch(client), settings.MCP_LIST_TIMEOUT)
+                status[server_id] = {"status": "ok"}
+            except asyncio.TimeoutError:
+                app_logger.warning(f"获取服务器{label}超时 ID {server_id}")
+                status[server_id] = {"status": "timeout", "error": f"超过 {settings.MCP_LIST_TIMEOUT} 秒未响应"}
             except Exception as e:
-                app_logger.error(f"获取服务器工具列表失败 ID {server_id}: {e}")
-                all_tools[server_id] = []
-        
-        return all_tools
-    
-    async def list_all_resources(self, force_refresh: bool = False) -> Dict[int, List[Resource]]:
-        """获取所有服务器的资源列表"""
-        all_resources = {}
-        
-        for server_id, client in self._clients.items():
+                app_logger.error(f"获取服务器{label}失败 ID {server_id}: {e}")
+                status[server_id] = {"status": "error", "error": str(e)}
+            status[server_id]["elapsed_ms"] = int((loop.time() - started) * 1000)
+        
+        tasks = []
+        for server_id in server_ids:
+            client = self._clients.get(server_id)
+            if client is None:
+                continue
             if not client.is_connected:
+                status[server_id] = {"status": "disconnected", "error": "服务器未连接"}
                 continue
-            
-            try:
-                resources = await client.list_resources(force_refresh)
-                all_resources[server_id] = resources
-            except Exception as e:
-                app_logger.error(f"获取服务器资源列表失败 ID {server_id}: {e}")
-                all_resources[server_id] = []
-        
+            tasks.append(asyncio.create_task(fetch_one(server_id, client)))
+        
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=settings.MCP_LIST_BUDGET)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+                for server_id in server_ids:
+                    if server_id not in status and server_id in self._clients:
+                        status[server_id] = {
+                            "status": "timeout",
+                            "error": f"超出总时间预算 {settings.MCP_LIST_BUDGET} 秒",
+                            "elapsed_ms": int((loop.time() - started) * 1000)
+                        }
+                app_logger.warning(f"获取{label}超出总时间预算，{len(pending)} 个服务器返回部分结果")
+        return results, status
+    
+    def _scope_servers(self, user_id: Optional[int] = None) -> List[int]:
+        """传入user_id时只包含该用户可见的服务器，否则为全部服务器"""
+        return self._visible_servers(user_id) if user_id is not None else list(self._clients.keys())
+    
+    async def list_all_tools_with_status(
+        self,
+        force_refresh: bool = False,
+        user_id: Optional[int] = None
+    ) -> Tuple[Dict[int, List[Tool]], Dict[int, Dict[str, Any]]]:
+        """并发获取工具列表，返回各服务器的工具和获取状态"""
+        server_ids = self._scope_servers(user_id)
+        all_tools, status = await self._fan_out(
+            server_ids, lambda client: client.list_tools(force_refresh), "工具列表"
+        )
+        if force_refresh:
+            for server_id in server_ids:
+                self.invalidate_tools(server_id)
+        return all_tools, status
+    
+    async def list_all_tools(self, force_refresh: bool = False, user_id: Optional[int] = None) -> Dict[int, List[Tool]]:
+        """获取服务器的工具列表
+        
+        传入user_id时只返回该用户可见的服务器（用户自己的和系统级的），否则返回全部服务器。
+        获取失败或超时的服务器返回空列表。
+        """
+        all_tools, status = await self.list_all_tools_with_status(force_refresh, user_id)
+        for server_id, item in status.items():
+            if item["status"] != "disconnected":
+                all_tools.setdefault(server_id, [])
+        return all_tools
+    
+    async def list_all_resources(self, force_refresh: bool = False, user_id: Optional[int] = None) -> Dict[int, List[Resource]]:
+        """并发获取服务器的资源列表"""
+        all_resources, status = await self._fan_out(
+            self._scope_servers(user_id), lambda client: client.list_resources(force_refresh), "资源列表"
+        )
+        for server_id, item in status.items():
+            if item["status"] != "disconnected":
+                all_resources.setdefault(server_id, [])
         return all_resources
     
-    async def list_all_prompts(self, force_refresh: bool = False) -> Dict[int, List[Prompt]]:
-        """获取所有服务器的提示列表"""
-        all_prompts = {}
-        
-        for server_id, client in self._clients.items():
-            if not client.is_connected:
-                continue
-            
-            try:
-                prompts = await client.list_prompts(force_refresh)
-                all_prompts[server_id] = prompts
-            except Exception as e:
-                app_logger.error(f"获取服务器提示列表失败 ID {server_id}: {e}")
-                all_prompts[server_id] = []
-        
+    async def list_all_prompts(self, force_refresh: bool = False, user_id: Optional[int] = None) -> Dict[int, List[Prompt]]:
+        """并发获取服务器的提示列表"""
+        all_prompts, status = await self._fan_out(
+            self._scope_servers(user_id), lambda client: client.list_prompts(force_refresh), "提示列表"
+        )
+        for server_id, item in status.items():
+            if item["status"] != "disconnected":
+                all_prompts.setdefault(server_id, [])
         return all_prompts
     
-    async def call_tool(
-        self,
-        server_id: int,
-        tool_name: str,
-        arguments: Dict[str, Any] = None
-    ) -> ToolResult:
-        """调用指定服务器的工具"""
+    def _acquire(self, server_id: int) -> MCPClient:
+        """获取可用的客户端并标记为使用中，使用中的服务器不会被淘汰"""
         client = self._clients.get(server_id)
         if not client:
             raise MCPError(f"MCP服务器不存在: ID {server_id}")
         
         if not client.is_connected:
+            self.health.report_disconnected(server_id)
             raise MCPConnectionError(f"MCP服务器未连接: ID {server_id}")
         
-        return await client.call_tool(tool_name, arguments)
+        # 已熔断的服务器直接失败，不再等待超时
+        self.health.before_call(server_id)
+        
+        entry = self._entries.get(server_id)
+        if entry is not None:
+            entry.touch()
+            entry.active_calls += 1
+        return client
+    
+    def _release(self, server_id: int) -> None:
+        entry = self._entries.get(server_id)
+        if entry is not None:
+            entry.active_calls = max(0, entry.active_calls - 1)
+            entry.touch()
+    
+    @contextlib.asynccontextmanager
+    async def _use(self, server_id: int):
+        """使用服务器完成一次调用，记录延迟和结果用于健康统计"""
+        client = self._acquire(server_id)
+        started = time.monotonic()
+        error = None
+        try:
+            yield client
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(server_id)
+            self.health.record_call(server_id, time.monotonic() - started, error)
+    
+    async def call_tool(
+        self,
+        server_id: int,
+        tool_name: str,
+        arguments: Dict[str, Any] = None,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> ToolResult:
+        """调用指定服务器的工具
+
+        只有声明为只读或幂等的工具才合并相同的并发调用，其他工具（如创建、编辑）每次都直接调用。
+        """
+        async with self._use(server_id) as client:
+            if not settings.MCP_COALESCE_TOOL_CALLS or not self._is_coalescible(client, tool_name):
+                return await client.call_tool(tool_name, arguments, progress_callback=progress_callback)
+            
+            key = make_call_key(server_id, tool_name, arguments or {})
+            return await self._tool_call_flight.do_with_progress(
+                key,
+                lambda emit: client.call_tool(tool_name, arguments, progress_callback=emit),
+                progress_callback
+            )
+    
+    @staticmethod
+    def _is_coalescible(client: MCPClient, tool_name: str) -> bool:
+        """工具注解声明了 readOnlyHint 或 idempotentHint 时才可以合并；查不到工具定义时不合并"""
+        tool = client.cached_tool(tool_name)
+        annotations = tool.annotations if tool is not None else None
+        return annotations is not None and bool(annotations.readOnlyHint or annotations.idempotentHint)
     
     async def read_resource(self, server_id: int, uri: str) -> ResourceContent:
         """读取指定服务器的资源"""
-        client = self._clients.get(server_id)
-        if not client:
-            raise MCPError(f"MCP服务器不存在: ID {server_id}")
-        
-        if not client.is_connected:
-            raise MCPConnectionError(f"MCP服务器未连接: ID {server_id}")
-        
-        return await client.read_resource(uri)
+        async with self._use(server_id) as client:
+            return await client.read_resource(uri)
     
     async def get_prompt(
         self,
@@ -453,30 +840,20 @@ class MCPSessionManager:
         arguments: Dict[str, Any] = None
     ) -> PromptResult:
         """获取指定服务器的提示"""
-        client = self._clients.get(server_id)
-        if not client:
-            raise MCPError(f"MCP服务器不存在: ID {server_id}")
-        
-        if not client.is_connected:
-            raise MCPConnectionError(f"MCP服务器未连接: ID {server_id}")
-        
-        return await client.get_prompt(prompt_name, arguments)
+        async with self._use(server_id) as client:
+            return await client.get_prompt(prompt_name, arguments)
     
-    async def find_tool(self, tool_name: str) -> Optional[tuple[int, Tool]]:
-        """在所有服务器中查找工具"""
-        for server_id, client in self._clients.items():
-            if not client.is_connected:
-                continue
-            
-            try:
-                tools = await client.list_tools()
-                for tool in tools:
-                    if tool.name == tool_name:
-                        return server_id, tool
-            except Exception as e:
-                app_logger.error(f"查找工具时出错 ID {server_id}: {e}")
-                continue
-        
+    async def find_tool(self, tool_name: str, user_id: Optional[int] = None) -> Optional[tuple[int, Tool]]:
+        """在用户可见的服务器中查找工具
+        
+        先查用户自己的服务器，再查系统级服务器；未传入user_id时只查系统级服务器。
+        """
+        namespaces = [user_id, None] if user_id is not None else [None]
+        for namespace in namespaces:
+            index = await self._get_tool_index(namespace)
+            found = index.get(tool_name)
+            if found is not None:
+                return found
         return None
     
     async def find_resource(self, uri: str) -> Optional[tuple[int, Resource]]:
@@ -526,23 +903,30 @@ class MCPSessionManager:
         servers_status = {}
         connected_count = 0
         
+        now = time.monotonic()
         for server_id, client in self._clients.items():
             is_connected = client.is_connected if client else False
             if is_connected:
                 connected_count += 1
             
+            entry = self._entries.get(server_id)
             servers_status[str(server_id)] = {
                 "id": server_id,
                 "connected": is_connected,
                 "initialized": is_connected,  # 如果连接成功，认为已初始化
-                "name": client.name if client else f"server_{server_id}"
+                "name": client.name if client else f"server_{server_id}",
+                "user_id": entry.user_id if entry else None,
+                "idle_seconds": round(now - entry.last_used, 1) if entry else None,
+                "active_calls": entry.active_calls if entry else 0,
+                "health": self.health.get_metrics(server_id)
             }
         
         return {
             "initialized": True,
             "server_count": len(self._clients),
             "connected_count": connected_count,
-            "servers": servers_status
+            "servers": servers_status,
+            "warm_pool": self.warm_pool.get_stats()
         }
 
     @property
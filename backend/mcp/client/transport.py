@@ -3,19 +3,33 @@ MCP传输层实现
 
 支持多种传输协议：
 - stdio: 标准输入输出传输
-- SSE: Server-Sent Events传输
+- sse: HTTP+SSE传输（2024-11-05）
+- streamable_http: Streamable HTTP传输（2025-03-26）
+- inprocess: 在API进程内直接调用内置服务器
 """
 
 import asyncio
 import json
-import subprocess
+import logging
+import random
+import re
 import sys
 from abc import ABC, abstractmethod
-from typing import Any, AsyncIterator, Dict, Optional, Union, Callable
+from typing import Any, AsyncIterator, Dict, List, Optional, Union, Callable
+from urllib.parse import urljoin
 import httpx
-from ..schemas.protocol import MCPMessage, MCPRequest, MCPResponse, MCPNotification
+from ..schemas.protocol import (
+    MCPMessage, MCPRequest, MCPResponse, MCPNotification,
+    RequestMethod, ErrorCode, create_response, create_error
+)
 from ..schemas.exceptions import MCPConnectionError, MCPTimeoutError, MCPParseError
 from backend.utils.logging import app_logger
+from backend.core.config import settings
+
+
+MessageHandler = Callable[[Union[MCPRequest, MCPResponse, MCPNotification]], None]
+# 消息级错误回调：参数为出错响应的请求ID（无法确定时为None）和异常
+ErrorHandler = Callable[[Optional[Union[str, int]], Exception], None]
 
 
 class Transport(ABC):
@@ -24,6 +38,18 @@ class Transport(ABC):
     def __init__(self, timeout: float = 30.0):
         self.timeout = timeout
         self.connected = False
+        self._on_error: Optional[ErrorHandler] = None
+    
+    def set_handlers(self, on_message: MessageHandler, on_close: Callable[[], None]) -> bool:
+        """注册消息和关闭回调，由读取任务直接分发消息
+        
+        返回False表示传输层不支持直接分发，调用方需要通过receive()读取消息。
+        """
+        return False
+    
+    def set_error_handler(self, on_error: ErrorHandler) -> None:
+        """注册消息级错误回调，收到无法处理的响应时让等待中的请求立即失败而不是等到超时"""
+        self._on_error = on_error
         
     @abstractmethod
     async def connect(self) -> None:
@@ -46,17 +72,107 @@ class Transport(ABC):
         pass
 
 
+# 超长消息保留的开头部分，用于找出所属请求的ID
+OVERSIZED_HEAD_BYTES = 256
+_REQUEST_ID_PATTERN = re.compile(rb'"id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+
+def oversized_request_id(head: bytes) -> Optional[Union[str, int]]:
+    """从超长消息的开头找出请求ID，找不到时返回None"""
+    match = _REQUEST_ID_PATTERN.search(head)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+class LineFramer:
+    """把字节流增量切分为以换行结尾的消息
+    
+    每次只从上次扫描结束的位置继续查找换行，超大消息不会被重复扫描，
+    也不受 StreamReader.readline 默认64KB的限制。
+    超过最大长度的消息被丢弃，之后的输入跳过到下一个换行，剩余部分不会被当作新消息解析。
+    """
+    __slots__ = ("max_size", "_buffer", "_scan_from", "_skipping", "_on_oversized")
+    
+    def __init__(self, max_size: int, on_oversized: Optional[Callable[[bytes, int], None]] = None):
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._scan_from = 0
+        self._skipping = False
+        # 丢弃超长消息时的回调，参数为消息开头和已读取的字节数
+        self._on_oversized = on_oversized
+    
+    def feed(self, data: bytes) -> List[bytes]:
+        """追加数据，返回已完整的消息（不含换行）"""
+        if self._skipping:
+            end = data.find(b"\n")
+            if end == -1:
+                return []
+            self._skipping = False
+            data = data[end + 1:]
+        self._buffer += data
+        lines = []
+        start = 0
+        position = self._scan_from
+        while True:
+            end = self._buffer.find(b"\n", position)
+            if end == -1:
+                break
+            lines.append(bytes(self._buffer[start:end]))
+            start = position = end + 1
+        if start:
+            del self._buffer[:start]
+        self._scan_from = len(self._buffer)
+        if self._scan_from > self.max_size:
+            head = bytes(self._buffer[:OVERSIZED_HEAD_BYTES])
+            size = self._scan_from
+            self._buffer.clear()
+            self._scan_from = 0
+            self._skipping = True
+            if self._on_oversized is not None:
+                self._on_oversized(head, size)
+        return lines
+    
+    def flush(self) -> Optional[bytes]:
+        """流结束时返回未以换行结尾的剩余数据"""
+        rest = bytes(self._buffer).strip()
+        self._buffer.clear()
+        self._scan_from = 0
+        self._skipping = False
+        return rest or None
+
+
 class StdioTransport(Transport):
-    """标准输入输出传输"""
+    """标准输入输出传输
+    
+    读取任务按块读取stdout并增量切分消息。注册了消息回调时直接在读取任务中分发，
+    响应可以立即唤醒等待中的请求；否则放入队列供receive()读取。
+    """
     
     def __init__(self, command: str, args: list = None, timeout: float = 30.0, env: dict = None, **kwargs):
         super().__init__(timeout)
         self.command = command
         self.args = args or []
         self.env = env or {}
-        self.process: Optional[subprocess.Popen] = None
+        self.process: Optional[asyncio.subprocess.Process] = None
         self._reader_task: Optional[asyncio.Task] = None
-        self._message_queue = asyncio.Queue()
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._message_queue: asyncio.Queue = asyncio.Queue()
+        self._on_message: Optional[MessageHandler] = None
+        self._on_close: Optional[Callable[[], None]] = None
+        # 写入合并：同一轮事件循环中发出的消息在一次write中写出，共享一次drain
+        self._write_batch: Optional[List[bytes]] = None
+        self._write_done: Optional[asyncio.Future] = None
+        self.write_calls = 0
+        self.messages_sent = 0
+    
+    def set_handlers(self, on_message: MessageHandler, on_close: Callable[[], None]) -> bool:
+        self._on_message = on_message
+        self._on_close = on_close
+        return True
         
     async def connect(self) -> None:
         """启动子进程并建立连接"""
@@ -112,9 +228,10 @@ class StdioTransport(Transport):
                 env=process_env
             )
             
-            # 启动读取任务
-            self._reader_task = asyncio.create_task(self._read_messages())
+            # 启动读取任务；stderr也需要持续读取，否则管道写满会阻塞子进程
             self.connected = True
+            self._reader_task = asyncio.create_task(self._read_messages())
+            self._stderr_task = asyncio.create_task(self._drain_stderr())
             app_logger.info("MCP服务器连接成功")
             
         except Exception as e:
@@ -123,12 +240,15 @@ class StdioTransport(Transport):
     
     async def disconnect(self) -> None:
         """断开连接并终止子进程"""
-        if self._reader_task:
-            self._reader_task.cancel()
-            try:
-                await self._reader_task
-            except asyncio.CancelledError:
-                pass
+        # 主动断开时不再回调关闭通知
+        self._on_close = None
+        for task in (self._reader_task, self._stderr_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
                 
         if self.process:
             try:
@@ -145,208 +265,700 @@ class StdioTransport(Transport):
     
     async def send(self, message: Union[MCPRequest, MCPResponse, MCPNotification]) -> None:
         """发送消息到子进程"""
-        if not self.process or not self.connected:
+        await self._write([message.model_dump_json().encode() + b"\n"])
+    
+    async def _write(self, lines: List[bytes]) -> None:
+        """加入当前写入批次并等待写出
+        
+        批次在本轮事件循环结束时写出，期间其他协程发出的消息一起合并为一次write和drain。
+        """
+        if not self.process or not self.connected or not self.process.stdin:
             raise MCPConnectionError("未连接到MCP服务器")
-            
+        if self._write_batch is None:
+            loop = asyncio.get_running_loop()
+            self._write_batch = []
+            self._write_done = loop.create_future()
+            # 调用方都取消时避免未读取异常的警告
+            self._write_done.add_done_callback(lambda f: f.cancelled() or f.exception())
+            loop.call_soon(self._flush_writes)
+        self._write_batch.extend(lines)
+        await asyncio.shield(self._write_done)
+    
+    def _flush_writes(self) -> None:
+        batch, done = self._write_batch, self._write_done
+        self._write_batch = self._write_done = None
+        stdin = self.process.stdin if self.process else None
         try:
-            message_json = message.model_dump_json() + "\n"
-            app_logger.info(f"发送MCP消息: {message_json.strip()}")
-            
-            if self.process.stdin:
-                self.process.stdin.write(message_json.encode())
-                await self.process.stdin.drain()
-                app_logger.info("MCP消息发送成功")
-            else:
-                raise MCPConnectionError("进程stdin不可用")
-                
+            if stdin is None or not self.connected:
+                raise MCPConnectionError("未连接到MCP服务器")
+            stdin.write(b"".join(batch))
         except Exception as e:
             app_logger.error(f"发送MCP消息失败: {e}")
-            raise MCPConnectionError(f"发送消息失败: {e}")
+            done.set_exception(e if isinstance(e, MCPConnectionError) else MCPConnectionError(f"发送消息失败: {e}"))
+            return
+        self.write_calls += 1
+        self.messages_sent += len(batch)
+        if app_logger.isEnabledFor(logging.DEBUG):
+            app_logger.debug(f"发送MCP消息: {len(batch)} 条, {sum(len(line) for line in batch)} 字节")
+        
+        drain = asyncio.ensure_future(stdin.drain())
+        
+        def finish(task: asyncio.Future) -> None:
+            if done.done():
+                return
+            if task.cancelled():
+                done.set_exception(MCPConnectionError("发送消息被取消"))
+            elif task.exception() is not None:
+                app_logger.error(f"发送MCP消息失败: {task.exception()}")
+                done.set_exception(MCPConnectionError(f"发送消息失败: {task.exception()}"))
+            else:
+                done.set_result(None)
+        drain.add_done_callback(finish)
     
     async def receive(self) -> AsyncIterator[Union[MCPRequest, MCPResponse, MCPNotification]]:
-        """接收消息"""
-        while self.connected:
-            try:
-                # 使用较短的超时时间，避免长时间阻塞
-                message = await asyncio.wait_for(
-                    self._message_queue.get(),
-                    timeout=5.0  # 5秒超时，避免长时间阻塞
-                )
-                app_logger.debug(f"接收到MCP消息: {type(message).__name__}")
-                yield message
-            except asyncio.TimeoutError:
-                # 静默处理超时，不打印警告（这是正常的空闲状态）
-                continue
-            except Exception as e:
-                app_logger.error(f"接收MCP消息失败: {e}")
+        """接收消息（未注册消息回调时使用），连接关闭后结束"""
+        while True:
+            message = await self._message_queue.get()
+            if message is None:
                 break
+            yield message
     
     async def _read_messages(self) -> None:
-        """从子进程读取消息"""
+        """按块读取子进程输出，切分并分发消息"""
         if not self.process or not self.process.stdout:
             return
-            
+        
+        stdout = self.process.stdout
+        framer = LineFramer(settings.MCP_STDIO_MAX_MESSAGE_BYTES, self._drop_oversized)
         try:
-            app_logger.debug("开始读取MCP消息流")
-            while self.connected and self.process.returncode is None:
-                line = await self.process.stdout.readline()
-                if not line:
+            while True:
+                chunk = await stdout.read(settings.MCP_STDIO_READ_CHUNK)
+                if not chunk:
                     app_logger.debug("MCP消息流结束")
+                    rest = framer.flush()
+                    if rest:
+                        self._dispatch_line(rest)
                     break
-                    
-                try:
-                    line_str = line.decode().strip()
-                    if not line_str:
-                        continue
-                        
-                    app_logger.info(f"接收到原始MCP消息: {line_str}")
-                    
-                    data = json.loads(line_str)
-                    message = self._parse_message(data)
-                    app_logger.info(f"解析MCP消息成功: {type(message).__name__}")
-                    await self._message_queue.put(message)
-                    
-                except json.JSONDecodeError as e:
-                    app_logger.error(f"解析MCP消息JSON失败: {e}, 消息: {line_str}")
-                    continue
-                except Exception as e:
-                    app_logger.error(f"处理MCP消息失败: {e}")
-                    continue
-                    
+                for line in framer.feed(chunk):
+                    self._dispatch_line(line)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             app_logger.error(f"读取MCP消息流失败: {e}")
         finally:
-            app_logger.debug("MCP消息读取结束")
             self.connected = False
+            self._message_queue.put_nowait(None)
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+    
+    def _drop_oversized(self, head: bytes, size: int) -> None:
+        """丢弃超长消息，并让对应的请求立即失败（找不到请求ID时由客户端让所有等待中的请求失败）"""
+        error = MCPParseError(f"消息超过最大长度 {settings.MCP_STDIO_MAX_MESSAGE_BYTES} 字节（已读取 {size} 字节）")
+        request_id = oversized_request_id(head)
+        app_logger.error(f"丢弃超长MCP消息: {error}, 请求ID: {request_id}, 开头: {head[:100]!r}")
+        if self._on_error is None:
+            return
+        try:
+            self._on_error(request_id, error)
+        except Exception as e:
+            app_logger.error(f"处理超长MCP消息失败: {e}")
+    
+    def _dispatch_line(self, line: bytes) -> None:
+        """解析一条消息并交给回调或放入队列"""
+        line = line.strip()
+        if not line:
+            return
+        try:
+            payload = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            app_logger.error(f"解析MCP消息JSON失败: {e}, 消息: {line[:200]!r}")
+            return
+        
+        # 批量响应为JSON数组
+        for item in payload if isinstance(payload, list) else [payload]:
+            try:
+                message = self._parse_message(item)
+            except MCPParseError as e:
+                app_logger.error(f"{e}, 消息: {line[:200]!r}")
+                continue
+            
+            if app_logger.isEnabledFor(logging.DEBUG):
+                app_logger.debug(f"接收到MCP消息: {type(message).__name__}, {len(line)} 字节")
+            if self._on_message is None:
+                self._message_queue.put_nowait(message)
+                continue
+            try:
+                self._on_message(message)
+            except Exception as e:
+                app_logger.error(f"处理MCP消息失败: {e}")
+    
+    async def _drain_stderr(self) -> None:
+        """持续读取子进程stderr，记录为调试日志"""
+        if not self.process or not self.process.stderr:
+            return
+        stderr = self.process.stderr
+        framer = LineFramer(settings.MCP_STDIO_MAX_MESSAGE_BYTES)
+        try:
+            while True:
+                chunk = await stderr.read(settings.MCP_STDIO_READ_CHUNK)
+                if not chunk:
+                    break
+                for line in framer.feed(chunk):
+                    app_logger.debug(f"MCP服务器stderr [{self.command}]: {line.decode(errors='replace')}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            app_logger.debug(f"读取MCP服务器stderr结束: {e}")
     
     def _parse_message(self, data: Dict[str, Any]) -> Union[MCPRequest, MCPResponse, MCPNotification]:
         """解析消息"""
+        return parse_message(data)
+
+
+class SSEEvent:
+    """一条Server-Sent Events事件"""
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(self, event: str = "message", data: str = "", id: Optional[str] = None, retry: Optional[int] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+
+async def iter_sse_events(lines: AsyncIterator[str]) -> AsyncIterator[SSEEvent]:
+    """按SSE规范把文本行解析为事件（多行data以换行拼接，空行结束一条事件）"""
+    event, data, event_id, retry = "message", [], None, None
+    async for line in lines:
+        if not line:
+            if data or event_id is not None:
+                yield SSEEvent(event, "\n".join(data), event_id, retry)
+            event, data, event_id, retry = "message", [], None, None
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value or "message"
+        elif field == "id":
+            event_id = value
+        elif field == "retry" and value.isdigit():
+            retry = int(value)
+    if data:
+        yield SSEEvent(event, "\n".join(data), event_id, retry)
+
+
+class HTTPClientPool:
+    """所有HTTP类MCP传输共享的连接池，多个服务器复用同一组keep-alive连接"""
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def get(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                # 读取超时由各请求单独设置，事件流不设读取超时
+                timeout=httpx.Timeout(settings.MCP_CONNECTION_TIMEOUT, read=None),
+                limits=httpx.Limits(
+                    max_connections=settings.MCP_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.MCP_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=30.0
+                ),
+                follow_redirects=True
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# 创建全局HTTP连接池实例
+http_client_pool = HTTPClientPool()
+
+
+def backoff_delay(attempt: int, base_delay: Optional[float] = None, max_delay: Optional[float] = None) -> float:
+    """第attempt次重连前的等待时间：指数增长并加入随机抖动，默认使用HTTP事件流的重连配置"""
+    if base_delay is None:
+        base_delay = settings.MCP_HTTP_RECONNECT_BASE_DELAY
+    if max_delay is None:
+        max_delay = settings.MCP_HTTP_RECONNECT_MAX_DELAY
+    delay = min(max_delay, base_delay * (2 ** min(attempt, 30)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class HTTPTransportBase(Transport):
+    """HTTP类传输的公共部分：消息分发、事件流重连和关闭通知"""
+
+    def __init__(self, url: str, timeout: float = 30.0, headers: Optional[Dict[str, str]] = None, **kwargs):
+        super().__init__(timeout)
+        self.url = url
+        self.headers = headers or {}
+        self.last_event_id: Optional[str] = None
+        self._retry_delay: Optional[float] = None
+        self._tasks: set = set()
+        self._message_queue: asyncio.Queue = asyncio.Queue()
+        self._on_message: Optional[MessageHandler] = None
+        self._on_close: Optional[Callable[[], None]] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return http_client_pool.get()
+
+    def set_handlers(self, on_message: MessageHandler, on_close: Callable[[], None]) -> bool:
+        self._on_message = on_message
+        self._on_close = on_close
+        return True
+
+    async def receive(self) -> AsyncIterator[Union[MCPRequest, MCPResponse, MCPNotification]]:
+        """接收消息（未注册消息回调时使用），连接关闭后结束"""
+        while True:
+            message = await self._message_queue.get()
+            if message is None:
+                break
+            yield message
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _cancel_tasks(self) -> None:
+        tasks = [task for task in self._tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _deliver_payload(self, payload: Any) -> None:
+        """分发JSON-RPC消息（单条或批量数组）"""
+        items = payload if isinstance(payload, list) else [payload]
+        for item in items:
+            try:
+                message = parse_message(item)
+            except MCPParseError as e:
+                app_logger.error(f"{e}, 消息: {str(item)[:200]}")
+                continue
+            if self._on_message is None:
+                self._message_queue.put_nowait(message)
+                continue
+            try:
+                self._on_message(message)
+            except Exception as e:
+                app_logger.error(f"处理MCP消息失败: {e}")
+
+    def _deliver_event(self, event: SSEEvent) -> None:
+        if event.id:
+            self.last_event_id = event.id
+        if event.retry is not None:
+            self._retry_delay = event.retry / 1000
+        if event.event != "message" or not event.data:
+            return
         try:
-            if "id" in data:
-                if "method" in data:
-                    # Request
-                    return MCPRequest(**data)
-                else:
-                    # Response
-                    return MCPResponse(**data)
-            elif "method" in data:
-                # Notification
-                return MCPNotification(**data)
+            payload = json.loads(event.data)
+        except json.JSONDecodeError as e:
+            app_logger.error(f"解析SSE数据失败: {e}, 数据: {event.data[:200]}")
+            return
+        self._deliver_payload(payload)
+
+    def _closed(self, reason: str) -> None:
+        """连接不可恢复，通知客户端"""
+        if self.connected:
+            app_logger.warning(f"MCP HTTP连接已关闭 {self.url}: {reason}")
+        self.connected = False
+        self._message_queue.put_nowait(None)
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    async def _reconnect_wait(self, attempt: int) -> bool:
+        """等待下一次重连，超过重连次数时返回False"""
+        if attempt >= settings.MCP_HTTP_RECONNECT_ATTEMPTS:
+            return False
+        delay = self._retry_delay if self._retry_delay is not None else backoff_delay(attempt)
+        app_logger.info(f"{delay:.1f} 秒后重连MCP事件流 {self.url}（第 {attempt + 1} 次）")
+        await asyncio.sleep(delay)
+        return True
+
+    def _request_headers(self, accept: str) -> Dict[str, str]:
+        return {**self.headers, "Accept": accept}
+
+
+class StreamableHTTPTransport(HTTPTransportBase):
+    """Streamable HTTP传输（MCP 2025-03-26）
+
+    - 每条消息POST到同一个端点，响应为JSON或SSE事件流
+    - 服务器在初始化响应中返回Mcp-Session-Id，之后的请求都携带该会话ID
+    - 初始化后通过GET打开服务器推送流，断开后按指数退避携带Last-Event-ID恢复
+    - 断开连接时DELETE结束会话
+    """
+
+    def __init__(self, url: str, timeout: float = 30.0, headers: Optional[Dict[str, str]] = None, **kwargs):
+        super().__init__(url, timeout, headers, **kwargs)
+        self.session_id: Optional[str] = None
+        self.protocol_version: Optional[str] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def connect(self) -> None:
+        """Streamable HTTP无需预先建立连接，初始化请求即第一条POST"""
+        app_logger.info(f"使用Streamable HTTP连接MCP端点: {self.url}")
+        self.connected = True
+
+    async def disconnect(self) -> None:
+        self._on_close = None
+        await self._cancel_tasks()
+        self._listener = None
+        if self.session_id:
+            try:
+                await self.client.delete(
+                    self.url, headers=self._session_headers({}), timeout=min(self.timeout, 5.0)
+                )
+            except Exception as e:
+                app_logger.debug(f"结束MCP会话失败: {e}")
+            self.session_id = None
+        self.connected = False
+        app_logger.info(f"MCP HTTP连接已断开: {self.url}")
+
+    def _session_headers(self, headers: Dict[str, str]) -> Dict[str, str]:
+        if self.session_id:
+            headers["Mcp-Session-Id"] = self.session_id
+        if self.protocol_version:
+            headers["MCP-Protocol-Version"] = self.protocol_version
+        return headers
+
+    async def send(self, message: Union[MCPRequest, MCPResponse, MCPNotification]) -> None:
+        """POST消息；响应为事件流时在后台读取，不阻塞发送方"""
+        is_initialize = isinstance(message, MCPRequest) and message.method == "initialize"
+        await self._post(message.model_dump(mode="json", exclude_none=True), is_initialize)
+
+    async def _post(self, body: Any, is_initialize: bool) -> None:
+        if not self.connected:
+            raise MCPConnectionError("未连接到MCP服务器")
+
+        headers = self._session_headers(self._request_headers("application/json, text/event-stream"))
+        request = self.client.build_request(
+            "POST", self.url,
+            json=body,
+            headers=headers,
+            timeout=self.timeout
+        )
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise MCPConnectionError(f"发送MCP消息失败: {e}")
+
+        try:
+            if response.status_code == 404 and self.session_id:
+                # 服务器已丢弃会话，需要重新初始化
+                await response.aclose()
+                self.session_id = None
+                self._closed("会话已失效")
+                raise MCPConnectionError("MCP会话已失效")
+            if response.status_code >= 400:
+                await response.aread()
+                raise MCPConnectionError(f"MCP服务器返回错误状态: {response.status_code} {response.text[:200]}")
+
+            session_id = response.headers.get("mcp-session-id")
+            if session_id:
+                self.session_id = session_id
+
+            content_type = response.headers.get("content-type", "")
+            if response.status_code == 202 or not (
+                content_type.startswith("application/json") or content_type.startswith("text/event-stream")
+            ):
+                await response.aclose()
+            elif content_type.startswith("application/json"):
+                await response.aread()
+                payload = response.json()
+                await response.aclose()
+                if is_initialize:
+                    self._remember_protocol_version(payload)
+                self._deliver_payload(payload)
             else:
-                raise MCPParseError("无法识别的消息格式")
+                self._spawn(self._read_post_stream(response, is_initialize))
+                response = None
+        except MCPConnectionError:
+            raise
         except Exception as e:
-            raise MCPParseError(f"解析消息失败: {e}")
+            raise MCPConnectionError(f"处理MCP响应失败: {e}")
+        finally:
+            if response is not None and not response.is_closed:
+                await response.aclose()
 
+        if is_initialize and self._listener is None:
+            # 会话建立后打开服务器推送流
+            self._listener = self._spawn(self._listen())
+
+    def _remember_protocol_version(self, payload: Any) -> None:
+        if isinstance(payload, dict):
+            version = (payload.get("result") or {}).get("protocolVersion")
+            if version:
+                self.protocol_version = version
+
+    async def _read_post_stream(self, response: httpx.Response, is_initialize: bool) -> None:
+        """读取POST返回的事件流；中途断开时通过GET携带该流的Last-Event-ID恢复"""
+        stream_last_id = None
+        try:
+            async for event in iter_sse_events(response.aiter_lines()):
+                if event.id:
+                    stream_last_id = event.id
+                if is_initialize and event.data:
+                    try:
+                        self._remember_protocol_version(json.loads(event.data))
+                    except json.JSONDecodeError:
+                        pass
+                self._deliver_event(event)
+        except httpx.HTTPError as e:
+            app_logger.warning(f"MCP响应流中断: {e}")
+            if stream_last_id and self.connected:
+                self._spawn(self._listen(resume_from=stream_last_id))
+        finally:
+            await response.aclose()
+
+    async def _listen(self, resume_from: Optional[str] = None) -> None:
+        """保持GET推送流，断开后按退避策略携带Last-Event-ID恢复
+
+        resume_from不为空时用于恢复中断的POST响应流，服务器会重放该流中未收到的事件。
+        """
+        attempt = 0
+        last_id = resume_from
+        while self.connected:
+            headers = self._session_headers(self._request_headers("text/event-stream"))
+            if last_id:
+                headers["Last-Event-ID"] = last_id
+            try:
+                async with self.client.stream("GET", self.url, headers=headers) as response:
+                    if response.status_code == 405:
+                        app_logger.debug(f"MCP服务器不支持推送流: {self.url}")
+                        return
+                    if response.status_code == 404 and self.session_id:
+                        self.session_id = None
+                        self._closed("会话已失效")
+                        return
+                    response.raise_for_status()
+                    attempt = 0
+                    async for event in iter_sse_events(response.aiter_lines()):
+                        if event.id:
+                            last_id = event.id
+                        self._deliver_event(event)
+                    if resume_from:
+                        # 恢复流正常结束，说明中断的响应已全部收到
+                        return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_logger.warning(f"MCP推送流断开 {self.url}: {e}")
+            if not self.connected:
+                return
+            if not await self._reconnect_wait(attempt):
+                self._closed("推送流重连失败")
+                return
+            attempt += 1
+
+
+class SSETransport(HTTPTransportBase):
+    """HTTP+SSE传输（MCP 2024-11-05）
+
+    - GET打开事件流，服务器先发送endpoint事件告知消息提交地址（通常带会话参数）
+    - 之后的响应和通知都以message事件从事件流返回，消息通过POST提交到该地址
+    - 事件流断开后按指数退避重连，并携带Last-Event-ID恢复
+    - 重连后服务器发送新的endpoint事件表示开启了新会话，新会话未经初始化不能使用，
+      此时关闭传输层，由连接池或健康检查重新连接并完成初始化握手
+    """
+
+    def __init__(self, url: str = None, timeout: float = 30.0, headers: Optional[Dict[str, str]] = None,
+                 endpoint: str = None, **kwargs):
+        super().__init__(url or endpoint, timeout, headers, **kwargs)
+        self.message_url: Optional[str] = None
+        self._endpoint_ready: Optional[asyncio.Future] = None
 
-class SSETransport(Transport):
-    """Server-Sent Events传输"""
-    
-    def __init__(self, endpoint: str, timeout: float = 30.0, headers: Optional[Dict[str, str]] = None):
-        super().__init__(timeout)
-        self.endpoint = endpoint
-        self.headers = headers or {}
-        self.client: Optional[httpx.AsyncClient] = None
-        self._event_stream: Optional[AsyncIterator] = None
-        
     async def connect(self) -> None:
-        """建立SSE连接"""
+        """打开事件流并等待服务器返回消息提交地址"""
+        app_logger.info(f"连接到MCP SSE端点: {self.url}")
+        self._endpoint_ready = asyncio.get_running_loop().create_future()
+        self.connected = True
+        self._spawn(self._listen())
         try:
-            app_logger.info(f"连接到MCP SSE端点: {self.endpoint}")
-            
-            self.client = httpx.AsyncClient(timeout=self.timeout)
-            
-            # 测试连接
-            response = await self.client.get(
-                self.endpoint + "/health",  # 假设有健康检查端点
-                headers=self.headers
-            )
-            response.raise_for_status()
-            
-            self.connected = True
-            app_logger.info("MCP SSE连接成功")
-            
+            await asyncio.wait_for(asyncio.shield(self._endpoint_ready), self.timeout)
         except Exception as e:
-            app_logger.error(f"连接MCP SSE失败: {e}")
-            if self.client:
-                await self.client.aclose()
+            await self.disconnect()
+            if isinstance(e, asyncio.TimeoutError):
+                raise MCPConnectionError(f"等待MCP SSE endpoint事件超时: {self.url}")
             raise MCPConnectionError(f"无法连接到MCP SSE: {e}")
-    
+        app_logger.info(f"MCP SSE连接成功，消息地址: {self.message_url}")
+
     async def disconnect(self) -> None:
-        """断开SSE连接"""
-        if self.client:
-            await self.client.aclose()
+        self._on_close = None
         self.connected = False
-        app_logger.info("MCP SSE连接已断开")
-    
+        await self._cancel_tasks()
+        self.message_url = None
+        app_logger.info(f"MCP SSE连接已断开: {self.url}")
+
     async def send(self, message: Union[MCPRequest, MCPResponse, MCPNotification]) -> None:
-        """通过HTTP POST发送消息"""
-        if not self.client or not self.connected:
+        """通过HTTP POST提交消息，响应从事件流返回"""
+        if not self.connected or not self.message_url:
             raise MCPConnectionError("未连接到MCP服务器")
-            
         try:
-            message_data = message.model_dump()
-            app_logger.debug(f"发送MCP SSE消息: {message_data}")
-            
             response = await self.client.post(
-                self.endpoint + "/message",
-                json=message_data,
-                headers=self.headers
+                self.message_url,
+                json=message.model_dump(mode="json", exclude_none=True),
+                headers=self._request_headers("application/json"),
+                timeout=self.timeout
             )
             response.raise_for_status()
-            
-        except Exception as e:
-            app_logger.error(f"发送MCP SSE消息失败: {e}")
+        except httpx.HTTPError as e:
             raise MCPConnectionError(f"发送SSE消息失败: {e}")
+
+    def _deliver_event(self, event: SSEEvent) -> None:
+        if event.event == "endpoint":
+            if self._endpoint_ready is not None and self._endpoint_ready.done():
+                # 重连后服务器开启了新会话，旧会话的初始化状态不再有效
+                self._closed(f"服务器开启了新会话: {event.data.strip()}")
+                return
+            self.message_url = urljoin(self.url, event.data.strip())
+            if self._endpoint_ready is not None:
+                self._endpoint_ready.set_result(self.message_url)
+            return
+        super()._deliver_event(event)
+
+    async def _listen(self) -> None:
+        attempt = 0
+        while self.connected:
+            headers = self._request_headers("text/event-stream")
+            if self.last_event_id:
+                headers["Last-Event-ID"] = self.last_event_id
+            try:
+                async with self.client.stream("GET", self.url, headers=headers) as response:
+                    response.raise_for_status()
+                    attempt = 0
+                    async for event in iter_sse_events(response.aiter_lines()):
+                        self._deliver_event(event)
+                        if not self.connected:
+                            return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_logger.warning(f"MCP SSE事件流断开 {self.url}: {e}")
+                if self._endpoint_ready is not None and not self._endpoint_ready.done():
+                    self._endpoint_ready.set_exception(e)
+                    return
+            if not self.connected:
+                return
+            if not await self._reconnect_wait(attempt):
+                self._closed("事件流重连失败")
+                return
+            attempt += 1
+
+
+class InProcessTransport(Transport):
+    """进程内传输：直接调用内置服务器（如笔记服务器）的 handle_request
     
-    async def receive(self) -> AsyncIterator[Union[MCPRequest, MCPResponse, MCPNotification]]:
-        """接收SSE消息"""
-        if not self.client or not self.connected:
+    不启动子进程，也没有JSON编解码。每个工具调用在独立任务中执行，
+    使用应用引擎创建的独立数据库会话，调用结束后提交并关闭。
+    """
+    
+    def __init__(self, server: str, timeout: float = 30.0, **kwargs):
+        super().__init__(timeout)
+        self.server_name = server
+        self._server_class = None
+        self._server = None
+        self._tasks: set = set()
+        self._message_queue: asyncio.Queue = asyncio.Queue()
+        self._on_message: Optional[MessageHandler] = None
+    
+    def set_handlers(self, on_message: MessageHandler, on_close: Callable[[], None]) -> bool:
+        self._on_message = on_message
+        return True
+    
+    async def connect(self) -> None:
+        from ..servers import IN_PROCESS_SERVERS
+        
+        server_class = IN_PROCESS_SERVERS.get(self.server_name)
+        if server_class is None:
+            raise MCPConnectionError(f"未知的内置MCP服务器: {self.server_name}")
+        self._server_class = server_class
+        # 不需要数据库的请求（初始化、工具列表、ping）共用一个实例
+        self._server = server_class()
+        self.connected = True
+        app_logger.info(f"使用进程内MCP服务器: {self.server_name}")
+    
+    async def disconnect(self) -> None:
+        self.connected = False
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._message_queue.put_nowait(None)
+    
+    async def send(self, message: Union[MCPRequest, MCPResponse, MCPNotification]) -> None:
+        if not self.connected:
             raise MCPConnectionError("未连接到MCP服务器")
-            
+        # 只有请求需要处理；客户端发出的通知（如initialized）和响应忽略
+        if not isinstance(message, MCPRequest):
+            return
+        # 在独立任务中处理，请求超时由客户端等待响应时控制
+        task = asyncio.create_task(self._handle(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def receive(self) -> AsyncIterator[Union[MCPRequest, MCPResponse, MCPNotification]]:
+        """接收消息（未注册消息回调时使用），连接关闭后结束"""
+        while True:
+            message = await self._message_queue.get()
+            if message is None:
+                break
+            yield message
+    
+    async def _handle(self, request: MCPRequest) -> None:
         try:
-            async with self.client.stream(
-                "GET",
-                self.endpoint + "/events",
-                headers={**self.headers, "Accept": "text/event-stream"}
-            ) as response:
-                response.raise_for_status()
+            if request.method == RequestMethod.CALL_TOOL:
+                from backend.db.session import get_async_session
                 
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        try:
-                            data_str = line[6:]  # 移除 "data: " 前缀
-                            if data_str.strip() == "[DONE]":
-                                break
-                                
-                            data = json.loads(data_str)
-                            message = self._parse_message(data)
-                            yield message
-                            
-                        except json.JSONDecodeError as e:
-                            app_logger.error(f"解析SSE数据失败: {e}")
-                            continue
-                        except Exception as e:
-                            app_logger.error(f"处理SSE消息失败: {e}")
-                            continue
-                            
+                async for db in get_async_session():
+                    response = await self._server_class(db_session=db).handle_request(request)
+            else:
+                response = await self._server.handle_request(request)
         except Exception as e:
-            app_logger.error(f"接收SSE消息失败: {e}")
-            raise MCPConnectionError(f"接收SSE消息失败: {e}")
-    
-    def _parse_message(self, data: Dict[str, Any]) -> Union[MCPRequest, MCPResponse, MCPNotification]:
-        """解析消息"""
+            # 与独立进程中的服务器一样返回错误响应，避免请求一直等到超时
+            app_logger.error(f"进程内MCP服务器处理请求失败 {self.server_name}: {e}", exc_info=True)
+            response = create_response(
+                request.id,
+                error=create_error(ErrorCode.INTERNAL_ERROR, f"服务器内部错误: {str(e)}")
+            )
+        
+        if self._on_message is None:
+            self._message_queue.put_nowait(response)
+            return
         try:
-            if "id" in data:
-                if "method" in data:
-                    return MCPRequest(**data)
-                else:
-                    return MCPResponse(**data)
-            elif "method" in data:
-                return MCPNotification(**data)
-            else:
-                raise MCPParseError("无法识别的消息格式")
+            self._on_message(response)
         except Exception as e:
-            raise MCPParseError(f"解析消息失败: {e}")
+            app_logger.error(f"处理MCP消息失败: {e}")
+
+
+def parse_message(data: Dict[str, Any]) -> Union[MCPRequest, MCPResponse, MCPNotification]:
+    """把JSON-RPC数据解析为MCP消息"""
+    try:
+        if "id" in data:
+            if "method" in data:
+                return MCPRequest(**data)
+            return MCPResponse(**data)
+        elif "method" in data:
+            return MCPNotification(**data)
+        raise MCPParseError("无法识别的消息格式")
+    except MCPParseError:
+        raise
+    except Exception as e:
+        raise MCPParseError(f"解析消息失败: {e}")
 
 
 def create_transport(transport_type: str, **config) -> Transport:
@@ -355,5 +967,9 @@ def create_transport(transport_type: str, **config) -> Transport:
         return StdioTransport(**config)
     elif transport_type == "sse":
         return SSETransport(**config)
+    elif transport_type == "streamable_http":
+        return StreamableHTTPTransport(**config)
+    elif transport_type == "inprocess":
+        return InProcessTransport(**config)
     else:
-        raise ValueError(f"不支持的传输类型: {transport_type}") 
\ No newline at end of file
+        raise ValueError(f"不支持的传输类型: {transport_type}")
@@ -0,0 +1,213 @@
+"""
+stdio MCP服务器预热池
+
+启动stdio服务器进程（如 npx / uvx 包）并完成初始化握手通常需要数秒，
+用户第一次对话时连接服务器会把这段时间计入首次工具调用的延迟。
+预热池为常用配置预先启动并初始化若干实例，连接服务器时直接取用，
+取走后在后台补充：
+- 系统级服务器（MCP_SERVERS）的配置始终预热
+- 其他配置按连接次数统计热度，达到 MCP_WARM_POOL_MIN_DEMAND 的最常用配置预热
+预热实例按完整的传输配置（命令、参数、环境变量）匹配，且只交给一个服务器使用，
+与新启动的进程等价。
+"""
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from .mcp_client import MCPClient
+from backend.core.config import settings
+from backend.utils.logging import app_logger
+
+
+# 连续启动失败多少次后暂停预热该配置，直到再次被使用
+MAX_SPAWN_FAILURES = 3
+# 统计热度的配置数上限，超出时丢弃最久未使用的配置
+MAX_TRACKED_TEMPLATES = 1000
+
+
+class WarmTemplate:
+    """一种需要预热的服务器配置"""
+    __slots__ = ("key", "transport_config", "name", "demand", "pinned", "spares", "failures", "last_demand")
+
+    def __init__(self, key: str, transport_config: Dict[str, Any], name: str, pinned: bool = False):
+        self.key = key
+        self.transport_config = transport_config
+        self.name = name
+        self.demand = 0
+        self.pinned = pinned
+        self.spares: List[MCPClient] = []
+        self.failures = 0
+        self.last_demand = time.monotonic()
+
+
+class MCPWarmPool:
+    """预先启动的stdio服务器实例池"""
+
+    def __init__(self, enabled: bool, size: int, max_templates: int, min_demand: int):
+        self.enabled = enabled
+        self.size = max(0, size)
+        self.max_templates = max_templates
+        self.min_demand = max(1, min_demand)
+
+        self._templates: Dict[str, WarmTemplate] = {}
+        self._filling: Dict[str, asyncio.Task] = {}
+        self._started = False
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.spawn_failures = 0
+
+    def register(self, key: str, transport_config: Dict[str, Any], name: str, pinned: bool = False) -> None:
+        """登记需要预热的配置（系统级服务器使用pinned=True）"""
+        if not self.enabled:
+            return
+        template = self._templates.get(key)
+        if template is None:
+            self._templates[key] = WarmTemplate(key, transport_config, name, pinned)
+        elif pinned:
+            template.pinned = True
+
+    def note_demand(self, key: str, transport_config: Dict[str, Any], name: str) -> None:
+        """记录一次按该配置连接服务器，用于统计热度"""
+        if not self.enabled:
+            return
+        self.register(key, transport_config, name)
+        template = self._templates[key]
+        template.demand += 1
+        template.failures = 0
+        template.last_demand = time.monotonic()
+        if len(self._templates) > MAX_TRACKED_TEMPLATES:
+            self._prune()
+
+    def _prune(self) -> None:
+        active = self._active_keys()
+        stale = sorted(
+            (t for t in self._templates.values() if t.key not in active),
+            key=lambda t: t.last_demand
+        )[:len(self._templates) - MAX_TRACKED_TEMPLATES]
+        for template in stale:
+            self._discard_spares(template)
+            self._filling.pop(template.key, None)
+            del self._templates[template.key]
+
+    def take(self, key: str) -> Optional[MCPClient]:
+        """取出一个已初始化的实例，没有可用实例时返回None；取出后在后台补充"""
+        if not self.enabled:
+            return None
+        template = self._templates.get(key)
+        client = None
+        while template is not None and template.spares:
+            candidate = template.spares.pop(0)
+            if candidate.is_connected:
+                client = candidate
+                break
+            # 预热的进程已退出
+            asyncio.create_task(candidate.disconnect())
+        if client is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._schedule_fill()
+        return client
+
+    def _active_keys(self) -> Set[str]:
+        """需要保持预热的配置：系统级配置，以及热度最高的若干配置"""
+        pinned = {key for key, t in self._templates.items() if t.pinned}
+        popular = sorted(
+            (t for t in self._templates.values() if not t.pinned and t.demand >= self.min_demand),
+            key=lambda t: (t.demand, t.last_demand),
+            reverse=True
+        )[:max(0, self.max_templates)]
+        return pinned | {t.key for t in popular}
+
+    def start(self) -> None:
+        """开始预热（需要在事件循环中调用）"""
+        if not self.enabled or self._started:
+            return
+        self._started = True
+        app_logger.info(f"MCP预热池已启动，每种配置预热 {self.size} 个实例")
+        self._schedule_fill()
+
+    def _schedule_fill(self) -> None:
+        if not self._started:
+            return
+        active = self._active_keys()
+        for key, template in self._templates.items():
+            if key not in active:
+                self._discard_spares(template)
+                continue
+            if len(template.spares) >= self.size or template.failures >= MAX_SPAWN_FAILURES:
+                continue
+            task = self._filling.get(key)
+            if task is None or task.done():
+                self._filling[key] = asyncio.create_task(self._fill(template), name=f"mcp-warm-{template.name}")
+
+    async def _fill(self, template: WarmTemplate) -> None:
+        """补充实例直到达到预热数量"""
+        while len(template.spares) < self.size and template.failures < MAX_SPAWN_FAILURES:
+            client = MCPClient(
+                name=template.name,
+                version="1.0.0",
+                timeout=settings.MCP_CONNECTION_TIMEOUT,
+                retry_attempts=settings.MCP_RETRY_ATTEMPTS,
+                retry_delay=settings.MCP_RETRY_DELAY
+            )
+            started = time.monotonic()
+            try:
+                await client.connect("stdio", **template.transport_config)
+            except Exception as e:
+                template.failures += 1
+                self.spawn_failures += 1
+                app_logger.warning(f"预热MCP服务器失败 {template.name}（第 {template.failures} 次）: {e}")
+                continue
+            if self._templates.get(template.key) is not template or template.key not in self._active_keys():
+                # 预热期间配置已不再需要
+                await client.disconnect()
+                return
+            template.failures = 0
+            template.spares.append(client)
+            self.spawned += 1
+            app_logger.debug(f"预热MCP服务器完成 {template.name}，耗时 {time.monotonic() - started:.2f}秒")
+
+    def _discard_spares(self, template: WarmTemplate) -> None:
+        for client in template.spares:
+            asyncio.create_task(client.disconnect())
+        template.spares = []
+
+    async def shutdown(self) -> None:
+        """停止预热并关闭所有预热实例"""
+        tasks = [task for task in self._filling.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        spares = [client for template in self._templates.values() for client in template.spares]
+        if spares:
+            await asyncio.gather(*(client.disconnect() for client in spares), return_exceptions=True)
+        self._filling.clear()
+        self._templates.clear()
+        self._started = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        active = self._active_keys()
+        return {
+            "enabled": self.enabled,
+            "templates": len(self._templates),
+            "warming": [
+                {
+                    "name": t.name,
+                    "demand": t.demand,
+                    "pinned": t.pinned,
+                    "ready": sum(1 for c in t.spares if c.is_connected),
+                    "failures": t.failures,
+                }
+                for t in self._templates.values() if t.key in active
+            ],
+            "hits": self.hits,
+            "misses": self.misses,
+            "spawned": self.spawned,
+            "spawn_failures": self.spawn_failures,
+        }
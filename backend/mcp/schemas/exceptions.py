@@ -96,6 +96,13 @@ class MCPToolError(MCPError):
         super().__init__(message, code=-32005, data=data)
 
 
+class MCPCircuitOpenError(MCPConnectionError):
+    """MCP服务器已熔断，调用直接失败"""
+    
+    def __init__(self, message: str = "MCP服务器暂不可用", data: Optional[Dict[str, Any]] = None):
+        super().__init__(message, data=data)
+
+
 def create_mcp_error_from_code(code: int, message: str, data: Optional[Dict[str, Any]] = None) -> MCPError:
     """根据错误码创建对应的异常"""
     error_classes = {
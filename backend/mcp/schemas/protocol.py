@@ -136,11 +136,21 @@ class ToolInputSchema(BaseModel):
     required: List[str] = Field(default_factory=list)
 
 
+class ToolAnnotations(BaseModel):
+    """工具行为提示（2025-03-26），由服务器声明，客户端只作为提示使用"""
+    title: Optional[str] = None
+    readOnlyHint: Optional[bool] = None
+    destructiveHint: Optional[bool] = None
+    idempotentHint: Optional[bool] = None
+    openWorldHint: Optional[bool] = None
+
+
 class Tool(BaseModel):
     """工具定义"""
     name: str
     description: Optional[str] = None
     inputSchema: ToolInputSchema
+    annotations: Optional[ToolAnnotations] = None
 
 
 class ToolCall(BaseModel):
@@ -2,6 +2,12 @@
 
 from .note_server import NoteMCPServer
 
+# 可以在API进程内直接调用的内置服务器（inprocess传输通过名称查找）
+IN_PROCESS_SERVERS = {
+    "note": NoteMCPServer,
+}
+
 __all__ = [
     "NoteMCPServer",
+    "IN_PROCESS_SERVERS",
 ] 
\ No newline at end of file
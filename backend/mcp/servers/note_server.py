@@ -15,7 +15,7 @@ import traceback
 
 from ..schemas.protocol import (
     MCPRequest, MCPResponse, MCPNotification,
-    Tool, ToolInputSchema, ToolResult,
+    Tool, ToolAnnotations, ToolInputSchema, ToolResult,
     ServerCapabilities, Implementation,
     InitializeResponse,
     create_response, create_error, create_notification,
@@ -83,6 +83,7 @@ class NoteMCPServer:
         tools = [
             Tool(
                 name="read_note",
+                annotations=ToolAnnotations(readOnlyHint=True),
                 description="读取笔记内容。支持通过笔记ID或标题搜索笔记，可指定阅读范围和是否包含元数据。在会话中会自动关联当前笔记。",
                 inputSchema=ToolInputSchema(
                     type="object",
@@ -195,6 +196,7 @@ class NoteMCPServer:
             ),
             Tool(
                 name="list_notes",
+                annotations=ToolAnnotations(readOnlyHint=True),
                 description="列出用户的笔记。支持搜索、分页和排序。",
                 inputSchema=ToolInputSchema(
                     type="object",
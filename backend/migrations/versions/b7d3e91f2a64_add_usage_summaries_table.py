@@ -0,0 +1,78 @@
+"""add_usage_summaries_table
+
+Revision ID: b7d3e91f2a64
+Revises: 80f2848f9809
+Create Date: 2026-10-19 10:12:03.214551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e91f2a64'
+down_revision = '80f2848f9809'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('usage_summaries',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('session_id', sa.Integer(), nullable=False),
+    sa.Column('agent_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('prompt_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('completion_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('total_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('cached_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('request_count', sa.Integer(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.Column('public_id', sa.String(length=50), nullable=False),
+    sa.Column('created_at', postgresql.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('updated_at', postgresql.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('is_deleted', sa.Boolean(), nullable=False),
+    sa.Column('deleted_at', postgresql.TIMESTAMP(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['session_id'], ['sessions.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('session_id', 'agent_id', 'day', name='uq_usage_summaries_session_agent_day')
+    )
+    op.create_index(op.f('ix_usage_summaries_agent_id'), 'usage_summaries', ['agent_id'], unique=False)
+    op.create_index(op.f('ix_usage_summaries_day'), 'usage_summaries', ['day'], unique=False)
+    op.create_index(op.f('ix_usage_summaries_id'), 'usage_summaries', ['id'], unique=False)
+    op.create_index(op.f('ix_usage_summaries_is_deleted'), 'usage_summaries', ['is_deleted'], unique=False)
+    op.create_index(op.f('ix_usage_summaries_public_id'), 'usage_summaries', ['public_id'], unique=True)
+    op.create_index(op.f('ix_usage_summaries_session_id'), 'usage_summaries', ['session_id'], unique=False)
+    op.create_index(op.f('ix_usage_summaries_user_id'), 'usage_summaries', ['user_id'], unique=False)
+
+    # 用已有的助手消息回填汇总数据（历史消息没有请求次数和缓存命中信息）
+    op.execute("""
+        INSERT INTO usage_summaries (
+            user_id, session_id, agent_id, day,
+            prompt_tokens, completion_tokens, total_tokens, cached_tokens,
+            request_count, message_count,
+            public_id, created_at, updated_at, is_deleted
+        )
+        SELECT
+            s.user_id, m.session_id, COALESCE(m.agent_id, 0), CAST(m.created_at AS DATE),
+            COALESCE(SUM(m.prompt_tokens), 0), COALESCE(SUM(m.tokens), 0), COALESCE(SUM(m.total_tokens), 0), 0,
+            COUNT(*), COUNT(*),
+            'usage-' || substr(md5(random()::text || m.session_id::text), 1, 12), now(), now(), false
+        FROM chat_messages m
+        JOIN sessions s ON s.id = m.session_id
+        WHERE m.role = 'assistant'
+        GROUP BY s.user_id, m.session_id, COALESCE(m.agent_id, 0), CAST(m.created_at AS DATE)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_usage_summaries_user_id'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_session_id'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_public_id'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_is_deleted'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_id'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_day'), table_name='usage_summaries')
+    op.drop_index(op.f('ix_usage_summaries_agent_id'), table_name='usage_summaries')
+    op.drop_table('usage_summaries')
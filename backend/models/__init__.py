@@ -6,5 +6,6 @@ from .note import Note
 from .note_session import NoteSession
 from .tool_call import ToolCallHistory
 from .mcp_server import MCPServer
+from .usage_summary import UsageSummary
 
-__all__ = ["BaseModel", "User", "Chat", "ChatMessage", "Agent", "Note", "NoteSession", "ToolCallHistory", "MCPServer"]
+__all__ = ["BaseModel", "User", "Chat", "ChatMessage", "Agent", "Note", "NoteSession", "ToolCallHistory", "MCPServer", "UsageSummary"]
@@ -33,7 +33,7 @@ class MCPServer(BaseModel):
     env = Column(JSON, comment="环境变量")
     cwd = Column(String(500), comment="工作目录")
     
-    # SSE配置 (当transport_type为sse时使用)
+    # HTTP配置 (当transport_type为sse或streamable_http时使用)
     url = Column(String(500), comment="SSE服务器URL")
     headers = Column(JSON, comment="HTTP请求头")
     
@@ -80,7 +80,7 @@ class MCPServer(BaseModel):
                 "env": self.env or {},
                 "cwd": self.cwd,
             })
-        elif self.transport_type == "sse":
+        elif self.transport_type in ("sse", "streamable_http"):
             config.update({
                 "url": self.url,
                 "headers": self.headers or {},
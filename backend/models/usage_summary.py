@@ -0,0 +1,42 @@
+from sqlalchemy import Column, Integer, BigInteger, Date, ForeignKey, UniqueConstraint, event
+from sqlalchemy.orm import relationship
+
+from backend.models.base import BaseModel
+from backend.utils.random_util import RandomUtil
+
+
+class UsageSummary(BaseModel):
+    """token用量汇总模型
+
+    每个会话、Agent、日期一行，消息完成时增量累加，
+    按用户、会话、Agent或日期统计用量时无需扫描消息表。
+    """
+    __tablename__ = "usage_summaries"
+    __table_args__ = (
+        UniqueConstraint("session_id", "agent_id", "day", name="uq_usage_summaries_session_agent_day"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False, index=True)
+    agent_id = Column(Integer, nullable=False, default=0, index=True)  # 0 表示未使用Agent
+    day = Column(Date, nullable=False, index=True)  # 统计日期
+
+    # 用量统计
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    total_tokens = Column(BigInteger, nullable=False, default=0)
+    cached_tokens = Column(BigInteger, nullable=False, default=0)  # 命中上游提示词缓存的token
+    request_count = Column(Integer, nullable=False, default=0)  # LLM请求次数（含工具调用后的后续请求）
+    message_count = Column(Integer, nullable=False, default=0)  # 助手消息数
+
+    # 关联关系
+    user = relationship("User")
+    session = relationship("Chat")
+
+
+# 为UsageSummary模型添加事件监听器，在创建前自动生成public_id
+@event.listens_for(UsageSummary, 'before_insert')
+def generate_usage_summary_public_id(mapper, connection, target):
+    if not target.public_id:
+        target.public_id = RandomUtil.generate_usage_summary_id()
@@ -10,6 +10,11 @@ from datetime import datetime
 from backend.utils.security import mask_env_variables, mask_headers
 
 
+# 支持的传输类型
+TRANSPORT_TYPES = ("stdio", "sse", "streamable_http")
+HTTP_TRANSPORT_TYPES = ("sse", "streamable_http")
+
+
 class MCPServerBase(BaseModel):
     """MCP服务器配置基础schema"""
     name: str = Field(..., description="服务器名称", max_length=100)
@@ -20,7 +25,7 @@ class MCPServerBase(BaseModel):
     share_link: Optional[str] = Field(None, description="分享链接", max_length=255)
     
     # 连接配置
-    transport_type: str = Field("stdio", description="传输类型: stdio, sse")
+    transport_type: str = Field("stdio", description="传输类型: stdio, sse, streamable_http")
     command: Optional[str] = Field(None, description="启动命令", max_length=500)
     args: Optional[List[str]] = Field(default_factory=list, description="命令参数数组")
     env: Optional[Dict[str, str]] = Field(default_factory=dict, description="环境变量")
@@ -46,8 +51,8 @@ class MCPServerBase(BaseModel):
     
     @validator('transport_type')
     def validate_transport_type(cls, v):
-        if v not in ['stdio', 'sse']:
-            raise ValueError('transport_type must be either "stdio" or "sse"')
+        if v not in TRANSPORT_TYPES:
+            raise ValueError('transport_type must be one of "stdio", "sse", "streamable_http"')
         return v
     
     @validator('command')
@@ -58,8 +63,8 @@ class MCPServerBase(BaseModel):
     
     @validator('url')
     def validate_url_for_sse(cls, v, values):
-        if values.get('transport_type') == 'sse' and not v:
-            raise ValueError('url is required for sse transport type')
+        if values.get('transport_type') in HTTP_TRANSPORT_TYPES and not v:
+            raise ValueError('url is required for sse and streamable_http transport types')
         return v
 
 
@@ -78,7 +83,7 @@ class MCPServerUpdate(BaseModel):
     share_link: Optional[str] = Field(None, description="分享链接", max_length=255)
     
     # 连接配置
-    transport_type: Optional[str] = Field(None, description="传输类型: stdio, sse")
+    transport_type: Optional[str] = Field(None, description="传输类型: stdio, sse, streamable_http")
     command: Optional[str] = Field(None, description="启动命令", max_length=500)
     args: Optional[List[str]] = Field(None, description="命令参数数组")
     env: Optional[Dict[str, str]] = Field(None, description="环境变量")
@@ -104,8 +109,8 @@ class MCPServerUpdate(BaseModel):
     
     @validator('transport_type')
     def validate_transport_type(cls, v):
-        if v is not None and v not in ['stdio', 'sse']:
-            raise ValueError('transport_type must be either "stdio" or "sse"')
+        if v is not None and v not in TRANSPORT_TYPES:
+            raise ValueError('transport_type must be one of "stdio", "sse", "streamable_http"')
         return v
 
 
@@ -304,14 +309,14 @@ class MCPServerConfigImport(BaseModel):
                 raise ValueError(f'服务器 {name} 的配置必须是字典格式')
             
             transport_type = config.get('type', 'stdio')
-            if transport_type not in ['stdio', 'sse']:
-                raise ValueError(f'服务器 {name} 的传输类型必须是 stdio 或 sse')
+            if transport_type not in TRANSPORT_TYPES:
+                raise ValueError(f'服务器 {name} 的传输类型必须是 stdio、sse 或 streamable_http')
             
             if transport_type == 'stdio' and not config.get('command'):
                 raise ValueError(f'stdio服务器 {name} 必须提供 command')
             
-            if transport_type == 'sse' and not config.get('url'):
-                raise ValueError(f'sse服务器 {name} 必须提供 url')
+            if transport_type in HTTP_TRANSPORT_TYPES and not config.get('url'):
+                raise ValueError(f'{transport_type}服务器 {name} 必须提供 url')
         
         return v
 
@@ -138,7 +138,7 @@ class AgentService:
             try:
                 if mcp_service.is_enabled():
                     await mcp_service.ensure_user_servers_loaded(user_id)
-                    raw_mcp_tools = await mcp_service.get_available_tools_for_chat()
+                    raw_mcp_tools = await mcp_service.get_available_tools_for_chat(user_id)
                     logger.info(f"获取到 {len(raw_mcp_tools)} 个MCP工具")
                     
                     # 去重MCP工具（按名称去重）
@@ -248,7 +248,7 @@ class AgentService:
             
             # 获取MCP工具
             try:
-                mcp_tools = await mcp_service.get_available_tools_for_chat()
+                mcp_tools = await mcp_service.get_available_tools_for_chat(user_id)
                 for tool in mcp_tools:
                     tool_info = tool.copy()
                     tool_info["is_mcp"] = True
@@ -308,7 +308,7 @@ class AgentService:
                     }
             
             # 尝试执行MCP工具
-            mcp_result = await mcp_service.execute_mcp_tool_for_chat(tool_name, arguments)
+            mcp_result = await mcp_service.execute_mcp_tool_for_chat(tool_name, arguments, user_id=user_id)
             if mcp_result["success"]:
                 mcp_result["source"] = "mcp"
                 return mcp_result
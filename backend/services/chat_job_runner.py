@@ -0,0 +1,174 @@
+"""
+聊天生成任务运行器
+
+可选模式：流式聊天的生成过程作为任务提交到进程内的异步工作池，
+由固定数量的工作协程执行，SSE接口通过回放缓冲区订阅任务产生的事件。
+- 准入控制：等待队列已满（全局或单用户）时直接拒绝，返回429
+- 单用户并发限制：同一用户同时执行的任务数有上限，超出的任务排队等待
+- 排队中被取消的任务立即移出队列，不再占用准入名额
+"""
+
+import asyncio
+import contextvars
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional
+
+from backend.core.config import settings
+from backend.core.exceptions import BusinessException
+from backend.core.response import ResponseCode
+from backend.utils.logging import app_logger
+
+
+class ChatJobRejected(BusinessException):
+    """生成任务被准入控制拒绝"""
+
+    def __init__(self, msg: str = "当前请求过多，请稍后再试"):
+        super().__init__(msg=msg, code=ResponseCode.TOO_MANY_REQUESTS.value, status_code=429)
+
+
+class ChatJob:
+    """排队中的生成任务"""
+    __slots__ = ("user_id", "handle", "factory", "enqueued_at")
+
+    def __init__(self, user_id: Optional[int], handle, factory: Callable[[], Coroutine[Any, Any, Any]]):
+        self.user_id = user_id
+        self.handle = handle
+        self.factory = factory
+        self.enqueued_at = time.monotonic()
+
+
+class ChatJobRunner:
+    """进程内的生成任务工作池"""
+
+    def __init__(self, workers: int, queue_max: int, per_user_limit: int, per_user_pending_max: int):
+        self.worker_count = workers
+        self.queue_max = queue_max
+        self.per_user_limit = per_user_limit
+        self.per_user_pending_max = per_user_pending_max
+
+        self._pending: Deque[ChatJob] = deque()
+        self._running: Dict[Optional[int], int] = {}
+        self._condition: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Task] = []
+
+        # 统计信息
+        self.completed = 0
+        self.rejected = 0
+
+    def _ensure_started(self) -> None:
+        """首次提交任务时在当前事件循环中启动工作协程
+
+        工作协程在空白上下文中创建，不继承首个请求的上下文变量。
+        """
+        if self._workers:
+            return
+        self._condition = asyncio.Condition()
+        self._workers = [
+            contextvars.Context().run(asyncio.create_task, self._worker(i), name=f"chat-job-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        app_logger.info(f"聊天生成工作池已启动，工作协程数: {self.worker_count}")
+
+    def _pending_for_user(self, user_id: Optional[int]) -> int:
+        return sum(1 for job in self._pending if job.user_id == user_id)
+
+    def check_admission(self, user_id: Optional[int]) -> None:
+        """检查是否可以接收新任务，不能接收时抛出 ChatJobRejected"""
+        if len(self._pending) >= self.queue_max:
+            self.rejected += 1
+            raise ChatJobRejected("服务繁忙，生成队列已满，请稍后再试")
+        if self._pending_for_user(user_id) >= self.per_user_pending_max:
+            self.rejected += 1
+            raise ChatJobRejected("您的排队请求过多，请等待当前回答完成")
+
+    def submit(self, user_id: Optional[int], handle, factory: Callable[[], Coroutine[Any, Any, Any]]) -> int:
+        """提交生成任务，返回排在它前面的任务数"""
+        self.check_admission(user_id)
+        self._ensure_started()
+        ahead = len(self._pending)
+        if self._running.get(user_id, 0) >= self.per_user_limit:
+            ahead = max(ahead, 1)
+        job = ChatJob(user_id, handle, factory)
+        handle.on_queued_cancel = lambda: self._discard(job)
+        self._pending.append(job)
+        asyncio.create_task(self._notify())
+        return ahead
+
+    def _discard(self, job: ChatJob) -> None:
+        """排队中被取消的任务移出队列，并立即启动以执行结束流程（发送完成事件、释放回放缓冲区）"""
+        try:
+            self._pending.remove(job)
+        except ValueError:
+            return
+        job.handle.on_queued_cancel = None
+        app_logger.info(f"排队中的生成任务已取消: user_id={job.user_id}")
+        job.handle.start(job.factory())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _take_eligible(self) -> Optional[ChatJob]:
+        """取出最早的、所属用户未达到并发上限的任务"""
+        for job in self._pending:
+            if self._running.get(job.user_id, 0) < self.per_user_limit:
+                self._pending.remove(job)
+                job.handle.on_queued_cancel = None
+                return job
+        return None
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            async with self._condition:
+                job = self._take_eligible()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._take_eligible()
+                self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+
+            waited = time.monotonic() - job.enqueued_at
+            if waited > 1:
+                app_logger.info(f"生成任务排队 {waited:.1f}s 后开始执行: user_id={job.user_id}")
+            try:
+                task = job.handle.start(job.factory())
+                # 任务被停止接口取消时不影响工作协程
+                await asyncio.wait({task})
+            except Exception as e:
+                app_logger.error(f"生成任务执行异常: {e}", exc_info=True)
+            finally:
+                self.completed += 1
+                async with self._condition:
+                    remaining = self._running.get(job.user_id, 1) - 1
+                    if remaining > 0:
+                        self._running[job.user_id] = remaining
+                    else:
+                        self._running.pop(job.user_id, None)
+                    self._condition.notify_all()
+
+    async def shutdown(self) -> None:
+        """停止工作协程，排队中的任务随之丢弃"""
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._pending.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "workers": len(self._workers),
+            "pending": len(self._pending),
+            "running": sum(self._running.values()),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+# 创建全局任务运行器实例
+chat_job_runner = ChatJobRunner(
+    workers=settings.CHAT_JOB_WORKERS,
+    queue_max=settings.CHAT_JOB_QUEUE_MAX,
+    per_user_limit=settings.CHAT_JOB_PER_USER_LIMIT,
+    per_user_pending_max=settings.CHAT_JOB_PER_USER_PENDING_MAX
+)
@@ -12,9 +12,13 @@ from backend.crud.chat import create_chat, get_chat, add_message, update_chat_ag
 from backend.crud.agent import agent as agent_crud
 from backend.services.memory import memory_service
 from backend.services.openai_client import openai_client_service
+from backend.services.context_builder import context_builder
+from backend.services.conversation_summarizer import conversation_summarizer
+from backend.services.prompt_layout import prompt_layout
+from backend.services.usage_service import usage_service
+from backend.services.title_queue import title_queue
 from backend.services.chat_tool_handler import chat_tool_handler
-from backend.services.chat_tool_processor import chat_tool_processor
-from backend.services.chat_session_manager import chat_session_manager
+from backend.services.chat_tool_loop import ToolLoopEngine, tool_calls_to_dicts
 from backend.crud.note_session import note_session
 
 
@@ -57,99 +61,16 @@ class ChatResponseService:
         if tool_calls:
             api_logger.info(f"检测到工具调用请求: {len(tool_calls)} 个工具调用")
             
-            # 处理工具调用
-            # 获取agent的数据库ID，避免在handle_tool_calls中懒加载
-            # 修复：避免在异步上下文中访问SQLAlchemy关系属性
-            agent_db_id = getattr(agent, 'id', None) if agent else None
-            
-            tool_results, tool_calls_data = await chat_tool_handler.handle_tool_calls(
-                tool_calls, 
-                agent, 
-                db, 
-                session_id,
-                message_id=message_id,
-                user_id=user_id,
-                agent_id=agent_db_id  # 传递agent_id，避免懒加载
+            # 整批执行工具后再请求一次AI响应，直到没有新的工具调用
+            engine = ToolLoopEngine(
+                messages, agent, use_model, max_tokens, temperature, top_p, tools, has_tools,
+                session_id, db=db, message_id=message_id, user_id=user_id,
+                interaction_flow=interaction_flow, stream=False, follow_up_per_tool=False
             )
+            async for _ in engine.run(content, tool_calls_to_dicts(tool_calls)):
+                pass
             
-            # 记录工具调用到交互流程
-            for i, tool_call in enumerate(tool_calls):
-                tool_call_record = {
-                    "type": "tool_call",
-                    "id": tool_call.id,
-                    "name": tool_call.function.name,
-                    "arguments": json.loads(tool_call.function.arguments),
-                    "status": "completed",
-                    "started_at": datetime.now().isoformat(),
-                    "completed_at": datetime.now().isoformat()
-                }
-                
-                # 添加结果
-                if i < len(tool_results):
-                    try:
-                        tool_call_record["result"] = json.loads(tool_results[i]["content"])
-                    except (json.JSONDecodeError, KeyError):
-                        tool_call_record["result"] = tool_results[i]["content"]
-                
-                interaction_flow.append(tool_call_record)
-            
-            # 将工具调用和结果添加到消息列表
-            messages.append({
-                "role": "assistant",
-                "content": content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    } for tc in tool_calls
-                ]
-            })
-            
-            # 添加工具结果
-            for tool_result in tool_results:
-                messages.append(tool_result)
-            
-            # 递归处理工具调用
-            final_content = await chat_tool_processor.process_tool_calls_recursively(
-                content, 
-                [
-                    {
-                        'id': tc.id,
-                        'type': tc.type,
-                        'function': {
-                            'name': tc.function.name,
-                            'arguments': tc.function.arguments
-                        }
-                    } for tc in tool_calls
-                ], 
-                messages, 
-                agent, 
-                use_model, 
-                max_tokens, 
-                temperature, 
-                top_p, 
-                tools, 
-                has_tools, 
-                session_id,
-                db,
-                message_id=message_id,
-                user_id=user_id
-            )
-            
-            # 如果有额外的内容，记录到交互流程
-            additional_content = final_content[len(content):] if len(final_content) > len(content) else ""
-            if additional_content.strip():
-                interaction_flow.append({
-                    "type": "text",
-                    "content": additional_content,
-                    "timestamp": datetime.now().isoformat()
-                })
-            
-            return final_content
+            return engine.final_content
         
         return content
     
@@ -163,6 +84,8 @@ class ChatResponseService:
         """
         调用OpenAI API生成对话响应，并保存对话记录
         """
+        # 统计本次生成的真实用量（包括工具调用后的后续请求）
+        usage_meter = usage_service.start_meter()
         try:
             api_logger.info(f"开始调用OpenAI API, 模型: {openai_client_service.model}, API地址: {openai_client_service.async_client.base_url}")
             
@@ -482,6 +405,18 @@ class ChatResponseService:
             has_tools = len(tools) > 0
             api_logger.info(f"当前聊天启用工具: {has_tools}, 工具数量: {len(tools)}")
             
+            # 插入较早对话的摘要并整理为稳定的前缀布局（利于上游提示词缓存），
+            # 再按模型上下文窗口裁剪历史消息，并统计提示词token
+            messages = conversation_summarizer.inject(session_id, messages)
+            messages, tools = prompt_layout.apply(messages, tools)
+            api_logger.debug(f"提示词前缀指纹: {prompt_layout.prefix_hash(messages, tools)}")
+            context = context_builder.build(messages, use_model, max_tokens, tools if has_tools else None)
+            messages = context.messages
+            max_tokens = context.max_tokens
+            token_counter = context_builder.counter(use_model)
+            # 后台把超出预算的历史折叠进会话摘要
+            conversation_summarizer.schedule(session_id, use_model, context)
+            
             # 调用API - 尝试直接使用异步客户端
             try:
                 api_logger.info(f"使用异步客户端调用API - URL: {openai_client_service.async_client.base_url}")
@@ -504,7 +439,7 @@ class ChatResponseService:
                 api_logger.info(f"[大模型请求] API调用参数详情: model={use_model}, max_tokens={max_tokens}, temperature={temperature}, 消息数量={len(messages)}, 启用工具={has_tools}")
                 
                 # 调用API
-                response = await openai_client_service.async_client.chat.completions.create(**api_params)
+                response = await openai_client_service.create_chat_completion(**api_params)
                 
                 api_logger.info(f"[大模型响应] API响应类型: {type(response)}")
                 
@@ -554,9 +489,9 @@ class ChatResponseService:
                         user_id
                     )
                     
-                    # 估算token使用量（因为递归调用可能无法准确获取）
-                    estimated_tokens = len(final_assistant_content) // 4
-                    estimated_prompt_tokens = len(str(messages)) // 4
+                    # 统计token使用量（递归调用无法汇总接口返回的用量）
+                    estimated_tokens = token_counter.count_text(final_assistant_content)
+                    estimated_prompt_tokens = context.prompt_tokens
                     estimated_total_tokens = estimated_tokens + estimated_prompt_tokens
                     
                     # 构建最终的JSON结构
@@ -579,13 +514,22 @@ class ChatResponseService:
                     
                     api_logger.info(f"递归工具调用完成，最终响应长度: {len(final_assistant_content)}")
                     
-                    # 使用最终内容和估算的token数量
+                    # 用接口返回的用量（汇总所有后续请求）替换本地统计值
+                    await usage_service.settle_message(db, ai_message, usage_meter, user_id)
+                    
                     assistant_content = final_assistant_content
-                    token_usage_dict = {
-                        "prompt_tokens": estimated_prompt_tokens,
-                        "completion_tokens": estimated_tokens,
-                        "total_tokens": estimated_total_tokens
-                    }
+                    if usage_meter.has_data:
+                        token_usage_dict = {
+                            "prompt_tokens": usage_meter.prompt_tokens,
+                            "completion_tokens": usage_meter.completion_tokens,
+                            "total_tokens": usage_meter.total_tokens
+                        }
+                    else:
+                        token_usage_dict = {
+                            "prompt_tokens": estimated_prompt_tokens,
+                            "completion_tokens": estimated_tokens,
+                            "total_tokens": estimated_total_tokens
+                        }
                 else:
                     # 常规响应处理（没有工具调用）
                     token_usage = response.usage
@@ -610,7 +554,7 @@ class ChatResponseService:
                     
                     # 如果提供了数据库会话，保存AI回复（使用JSON结构）
                     if db and user_id and session_id:
-                        await add_message(
+                        ai_message = await add_message(
                             db=db,
                             session_id=session_id,
                             role="assistant",
@@ -620,6 +564,7 @@ class ChatResponseService:
                             total_tokens=token_usage.total_tokens,
                             agent_id=agent_id
                         )
+                        await usage_service.settle_message(db, ai_message, usage_meter, user_id)
                     
                     api_logger.info(f"OpenAI API调用成功, 生成文本长度: {len(assistant_content)}")
                     
@@ -632,7 +577,7 @@ class ChatResponseService:
                 
                 # 检查是否需要自动生成标题
                 if db and session_id and user_content:
-                    await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                    title_queue.enqueue(session_id, user_content)  # 标题在后台队列中生成
                 
                 return ChatCompletionResponse(
                     message=Message(
@@ -648,7 +593,7 @@ class ChatResponseService:
                 if "无可用渠道" in str(api_error) and current_agent and use_model != openai_client_service.model:
                     api_logger.info(f"尝试使用默认模型 {openai_client_service.model} 重新请求")
                     try:
-                        response = await openai_client_service.async_client.chat.completions.create(
+                        response = await openai_client_service.create_chat_completion(
                             model=openai_client_service.model,
                             messages=messages,
                             max_tokens=max_tokens,
@@ -669,7 +614,7 @@ class ChatResponseService:
                         
                         # 如果提供了数据库会话，保存AI回复
                         if db and user_id and session_id:
-                            await add_message(
+                            ai_message = await add_message(
                                 db=db,
                                 session_id=session_id,
                                 role="assistant",
@@ -679,10 +624,11 @@ class ChatResponseService:
                                 total_tokens=token_usage.total_tokens,
                                 agent_id=agent_id
                             )
+                            await usage_service.settle_message(db, ai_message, usage_meter, user_id)
                         
                         # 检查是否需要自动生成标题
                         if db and session_id and user_content:
-                            await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                            title_queue.enqueue(session_id, user_content)  # 标题在后台队列中生成
                         
                         return ChatCompletionResponse(
                             message=Message(
@@ -711,7 +657,7 @@ class ChatResponseService:
                 
                 # 检查是否需要自动生成标题
                 if db and session_id and user_content:
-                    await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                    title_queue.enqueue(session_id, user_content)  # 标题在后台队列中生成
                 
                 return ChatCompletionResponse(
                     message=Message(
@@ -744,7 +690,7 @@ class ChatResponseService:
             
             # 检查是否需要自动生成标题
             if db and session_id and user_content:
-                await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                title_queue.enqueue(session_id, user_content)  # 标题在后台队列中生成
             
             return ChatCompletionResponse(
                 message=Message(
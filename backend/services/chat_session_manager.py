@@ -3,9 +3,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, status
 
 from backend.utils.logging import api_logger
-from backend.crud.chat import get_chat, get_chat_messages, update_chat_title
+from backend.crud.chat import get_chat, get_chat_messages
 from backend.services.memory import memory_service
-from backend.services.title_generator import generate_title_with_ai
+from backend.services.title_queue import title_queue
 from backend.utils.id_converter import IDConverter
 
 
@@ -15,42 +15,17 @@ class ChatSessionManager:
     @staticmethod
     async def auto_generate_title_if_needed(db: AsyncSession, session_id: str, user_content: str):
         """
-        如果会话标题为默认标题，自动生成新标题
+        如果会话标题为默认标题，在后台队列中生成新标题
         
         Args:
-            db: 数据库会话
+            db: 数据库会话（保留参数以兼容旧调用，生成任务使用独立会话）
             session_id: 会话public_id
             user_content: 用户消息内容
-        """
-        try:
-            # 获取会话信息
-            chat = await get_chat(db, session_id)
-            if not chat:
-                api_logger.warning(f"会话不存在: {session_id}")
-                return
             
-            # 如果标题是默认标题，则自动生成新标题
-            if chat.title in ["新对话", "新会话", "新聊天", None, ""]:
-                api_logger.info(f"检测到默认标题，开始生成新标题: session_id={session_id}")
-                
-                try:
-                    # 使用AI生成标题
-                    new_title = await generate_title_with_ai(session_id, user_content, db)
-                    
-                    # 更新会话标题
-                    updated_chat = await update_chat_title(db, session_id, new_title)
-                    if updated_chat:
-                        api_logger.info(f"自动生成标题成功: session_id={session_id}, new_title={new_title}")
-                    else:
-                        api_logger.warning(f"更新标题失败: session_id={session_id}")
-                        
-                except Exception as e:
-                    api_logger.error(f"自动生成标题失败: session_id={session_id}, error={str(e)}")
-            else:
-                api_logger.debug(f"会话已有自定义标题，跳过自动生成: session_id={session_id}, title={chat.title}")
-                
-        except Exception as e:
-            api_logger.error(f"自动生成标题过程失败: session_id={session_id}, error={str(e)}")
+        Returns:
+            标题生成结果的Future，无需生成时为None
+        """
+        return title_queue.enqueue(session_id, user_content)
     
     @staticmethod
     async def clear_memory(session_id: str):
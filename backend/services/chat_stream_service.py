@@ -5,7 +5,6 @@ import json
 from datetime import datetime
 import aiohttp
 import base64
-import asyncio
 
 from backend.schemas.chat import ChatRequest
 from backend.utils.logging import api_logger
@@ -13,9 +12,15 @@ from backend.crud.chat import create_chat, get_chat, add_message, update_chat_ag
 from backend.crud.agent import agent as agent_crud
 from backend.services.memory import memory_service
 from backend.services.openai_client import openai_client_service
+from backend.services.context_builder import context_builder
+from backend.services.conversation_summarizer import conversation_summarizer
+from backend.services.prompt_layout import prompt_layout
+from backend.services.usage_service import usage_service
+from backend.services.title_queue import title_queue
 from backend.services.chat_tool_handler import chat_tool_handler
-from backend.services.chat_tool_processor import chat_tool_processor
-from backend.services.chat_session_manager import chat_session_manager
+from backend.services.chat_tool_loop import ToolLoopEngine, StreamTupleSink
+from backend.services.tool_call_accumulator import ToolCallAccumulator
+from backend.services.stream_cancellation import stream_cancellation_registry
 from backend.crud.note_session import note_session
 
 
@@ -44,386 +49,15 @@ class ChatStreamService:
         """
         递归处理工具调用，支持无限次调用（流式版本），并记录到交互流程中
         """
-        if interaction_flow is None:
-            interaction_flow = []
-            
-        iteration = 0
-        current_content = content
-        current_tool_calls = tool_calls
-        
-        # 记录工具调用历史，防止重复调用
-        tool_call_history = []
-        consecutive_failures = 0  # 连续失败计数
-        max_consecutive_failures = 3  # 最大连续失败次数
-        
-        # 进行递归处理
-        while current_tool_calls and iteration < max_iterations:
-            iteration += 1
-            api_logger.info(f"开始第 {iteration} 轮工具调用处理，共 {len(current_tool_calls)} 个工具调用")
-            
-            # 检测是否有重复的工具调用
-            current_tool_signature = []
-            for tc in current_tool_calls:
-                if tc is not None and tc.get('function'):
-                    signature = f"{tc['function']['name']}:{tc['function']['arguments']}"
-                    current_tool_signature.append(signature)
-            
-            # 检查是否与最近的工具调用重复
-            if tool_call_history and current_tool_signature == tool_call_history[-1]:
-                api_logger.warning(f"检测到重复的工具调用，停止处理：{current_tool_signature}")
-                break
-            
-            # 检查是否连续多次调用同一组工具
-            if len(tool_call_history) >= 3:
-                last_three = tool_call_history[-3:]
-                if all(sig == current_tool_signature for sig in last_three):
-                    api_logger.warning(f"检测到连续多次重复工具调用，停止处理：{current_tool_signature}")
-                    break
-            
-            # 记录当前工具调用
-            tool_call_history.append(current_tool_signature)
-            
-            # 验证工具调用参数的完整性
-            valid_tool_calls = []
-            for tc in current_tool_calls:
-                # 跳过None值（可能由索引填充产生）
-                if tc is None:
-                    continue
-                    
-                # 检查函数名是否有效
-                if not tc['function']['name']:
-                    api_logger.warning(f"工具调用 {tc['id']} 函数名为空，跳过")
-                    continue
-                
-                # 检查参数是否有效
-                arguments_str = tc['function']['arguments'].strip()
-                
-                # 对于某些工具（如note_reader），空参数是合法的
-                if arguments_str or tc['function']['name'] in ['note_reader']:
-                    try:
-                        # 验证JSON格式，空字符串默认为空对象
-                        if not arguments_str:
-                            arguments_str = '{}'
-                            tc['function']['arguments'] = arguments_str
-                        
-                        json.loads(arguments_str)
-                        valid_tool_calls.append(tc)
-                        
-                        if arguments_str == '{}':
-                            api_logger.info(f"工具调用 {tc['function']['name']} 使用默认参数（空参数）")
-                        else:
-                            api_logger.info(f"工具调用 {tc['function']['name']} 参数完整: {arguments_str}")
-                    except json.JSONDecodeError as e:
-                        api_logger.error(f"工具调用 {tc['function']['name']} 参数JSON格式错误: {arguments_str}, 错误: {e}")
-                else:
-                    api_logger.warning(f"工具调用 {tc['function']['name']} 参数为空，跳过")
-            
-            if not valid_tool_calls:
-                api_logger.warning("没有有效的工具调用，结束工具处理")
-                break
-            
-            # 构造工具调用对象
-            class ToolCall:
-                def __init__(self, id, type, function):
-                    self.id = id
-                    self.type = type
-                    self.function = function
-            
-            class Function:
-                def __init__(self, name, arguments):
-                    self.name = name
-                    self.arguments = arguments
-            
-            # 处理当前的工具调用 - 逐个执行，每执行完一个就继续AI响应
-            tool_results = []
-            tool_index = 0
-            while tool_index < len(valid_tool_calls):
-                tc = valid_tool_calls[tool_index]
-                # 构造工具调用对象
-                func = Function(tc['function']['name'], tc['function']['arguments'])
-                tool_call_obj = ToolCall(tc['id'], tc['type'], func)
-                
-                # 记录工具调用开始到交互流程
-                tool_call_start_time = datetime.now()
-                tool_call_record = {
-                    "type": "tool_call",
-                    "id": tool_call_obj.id,
-                    "name": tool_call_obj.function.name,
-                    "arguments": json.loads(tool_call_obj.function.arguments),
-                    "status": "preparing",  # 修改为preparing状态
-                    "started_at": tool_call_start_time.isoformat()
-                }
-                interaction_flow.append(tool_call_record)
-                
-                # 发送工具调用开始状态
-                tool_status = {
-                    "type": "tool_call_start",
-                    "tool_call_id": tool_call_obj.id,
-                    "tool_name": tool_call_obj.function.name,
-                    "status": "preparing"
-                }
-                # 添加日志确认状态事件发送
-                api_logger.info(f"🚀 发送工具调用开始状态: {tool_call_obj.function.name} (ID: {tool_call_obj.id})")
-                # 统一使用四元组格式：(content, session_id, reasoning_content, tool_status)
-                yield ("", session_id, "", tool_status)
-                
-                # 立即发送一个空的内容响应，强制刷新异步生成器
-                yield ("", session_id, "", None)
-                
-                # 发送工具调用执行状态
-                tool_status = {
-                    "type": "tool_call_executing",
-                    "tool_call_id": tool_call_obj.id,
-                    "tool_name": tool_call_obj.function.name,
-                    "status": "executing"
-                }
-                # 添加日志确认状态事件发送
-                api_logger.info(f"⚙️ 发送工具调用执行状态: {tool_call_obj.function.name} (ID: {tool_call_obj.id})")
-                # 统一使用四元组格式：(content, session_id, reasoning_content, tool_status)
-                yield ("", session_id, "", tool_status)
-                
-                # 立即发送一个空的内容响应，强制刷新异步生成器
-                yield ("", session_id, "", None)
-                
-                # 执行单个工具调用（传递message_id关联到特定消息）
-                try:
-                    # 获取agent的数据库ID，避免在handle_tool_calls中懒加载
-                    # 修复：避免在异步上下文中访问SQLAlchemy关系属性
-                    agent_db_id = getattr(agent, 'id', None) if agent else None
-                    
-                    # 更新交互流程中的工具调用记录为执行中
-                    tool_call_record["status"] = "executing"
-                    
-                    # 创建异步任务来执行工具调用
-                    async def execute_tool():
-                        return await chat_tool_handler.handle_tool_calls(
-                            [tool_call_obj], 
-                            agent, 
-                            db,  # 传递数据库连接，保存工具调用记录
-                            session_id,
-                            message_id=message_id,  # 关联到特定消息
-                            user_id=user_id,  # 传递用户ID
-                            agent_id=agent_db_id  # 传递agent_id，避免懒加载
-                        )
-                    
-                    # 状态更新任务
-                    async def send_progress_updates():
-                        execution_time = 0
-                        while True:
-                            await asyncio.sleep(1)  # 每秒发送一次执行状态
-                            execution_time += 1
-                            
-                            # 发送持续的执行状态更新
-                            progress_status = {
-                                "type": "tool_call_executing",
-                                "tool_call_id": tool_call_obj.id,
-                                "tool_name": tool_call_obj.function.name,
-                                "status": "executing",
-                                "execution_time": execution_time,
-                                "message": f"工具正在执行中... ({execution_time}s)"
-                            }
-                            yield ("", session_id, "", progress_status)
-                            
-                            # 为执行时间较长的工具添加更详细的进度信息
-                            if tool_call_obj.function.name == "note_editor" and execution_time > 2:
-                                progress_status["message"] = f"正在编辑笔记内容，请稍候... ({execution_time}s)"
-                                yield ("", session_id, "", progress_status)
-                    
-                    # 同时运行工具执行和状态更新
-                    tool_task = asyncio.create_task(execute_tool())
-                    
-                    # 在工具执行期间持续发送状态更新
-                    execution_time = 0
-                    while not tool_task.done():
-                        try:
-                            # 等待1秒或工具完成
-                            await asyncio.wait_for(asyncio.shield(tool_task), timeout=1.0)
-                            break  # 工具执行完成
-                        except asyncio.TimeoutError:
-                            # 超时，发送进度更新
-                            execution_time += 1
-                            progress_status = {
-                                "type": "tool_call_executing",
-                                "tool_call_id": tool_call_obj.id,
-                                "tool_name": tool_call_obj.function.name,
-                                "status": "executing",
-                                "execution_time": execution_time,
-                                "message": f"工具正在执行中... ({execution_time}s)"
-                            }
-                            
-                            # 为不同工具添加特定的进度信息
-                            if tool_call_obj.function.name == "note_editor":
-                                if execution_time <= 2:
-                                    progress_status["message"] = f"正在分析笔记内容... ({execution_time}s)"
-                                elif execution_time <= 4:
-                                    progress_status["message"] = f"正在处理编辑操作... ({execution_time}s)"
-                                else:
-                                    progress_status["message"] = f"正在保存笔记更改... ({execution_time}s)"
-                            elif tool_call_obj.function.name == "note_reader":
-                                progress_status["message"] = f"正在读取笔记内容... ({execution_time}s)"
-                            
-                            yield ("", session_id, "", progress_status)
-                    
-                    # 获取工具执行结果
-                    single_result, single_tool_data = await tool_task
-                    
-                    # 收集工具结果
-                    tool_results.extend(single_result)
-                    
-                    # 重置连续失败计数（工具执行成功）
-                    consecutive_failures = 0
-                    
-                    # 更新交互流程中的工具调用记录
-                    tool_call_end_time = datetime.now()
-                    tool_call_record["status"] = "completed"
-                    tool_call_record["completed_at"] = tool_call_end_time.isoformat()
-                    tool_call_record["result"] = json.loads(single_result[0]["content"]) if single_result else None
-                    
-                    # 发送工具调用完成状态，包含结果内容
-                    tool_result_content = single_result[0]["content"] if single_result else ""
-                    tool_status = {
-                        "type": "tool_call_completed",
-                        "tool_call_id": tool_call_obj.id,
-                        "tool_name": tool_call_obj.function.name,
-                        "status": "completed",
-                        "result": tool_result_content
-                    }
-                    # 添加日志确认状态事件发送
-                    api_logger.info(f"✅ 发送工具调用完成状态: {tool_call_obj.function.name} (ID: {tool_call_obj.id}), 结果长度: {len(tool_result_content)}")
-                    # 统一使用四元组格式：(content, session_id, reasoning_content, tool_status)
-                    yield ("", session_id, "", tool_status)
-                    
-                    # 立即将这个工具调用和结果添加到消息列表，然后调用API获取基于此工具结果的响应
-                    # 只使用初始内容，避免累积重复
-                    messages.append({
-                        "role": "assistant",
-                        "content": content if iteration == 1 else "",  # 只在第一轮使用初始内容
-                        "tool_calls": [
-                            {
-                                "id": tc['id'],
-                                "type": "function",
-                                "function": {
-                                    "name": tc['function']['name'],
-                                    "arguments": tc['function']['arguments']
-                                }
-                            }
-                        ]
-                    })
-                    
-                    # 添加工具结果
-                    for tool_result in single_result:
-                        messages.append(tool_result)
-                    
-                    # 立即调用API获取基于此工具结果的响应
-                    api_logger.info(f"第 {iteration} 轮工具 {tool_call_obj.function.name} 执行完成，立即获取AI响应")
-                    
-                    next_response = await openai_client_service.async_client.chat.completions.create(
-                        model=use_model,
-                        messages=messages,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        top_p=top_p,
-                        stream=True,
-                        tools=tools if has_tools else None
-                    )
-                    
-                    # 收集这次AI响应的内容和新工具调用
-                    stream_content = ""
-                    stream_tool_calls = []
-                    
-                    async for chunk in next_response:
-                        if chunk.choices[0].delta.content:
-                            stream_content += chunk.choices[0].delta.content
-                            yield chunk.choices[0].delta.content  # 使用单个内容格式，避免混乱的三元组
-                        
-                        # 检查新的工具调用
-                        if chunk.choices[0].delta.tool_calls:
-                            for delta_tool_call in chunk.choices[0].delta.tool_calls:
-                                # 扩展工具调用列表以适应索引
-                                while len(stream_tool_calls) <= delta_tool_call.index:
-                                    stream_tool_calls.append(None)
-                                
-                                if stream_tool_calls[delta_tool_call.index] is None:
-                                    stream_tool_calls[delta_tool_call.index] = {
-                                        "id": delta_tool_call.id,
-                                        "type": "function",
-                                        "function": {
-                                            "name": delta_tool_call.function.name if delta_tool_call.function.name else "",
-                                            "arguments": delta_tool_call.function.arguments if delta_tool_call.function.arguments else ""
-                                        }
-                                    }
-                                else:
-                                    # 累积参数
-                                    if delta_tool_call.function.arguments:
-                                        stream_tool_calls[delta_tool_call.index]["function"]["arguments"] += delta_tool_call.function.arguments
-                    
-                    # ✅ 修复：将工具调用后的AI响应内容添加到交互流程中
-                    if stream_content.strip():
-                        interaction_flow.append({
-                            "type": "text",
-                            "content": stream_content,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                        api_logger.info(f"已将工具调用后的AI响应添加到交互流程: 内容长度={len(stream_content)}")
-                    
-                    # 更新当前内容和工具调用以供下次循环
-                    current_content = stream_content
-                    current_tool_calls = [tc for tc in stream_tool_calls if tc is not None]
-                    
-                    api_logger.info(f"第 {iteration} 轮工具 {tool_call_obj.function.name} 后得到 AI 响应，内容长度: {len(stream_content)}, 新工具调用数量: {len(current_tool_calls)}")
-                    
-                    # 进入下一个工具
-                    tool_index += 1
-                    
-                    # 如果没有新的工具调用，处理下一个工具；如果有新的工具调用，直接跳到下一轮iteration
-                    if current_tool_calls:
-                        api_logger.info(f"检测到新工具调用，跳转到下一轮iteration")
-                        break  # 跳出当前工具循环，进入下一轮iteration
-                        
-                except Exception as e:
-                    api_logger.error(f"工具调用失败: {e}")
-                    # 更新交互流程中的工具调用记录
-                    tool_call_end_time = datetime.now()
-                    tool_call_record["status"] = "failed"
-                    tool_call_record["completed_at"] = tool_call_end_time.isoformat()
-                    tool_call_record["error"] = str(e)
-                    
-                    # 更新连续失败计数
-                    consecutive_failures += 1
-                    
-                    # 发送工具调用失败状态
-                    tool_status = {
-                        "type": "tool_call_failed",
-                        "tool_call_id": tool_call_obj.id,
-                        "tool_name": tool_call_obj.function.name,
-                        "status": "failed",
-                        "error": str(e)
-                    }
-                    yield ("", session_id, "", tool_status)
-                    
-                    # 如果连续失败次数过多，也要结束整个循环
-                    if consecutive_failures >= max_consecutive_failures:
-                        api_logger.warning(f"连续工具调用失败 {consecutive_failures} 次，结束所有工具处理")
-                        break
-                    
-                    # 跳过这个工具，继续下一个
-                    tool_index += 1
-                    continue
-            
-            # 如果没有更多工具调用了，结束循环
-            if not current_tool_calls:
-                api_logger.info(f"第 {iteration} 轮处理完成，没有更多工具调用")
-                break
-        
-        # 发送最终完成状态
-        final_status = {
-            "type": "tools_processing_completed",
-            "total_iterations": iteration,
-            "interaction_flow": interaction_flow
-        }
-        yield ("", session_id, "", final_status)
-        
-        api_logger.info(f"工具调用处理完成，共进行了 {iteration} 轮，交互流程记录数: {len(interaction_flow)}")
+        engine = ToolLoopEngine(
+            messages, agent, use_model, max_tokens, temperature, top_p, tools, has_tools,
+            session_id, db=db, message_id=message_id, user_id=user_id,
+            interaction_flow=interaction_flow, stream=True, follow_up_per_tool=True,
+            max_iterations=max_iterations
+        )
+        sink = StreamTupleSink(session_id)
+        async for event in engine.run(content, tool_calls):
+            yield sink.render(event)
 
     @staticmethod
     async def generate_chat_stream(
@@ -438,6 +72,9 @@ class ChatStreamService:
         """
         # 初始化交互流程记录
         interaction_flow = []
+        stream_cancellation_registry.track_interaction_flow(interaction_flow)
+        # 统计本次生成的真实用量（包括工具调用后的后续请求）
+        usage_meter = usage_service.start_meter()
         
         try:
             api_logger.info(f"开始调用OpenAI流式API, 模型: {openai_client_service.model}, API地址: {openai_client_service.async_client.base_url}")
@@ -850,6 +487,19 @@ class ChatStreamService:
             has_tools = len(tools) > 0
             api_logger.info(f"流式聊天启用工具: {has_tools}, 工具数量: {len(tools)}")
             
+            # 插入较早对话的摘要并整理为稳定的前缀布局（利于上游提示词缓存），
+            # 再按模型上下文窗口裁剪历史消息，并统计提示词token
+            messages = conversation_summarizer.inject(session_id, messages)
+            messages, tools = prompt_layout.apply(messages, tools)
+            api_logger.debug(f"提示词前缀指纹: {prompt_layout.prefix_hash(messages, tools)}")
+            context = context_builder.build(messages, use_model, max_tokens, tools if has_tools else None)
+            messages = context.messages
+            max_tokens = context.max_tokens
+            token_counter = context_builder.counter(use_model)
+            # 后台把超出预算的历史折叠进会话摘要
+            conversation_summarizer.schedule(session_id, use_model, context)
+            stream_cancellation_registry.track_context(use_model, context.prompt_tokens, agent_id)
+            
             # 调用流式API
             try:
                 api_logger.info(f"尝试调用流式API - URL: {openai_client_service.async_client.base_url}")
@@ -919,14 +569,14 @@ class ChatStreamService:
                     api_logger.info("[验证] 没有工具数据")
                 
                 # 直接使用异步客户端，但开启流式响应
-                response = await openai_client_service.async_client.chat.completions.create(**api_params)
+                response = await openai_client_service.create_chat_completion(**api_params)
                 
                 api_logger.info(f"[流式响应] 获取到流式响应: {type(response)}")
                 
                 # 这里response是一个异步迭代器，需要使用async for遍历每个部分
                 collected_content = ""
                 collected_reasoning_content = ""  # 添加思考内容收集
-                collected_tool_calls = []
+                tool_call_accumulator = ToolCallAccumulator()
                 is_first_chunk = True
                 chunk_count = 0
                 current_text_segment = ""  # 当前文本片段
@@ -960,43 +610,8 @@ class ChatStreamService:
                             
                             api_logger.info(f"流式响应中检测到工具调用: {len(delta.tool_calls)} 个")
                             
-                            # 收集工具调用信息（与上面相同的逻辑）
-                            for tool_call in delta.tool_calls:
-                                tool_index = getattr(tool_call, 'index', None)
-                                existing_call = None
-                                
-                                if tool_index is not None:
-                                    if tool_index < len(collected_tool_calls):
-                                        existing_call = collected_tool_calls[tool_index]
-                                else:
-                                    for existing in collected_tool_calls:
-                                        if existing.get('id') == tool_call.id:
-                                            existing_call = existing
-                                            break
-                                
-                                if existing_call:
-                                    if tool_call.function and tool_call.function.arguments:
-                                        existing_call['function']['arguments'] += tool_call.function.arguments
-                                    if tool_call.function and tool_call.function.name:
-                                        existing_call['function']['name'] = tool_call.function.name
-                                    if tool_call.id:
-                                        existing_call['id'] = tool_call.id
-                                else:
-                                    new_call = {
-                                        'id': tool_call.id if tool_call.id else f"call_{len(collected_tool_calls)}",
-                                        'type': tool_call.type if tool_call.type else 'function',
-                                        'function': {
-                                            'name': tool_call.function.name if tool_call.function and tool_call.function.name else '',
-                                            'arguments': tool_call.function.arguments if tool_call.function and tool_call.function.arguments else ''
-                                        }
-                                    }
-                                    
-                                    if tool_index is not None:
-                                        while len(collected_tool_calls) <= tool_index:
-                                            collected_tool_calls.append(None)
-                                        collected_tool_calls[tool_index] = new_call
-                                    else:
-                                        collected_tool_calls.append(new_call)
+                            # 收集工具调用增量（参数片段写入缓冲区，流结束时统一解析）
+                            tool_call_accumulator.add_all(delta.tool_calls)
                         
                         content_chunk = delta.content or ""
                         reasoning_chunk = ""
@@ -1079,15 +694,15 @@ class ChatStreamService:
                 api_logger.info(f"流式响应完成，共接收 {chunk_count} 个块")
                 api_logger.info(f"流式响应内容长度: {len(collected_content)}")
                 api_logger.info(f"流式响应思考内容长度: {len(collected_reasoning_content)}")
-                api_logger.info(f"收集到的工具调用: {len(collected_tool_calls)} 个")
+                api_logger.info(f"收集到的工具调用: {len(tool_call_accumulator)} 个")
                 
                 # 先保存AI消息（即使内容为空，也要保存以便后续更新）
                 ai_message = None
                 saved_prompt_tokens = 0  # 提前保存prompt_tokens
                 if db and user_id and session_id:
-                    # 估算token数量（简单实现）
-                    tokens = len(collected_content) // 4 if collected_content else 0
-                    prompt_tokens = len(str(messages)) // 4
+                    # 统计token数量
+                    tokens = token_counter.count_text(collected_content)
+                    prompt_tokens = context.prompt_tokens
                     total_tokens = tokens + prompt_tokens
                     saved_prompt_tokens = prompt_tokens  # 保存这个值供后续使用
                     
@@ -1101,10 +716,11 @@ class ChatStreamService:
                         total_tokens=total_tokens,
                         agent_id=agent_id
                     )
+                    stream_cancellation_registry.track_message(ai_message.public_id if ai_message else None)
                     api_logger.info(f"AI消息已保存: id={ai_message.public_id}, 初始内容长度: {len(collected_content or '')}")
                 
                 # 检查是否有有效的工具调用需要处理
-                valid_tool_calls = [tc for tc in collected_tool_calls if tc is not None and tc.get('function', {}).get('name')]
+                valid_tool_calls = tool_call_accumulator.finalize()
                 
                 if valid_tool_calls:
                     api_logger.info(f"检测到 {len(valid_tool_calls)} 个有效工具调用，开始递归处理")
@@ -1112,7 +728,7 @@ class ChatStreamService:
                     final_content = collected_content or ""  # 保存初始内容，确保不为None
                     async for content_chunk in ChatStreamService._process_tool_calls_with_interaction_flow(
                         collected_content or "", 
-                        collected_tool_calls, 
+                        valid_tool_calls, 
                         messages, 
                         current_agent, 
                         use_model, 
@@ -1144,7 +760,7 @@ class ChatStreamService:
                     # 更新AI消息内容
                     if ai_message:
                         ai_message.content = json.dumps(final_json_content, ensure_ascii=False)
-                        ai_message.tokens = len(final_content) // 4
+                        ai_message.tokens = token_counter.count_text(final_content)
                         # 使用之前保存的prompt_tokens值，避免延迟加载
                         ai_message.total_tokens = saved_prompt_tokens + ai_message.tokens
                         await db.commit()
@@ -1175,9 +791,15 @@ class ChatStreamService:
                         memory_service.add_assistant_message(session_id, collected_content, user_id)
                         api_logger.info(f"fallback模式：流式聊天完成，内容长度: {len(collected_content)}")
                 
+                # 最终内容已保存，之后的取消无需再保存部分内容
+                stream_cancellation_registry.mark_saved()
+                # 用接口返回的用量（汇总所有后续请求）更新消息并累加到用量汇总
+                await usage_service.settle_message(db, ai_message, usage_meter, user_id)
+                
                 # 检查是否需要自动生成标题
                 if db and session_id and user_content:
-                    await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                    # 标题在后台队列中生成，不阻塞本次回答的完成
+                    stream_cancellation_registry.track_title(title_queue.enqueue(session_id, user_content))
             
             except Exception as api_error:
                 api_logger.error(f"流式API调用出错: {str(api_error)}", exc_info=True)
@@ -1201,14 +823,14 @@ class ChatStreamService:
                             fallback_api_params["tools"] = tools
                         
                         # 使用默认模型重试
-                        response = await openai_client_service.async_client.chat.completions.create(**fallback_api_params)
+                        response = await openai_client_service.create_chat_completion(**fallback_api_params)
                         
                         api_logger.info(f"使用默认模型获取到流式响应: {type(response)}")
                         
                         # 处理流式响应（与上面相同的逻辑）
                         collected_content = ""
                         collected_reasoning_content = ""  # 添加思考内容收集
-                        collected_tool_calls = []
+                        tool_call_accumulator = ToolCallAccumulator()
                         is_first_chunk = True
                         chunk_count = 0
                         current_text_segment = ""  # 当前文本片段
@@ -1224,43 +846,8 @@ class ChatStreamService:
                                 if hasattr(delta, 'tool_calls') and delta.tool_calls:
                                     api_logger.info(f"流式响应中检测到工具调用: {len(delta.tool_calls)} 个")
                                     
-                                    # 收集工具调用信息（与上面相同的逻辑）
-                                    for tool_call in delta.tool_calls:
-                                        tool_index = getattr(tool_call, 'index', None)
-                                        existing_call = None
-                                        
-                                        if tool_index is not None:
-                                            if tool_index < len(collected_tool_calls):
-                                                existing_call = collected_tool_calls[tool_index]
-                                        else:
-                                            for existing in collected_tool_calls:
-                                                if existing.get('id') == tool_call.id:
-                                                    existing_call = existing
-                                                    break
-                                        
-                                        if existing_call:
-                                            if tool_call.function and tool_call.function.arguments:
-                                                existing_call['function']['arguments'] += tool_call.function.arguments
-                                            if tool_call.function and tool_call.function.name:
-                                                existing_call['function']['name'] = tool_call.function.name
-                                            if tool_call.id:
-                                                existing_call['id'] = tool_call.id
-                                        else:
-                                            new_call = {
-                                                'id': tool_call.id if tool_call.id else f"call_{len(collected_tool_calls)}",
-                                                'type': tool_call.type if tool_call.type else 'function',
-                                                'function': {
-                                                    'name': tool_call.function.name if tool_call.function and tool_call.function.name else '',
-                                                    'arguments': tool_call.function.arguments if tool_call.function and tool_call.function.arguments else ''
-                                                }
-                                            }
-                                            
-                                            if tool_index is not None:
-                                                while len(collected_tool_calls) <= tool_index:
-                                                    collected_tool_calls.append(None)
-                                                collected_tool_calls[tool_index] = new_call
-                                            else:
-                                                collected_tool_calls.append(new_call)
+                                    # 收集工具调用增量（参数片段写入缓冲区，流结束时统一解析）
+                                    tool_call_accumulator.add_all(delta.tool_calls)
                                 
                                 content_chunk = delta.content or ""
                                 reasoning_chunk = ""
@@ -1343,8 +930,8 @@ class ChatStreamService:
                         ai_message = None
                         saved_prompt_tokens_fallback = 0  # 提前保存prompt_tokens
                         if db and user_id and session_id:
-                            tokens = len(collected_content) // 4 if collected_content else 0
-                            prompt_tokens = len(str(messages)) // 4
+                            tokens = token_counter.count_text(collected_content)
+                            prompt_tokens = context.prompt_tokens
                             total_tokens = tokens + prompt_tokens
                             saved_prompt_tokens_fallback = prompt_tokens  # 保存这个值供后续使用
                             
@@ -1358,16 +945,17 @@ class ChatStreamService:
                                 total_tokens=total_tokens,
                                 agent_id=agent_id
                             )
+                            stream_cancellation_registry.track_message(ai_message.public_id if ai_message else None)
                         
                         # 检查是否有有效的工具调用需要处理
-                        valid_tool_calls = [tc for tc in collected_tool_calls if tc is not None and tc.get('function', {}).get('name')]
+                        valid_tool_calls = tool_call_accumulator.finalize()
                         
                         if valid_tool_calls:
                             # 递归处理工具调用
                             final_content = collected_content or ""
                             async for content_chunk in ChatStreamService._process_tool_calls_with_interaction_flow(
                                 collected_content or "", 
-                                collected_tool_calls, 
+                                valid_tool_calls, 
                                 messages, 
                                 current_agent, 
                                 use_model, 
@@ -1397,7 +985,7 @@ class ChatStreamService:
                             # 更新AI消息内容
                             if ai_message:
                                 ai_message.content = json.dumps(final_json_content, ensure_ascii=False)
-                                ai_message.tokens = len(final_content) // 4
+                                ai_message.tokens = token_counter.count_text(final_content)
                                 # 使用之前保存的prompt_tokens值，避免延迟加载
                                 ai_message.total_tokens = saved_prompt_tokens_fallback + ai_message.tokens
                                 await db.commit()
@@ -1428,9 +1016,15 @@ class ChatStreamService:
                                 memory_service.add_assistant_message(session_id, collected_content, user_id)
                                 api_logger.info(f"fallback模式：流式聊天完成，内容长度: {len(collected_content)}")
                         
+                        # 最终内容已保存，之后的取消无需再保存部分内容
+                        stream_cancellation_registry.mark_saved()
+                        # 用接口返回的用量（汇总所有后续请求）更新消息并累加到用量汇总
+                        await usage_service.settle_message(db, ai_message, usage_meter, user_id)
+                        
                         # 检查是否需要自动生成标题
                         if db and session_id and user_content:
-                            await chat_session_manager.auto_generate_title_if_needed(db, session_id, user_content)
+                            # 标题在后台队列中生成，不阻塞本次回答的完成
+                            stream_cancellation_registry.track_title(title_queue.enqueue(session_id, user_content))
                     
                     except Exception as fallback_error:
                         api_logger.error(f"使用默认模型 {openai_client_service.model} 流式响应仍然失败: {str(fallback_error)}", exc_info=True)
@@ -1,4 +1,4 @@
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, List, Any, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 import json
 from datetime import datetime
@@ -77,9 +77,17 @@ class ChatToolHandler:
         session_id: Optional[int] = None, 
         message_id: Optional[int] = None,
         user_id: Optional[int] = None,
-        agent_id: Optional[int] = None
+        agent_id: Optional[int] = None,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        persist: bool = True
     ):
-        """处理工具调用请求并返回结果 - 支持转换后的MCP工具"""
+        """处理工具调用请求并返回结果 - 支持转换后的MCP工具
+        
+        on_progress: 可选的进度回调，工具产生中间结果时以
+        {"tool_call_id", "tool_name", "partial"} 的形式立即回调
+        persist: 是否在返回前保存工具调用记录；为False时调用方可在
+        发起后续LLM请求的同时调用 persist_tool_calls 在后台保存
+        """
         results = []
         tool_calls_data = []  # 用于兼容性，保留原有的返回格式
         
@@ -108,6 +116,7 @@ class ChatToolHandler:
                 function_args = mcp_tool.get("arguments", {})
                 
                 api_logger.info(f"处理原生MCP工具调用: {function_name} (服务器: {server_name}), 参数: {function_args}")
+                emit_progress = ChatToolHandler._make_progress_emitter(on_progress, tool_call_id, function_name)
                 
                 # 初始化工具调用数据
                 tool_call_data = {
@@ -147,7 +156,8 @@ class ChatToolHandler:
                     mcp_result = await mcp_service.call_tool(
                         server_name=server_name,
                         tool_name=function_name,
-                        arguments=mcp_arguments
+                        arguments=mcp_arguments,
+                        progress_callback=emit_progress
                     )
                     
                     # 转换MCP结果格式
@@ -182,7 +192,12 @@ class ChatToolHandler:
             else:
                 # OpenAI function调用格式（包括转换后的MCP工具）
                 function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
+                # 优先使用上游已解析的参数，避免重复解析
+                function_args = getattr(tool_call, "parsed_arguments", None)
+                if function_args is None:
+                    function_args = json.loads(tool_call.function.arguments)
+                
+                emit_progress = ChatToolHandler._make_progress_emitter(on_progress, tool_call_id, function_name)
                 
                 # 检查是否是转换后的MCP工具
                 mcp_metadata = tools_config.get(function_name)
@@ -235,7 +250,8 @@ class ChatToolHandler:
                         mcp_result = await mcp_service.call_tool(
                             server_name=server_name,
                             tool_name=function_name,
-                            arguments=mcp_arguments
+                            arguments=mcp_arguments,
+                            progress_callback=emit_progress
                         )
                         
                         # 转换MCP结果格式
@@ -263,7 +279,7 @@ class ChatToolHandler:
                         # 根据函数名执行相应的工具
                         tool_result = None
                         if function_name == "tavily_search":
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="tavily",
                                 action="search",
                                 params={
@@ -274,18 +290,19 @@ class ChatToolHandler:
                             )
                             
                         elif function_name == "tavily_extract":
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="tavily",
                                 action="extract",
                                 params={
                                     "urls": function_args.get("urls"),
                                     "include_images": function_args.get("include_images", False)
                                 },
-                                config={"api_key": api_key} if api_key else None
+                                config={"api_key": api_key} if api_key else None,
+                                on_progress=emit_progress
                             )
                         
                         elif function_name == "serper_search":
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="serper",
                                 action="search",
                                 params={
@@ -298,7 +315,7 @@ class ChatToolHandler:
                             )
                         
                         elif function_name == "serper_news":
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="serper",
                                 action="news_search",
                                 params={
@@ -311,14 +328,15 @@ class ChatToolHandler:
                             )
                         
                         elif function_name == "serper_scrape":
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="serper",
                                 action="scrape_url",
                                 params={
                                     "url": function_args.get("url"),
                                     "include_markdown": function_args.get("include_markdown", True)
                                 },
-                                config={"api_key": api_key} if api_key else None
+                                config={"api_key": api_key} if api_key else None,
+                                on_progress=emit_progress
                             )
                         
                         elif function_name == "note_reader":
@@ -406,7 +424,7 @@ class ChatToolHandler:
                         elif function_name == "get_time":
                             # 处理时间工具
                             api_logger.info(f"正在执行时间查询操作: {function_args}")
-                            tool_result = tools_service.execute_tool(
+                            tool_result = await tools_service.execute_tool_async(
                                 tool_name="get_time",
                                 action="get_current_time",
                                 params=function_args,
@@ -435,47 +453,11 @@ class ChatToolHandler:
                     tool_call_data["error"] = str(e)
                     tool_call_data["completed_at"] = datetime.now().isoformat()
             
-            # 保存工具调用记录到数据库
-            if db and session_id and message_id:
-                try:
-                    # 将public_id转换为数据库内部ID
-                    from backend.utils.id_converter import IDConverter
-                    
-                    # 转换message_id和session_id为数据库ID
-                    db_message_id = await IDConverter.get_message_db_id(db, message_id) if isinstance(message_id, str) else message_id
-                    db_session_id = await IDConverter.get_chat_db_id(db, session_id) if isinstance(session_id, str) else session_id
-                    
-                    if not db_message_id or not db_session_id:
-                        api_logger.warning(f"无法转换ID: message_id={message_id} -> {db_message_id}, session_id={session_id} -> {db_session_id}")
-                        raise ValueError("无法转换public_id为数据库ID")
-                    
-                    # 使用传入的agent_id，避免懒加载
-                    agent_db_id = agent_id
-                    
-                    # 获取工具名称和参数
-                    tool_name = tool_call_data["name"]
-                    tool_arguments = tool_call_data["arguments"]
-                    
-                    # 创建工具调用记录
-                    await create_tool_call(
-                        db=db,
-                        user_id=user_id,
-                        message_id=db_message_id,  # 使用数据库ID
-                        session_id=db_session_id,  # 使用数据库ID
-                        tool_call_id=tool_call_id,
-                        tool_name=tool_name,
-                        function_name=tool_name,
-                        arguments=tool_arguments,
-                        agent_id=agent_db_id,
-                        status=tool_call_data["status"],
-                        result=tool_result if tool_call_data["status"] == "completed" else None,
-                        error_message=tool_call_data.get("error") if tool_call_data["status"] == "error" else None
-                    )
-                    api_logger.info(f"工具调用记录已保存到数据库: {tool_call_id}")
-                except Exception as e:
-                    api_logger.error(f"保存工具调用记录失败: {str(e)}", exc_info=True)
-            else:
-                api_logger.debug(f"跳过工具调用数据库记录（缺少必要参数）: db={bool(db)}, session_id={session_id}, message_id={message_id}")
+            # 保存工具调用记录到数据库（persist=False时由调用方在后台统一保存）
+            if persist:
+                await ChatToolHandler._save_tool_call_record(
+                    db, tool_call_data, session_id, message_id, user_id, agent_id
+                )
             
             # 添加到结果列表
             results.append({
@@ -488,6 +470,96 @@ class ChatToolHandler:
         
         api_logger.info(f"完成 {len(results)} 个工具调用")
         return results, tool_calls_data
+    
+    @staticmethod
+    async def _save_tool_call_record(
+        db: Optional[AsyncSession],
+        tool_call_data: Dict[str, Any],
+        session_id,
+        message_id,
+        user_id: Optional[int],
+        agent_id: Optional[int]
+    ) -> None:
+        """保存单条工具调用记录"""
+        if not (db and session_id and message_id):
+            api_logger.debug(f"跳过工具调用数据库记录（缺少必要参数）: db={bool(db)}, session_id={session_id}, message_id={message_id}")
+            return
+        
+        tool_call_id = tool_call_data["id"]
+        try:
+            # 将public_id转换为数据库内部ID
+            from backend.utils.id_converter import IDConverter
+            
+            # 转换message_id和session_id为数据库ID
+            db_message_id = await IDConverter.get_message_db_id(db, message_id) if isinstance(message_id, str) else message_id
+            db_session_id = await IDConverter.get_chat_db_id(db, session_id) if isinstance(session_id, str) else session_id
+            
+            if not db_message_id or not db_session_id:
+                api_logger.warning(f"无法转换ID: message_id={message_id} -> {db_message_id}, session_id={session_id} -> {db_session_id}")
+                raise ValueError("无法转换public_id为数据库ID")
+            
+            completed = tool_call_data["status"] == "completed"
+            
+            # 创建工具调用记录，使用传入的agent_id，避免懒加载
+            await create_tool_call(
+                db=db,
+                user_id=user_id,
+                message_id=db_message_id,  # 使用数据库ID
+                session_id=db_session_id,  # 使用数据库ID
+                tool_call_id=tool_call_id,
+                tool_name=tool_call_data["name"],
+                function_name=tool_call_data["name"],
+                arguments=tool_call_data["arguments"],
+                agent_id=agent_id,
+                status=tool_call_data["status"],
+                result=tool_call_data.get("result") if completed else None,
+                error_message=tool_call_data.get("error") if tool_call_data["status"] == "error" else None
+            )
+            api_logger.info(f"工具调用记录已保存到数据库: {tool_call_id}")
+        except Exception as e:
+            api_logger.error(f"保存工具调用记录失败: {str(e)}", exc_info=True)
+    
+    @staticmethod
+    async def persist_tool_calls(
+        tool_calls_data: List[Dict[str, Any]],
+        session_id,
+        message_id,
+        user_id: Optional[int] = None,
+        agent_id: Optional[int] = None
+    ) -> None:
+        """使用独立的数据库会话保存工具调用记录
+        
+        独立会话不与请求的主会话共享状态，可以和后续的LLM请求并发执行。
+        """
+        if not tool_calls_data or not session_id or not message_id:
+            return
+        
+        from backend.db.session import get_async_session
+        async for db in get_async_session():
+            for tool_call_data in tool_calls_data:
+                await ChatToolHandler._save_tool_call_record(
+                    db, tool_call_data, session_id, message_id, user_id, agent_id
+                )
+            break
+    
+    @staticmethod
+    def _make_progress_emitter(
+        on_progress: Optional[Callable[[Dict[str, Any]], None]],
+        tool_call_id: str,
+        tool_name: str
+    ) -> Optional[Callable[[Any], None]]:
+        """为单个工具调用包装进度回调，附带调用ID和工具名"""
+        if on_progress is None:
+            return None
+        
+        def emit(partial: Any) -> None:
+            on_progress({
+                "tool_call_id": tool_call_id,
+                "tool_name": tool_name,
+                "partial": partial
+            })
+        
+        return emit
 
 
 # 创建全局工具处理器实例
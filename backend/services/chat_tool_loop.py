@@ -0,0 +1,545 @@
+"""
+工具调用循环引擎
+
+流式与非流式聊天共用的工具调用状态机：校验工具调用 -> 执行工具 ->
+发起后续LLM请求 -> 解析新的工具调用，直到没有新的工具调用为止。
+引擎只产出事件，由不同的输出端（sink）转换为各自需要的格式。
+"""
+
+import asyncio
+import json
+from contextlib import aclosing
+from datetime import datetime
+from enum import Enum
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.utils.logging import api_logger
+from backend.services.openai_client import openai_client_service
+from backend.services.chat_tool_handler import chat_tool_handler
+from backend.services.llm_gateway import close_stream
+from backend.services.tool_call_accumulator import ToolCallAccumulator, parse_arguments
+
+
+# 对于这些工具，空参数是合法的
+EMPTY_ARGUMENTS_ALLOWED_TOOLS = frozenset({"note_reader"})
+
+
+class ToolLoopState(str, Enum):
+    """工具循环状态"""
+    VALIDATE = "validate"    # 校验本轮工具调用
+    EXECUTE = "execute"      # 执行工具
+    FOLLOW_UP = "follow_up"  # 基于工具结果请求LLM
+    DONE = "done"
+
+
+class ToolLoopEvent:
+    """工具循环产出的事件"""
+    __slots__ = ("kind", "data")
+
+    CONTENT = "content"  # data为文本片段
+    STATUS = "status"    # data为工具状态字典
+
+    def __init__(self, kind: str, data: Any):
+        self.kind = kind
+        self.data = data
+
+
+class ToolCallFunction:
+    """工具调用的函数信息（兼容OpenAI对象的属性访问方式）"""
+    __slots__ = ("name", "arguments")
+
+    def __init__(self, name: str, arguments: str):
+        self.name = name
+        self.arguments = arguments
+
+
+class ToolCallRequest:
+    """传递给 ChatToolHandler 的工具调用对象"""
+    __slots__ = ("id", "type", "function", "parsed_arguments")
+
+    def __init__(
+        self,
+        id: str,
+        type: str,
+        function: ToolCallFunction,
+        parsed_arguments: Optional[Dict[str, Any]] = None
+    ):
+        self.id = id
+        self.type = type
+        self.function = function
+        # 已解析的参数，下游直接使用，避免重复解析
+        self.parsed_arguments = parsed_arguments
+
+    @classmethod
+    def from_dict(cls, tc: Dict[str, Any]) -> "ToolCallRequest":
+        return cls(
+            tc["id"],
+            tc.get("type") or "function",
+            ToolCallFunction(tc["function"]["name"], tc["function"]["arguments"]),
+            parsed_arguments=tc.get("parsed_arguments")
+        )
+
+
+class StreamTupleSink:
+    """流式输出端：把事件转换为流式接口约定的格式
+
+    文本片段直接产出字符串，工具状态使用四元组
+    (content, session_id, reasoning_content, tool_status)。
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+    def render(self, event: ToolLoopEvent):
+        if event.kind == ToolLoopEvent.CONTENT:
+            return event.data
+        return ("", self.session_id, "", event.data)
+
+
+def tool_calls_to_dicts(tool_calls: List[Any]) -> List[Dict[str, Any]]:
+    """将OpenAI响应中的工具调用对象转换为字典格式"""
+    return [
+        {
+            "id": tc.id,
+            "type": tc.type or "function",
+            "function": {
+                "name": tc.function.name,
+                "arguments": tc.function.arguments or ""
+            }
+        }
+        for tc in tool_calls
+    ]
+
+
+class ToolLoopEngine:
+    """工具调用循环引擎
+
+    follow_up_per_tool为True时每执行完一个工具就请求一次LLM（流式聊天，
+    工具之间可以穿插文本）；为False时整批工具执行完再请求一次LLM。
+    """
+
+    def __init__(
+        self,
+        messages: List[Dict[str, Any]],
+        agent,
+        use_model: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        tools: List[Dict[str, Any]],
+        has_tools: bool,
+        session_id,
+        db: Optional[AsyncSession] = None,
+        message_id: Optional[str] = None,
+        user_id: Optional[int] = None,
+        interaction_flow: Optional[List[Dict[str, Any]]] = None,
+        stream: bool = True,
+        follow_up_per_tool: bool = True,
+        max_iterations: int = 20,
+        max_consecutive_failures: int = 3
+    ):
+        self.messages = messages
+        self.agent = agent
+        self.use_model = use_model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.tools = tools
+        self.has_tools = has_tools
+        self.session_id = session_id
+        self.db = db
+        self.message_id = message_id
+        self.user_id = user_id
+        self.interaction_flow = interaction_flow if interaction_flow is not None else []
+        self.stream = stream
+        self.follow_up_per_tool = follow_up_per_tool
+        self.max_iterations = max_iterations
+        self.max_consecutive_failures = max_consecutive_failures
+
+        # 获取agent的数据库ID，避免在handle_tool_calls中懒加载
+        self.agent_db_id = getattr(agent, "id", None) if agent else None
+
+        # 运行状态
+        self.state = ToolLoopState.VALIDATE
+        self.iteration = 0
+        self._pending_calls: List[Dict[str, Any]] = []
+        self._batch: List[Dict[str, Any]] = []
+        self._batch_pos = 0
+        self._signature_history: List[List[str]] = []
+        self._consecutive_failures = 0
+        self._assistant_text = ""  # 尚未写入消息列表的助手文本
+        self._content_parts: List[str] = []
+        self._follow_up_task: Optional[asyncio.Task] = None
+        self._follow_up_records: List[Dict[str, Any]] = []  # 后续请求所基于的工具调用记录
+        self._persist_tasks: List[asyncio.Task] = []
+
+    @property
+    def final_content(self) -> str:
+        """初始内容加上所有后续响应内容"""
+        return "".join(self._content_parts)
+
+    async def run(self, content: str, tool_calls: List[Dict[str, Any]]) -> AsyncGenerator[ToolLoopEvent, None]:
+        """运行工具循环，逐个产出事件"""
+        self._content_parts = [content or ""]
+        self._assistant_text = content or ""
+        self._pending_calls = [tc for tc in tool_calls if tc is not None]
+        self.state = ToolLoopState.VALIDATE
+
+        try:
+            while self.state is not ToolLoopState.DONE:
+                if self.state is ToolLoopState.VALIDATE:
+                    self.state = self._validate()
+                elif self.state is ToolLoopState.EXECUTE:
+                    async with aclosing(self._execute()) as events:
+                        async for event in events:
+                            yield event
+                elif self.state is ToolLoopState.FOLLOW_UP:
+                    async with aclosing(self._follow_up()) as events:
+                        async for event in events:
+                            yield event
+        finally:
+            await self._discard_follow_up()
+
+        # 等待后台保存完成，确保结束前工具历史已经落库
+        if self._persist_tasks:
+            await asyncio.gather(*self._persist_tasks, return_exceptions=True)
+
+        api_logger.info(f"工具调用处理完成，共进行了 {self.iteration} 轮，交互流程记录数: {len(self.interaction_flow)}")
+        yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+            "type": "tools_processing_completed",
+            "total_iterations": self.iteration,
+            "interaction_flow": self.interaction_flow
+        })
+
+    def _validate(self) -> ToolLoopState:
+        """校验本轮工具调用，检测重复调用"""
+        if not self._pending_calls:
+            return ToolLoopState.DONE
+        if self.iteration >= self.max_iterations:
+            api_logger.warning(f"工具调用达到最大迭代次数 {self.max_iterations}，强制结束")
+            return ToolLoopState.DONE
+
+        self.iteration += 1
+        api_logger.info(f"开始第 {self.iteration} 轮工具调用处理，共 {len(self._pending_calls)} 个工具调用")
+
+        signature = [
+            f"{tc['function']['name']}:{tc['function']['arguments']}"
+            for tc in self._pending_calls if tc.get("function")
+        ]
+        # 检查是否与最近的工具调用重复
+        if self._signature_history and signature == self._signature_history[-1]:
+            api_logger.warning(f"检测到重复的工具调用，停止处理：{signature}")
+            return ToolLoopState.DONE
+        self._signature_history.append(signature)
+
+        batch = []
+        for tc in self._pending_calls:
+            name = tc["function"]["name"]
+            if not name:
+                api_logger.warning(f"工具调用 {tc.get('id')} 函数名为空，跳过")
+                continue
+
+            if not (tc["function"]["arguments"] or "").strip():
+                if name not in EMPTY_ARGUMENTS_ALLOWED_TOOLS:
+                    api_logger.warning(f"工具调用 {name} 参数为空，跳过")
+                    continue
+                tc["function"]["arguments"] = "{}"
+            if parse_arguments(tc) is None:
+                api_logger.error(f"工具调用 {name} 参数JSON格式错误: {tc['function']['arguments']}, 错误: {tc.get('parse_error')}")
+                continue
+            batch.append(tc)
+
+        self._pending_calls = []
+        if not batch:
+            api_logger.warning("没有有效的工具调用，结束工具处理")
+            return ToolLoopState.DONE
+
+        self._batch = batch
+        self._batch_pos = 0
+        return ToolLoopState.EXECUTE
+
+    async def _execute(self) -> AsyncGenerator[ToolLoopEvent, None]:
+        """执行当前批次中的工具（逐个模式下只执行一个）"""
+        end = self._batch_pos + 1 if self.follow_up_per_tool else len(self._batch)
+        step = self._batch[self._batch_pos:end]
+        self._batch_pos = end
+
+        executed: List[Dict[str, Any]] = []
+        records: List[Dict[str, Any]] = []
+        tool_messages: List[Dict[str, Any]] = []
+        deferred_status: Optional[Dict[str, Any]] = None
+
+        for position, tc in enumerate(step):
+            completed_status = None
+            async with aclosing(self._execute_one(tc)) as events:
+                async for event in events:
+                    if isinstance(event, ToolLoopEvent):
+                        yield event
+                    else:
+                        completed_status, single_result, record = event
+                        executed.append(tc)
+                        tool_messages.extend(single_result)
+                        records.append(record)
+
+            if self.state is ToolLoopState.DONE:
+                return
+            if completed_status is not None:
+                # 最后一个工具的完成状态在后续请求发起后再发送
+                if position == len(step) - 1:
+                    deferred_status = completed_status
+                else:
+                    yield ToolLoopEvent(ToolLoopEvent.STATUS, completed_status)
+
+        if not executed:
+            self.state = ToolLoopState.EXECUTE if self._batch_pos < len(self._batch) else ToolLoopState.DONE
+            return
+
+        # 将工具调用和结果添加到消息列表
+        self.messages.append({
+            "role": "assistant",
+            "content": self._assistant_text,
+            "tool_calls": [
+                {
+                    "id": tc["id"],
+                    "type": "function",
+                    "function": {
+                        "name": tc["function"]["name"],
+                        "arguments": tc["function"]["arguments"]
+                    }
+                } for tc in executed
+            ]
+        })
+        self._assistant_text = ""
+        self.messages.extend(tool_messages)
+
+        # 工具结果就绪后立即发起后续请求，完成状态的发送与其并行
+        api_logger.info(f"第 {self.iteration} 轮工具执行完成，立即获取AI响应")
+        self._follow_up_task = asyncio.create_task(self._create_completion())
+        self._follow_up_records = records
+        self.state = ToolLoopState.FOLLOW_UP
+        if deferred_status is not None:
+            yield ToolLoopEvent(ToolLoopEvent.STATUS, deferred_status)
+
+    async def _execute_one(self, tc: Dict[str, Any]):
+        """执行单个工具，产出状态事件，成功时最后产出 (完成状态, 工具消息, 调用记录)"""
+        tool_call = ToolCallRequest.from_dict(tc)
+        name = tool_call.function.name
+
+        tool_call_record = {
+            "type": "tool_call",
+            "id": tool_call.id,
+            "name": name,
+            "arguments": tool_call.parsed_arguments,
+            "status": "executing",
+            "started_at": datetime.now().isoformat()
+        }
+        self.interaction_flow.append(tool_call_record)
+
+        api_logger.info(f"🚀 发送工具调用开始状态: {name} (ID: {tool_call.id})")
+        yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+            "type": "tool_call_start",
+            "tool_call_id": tool_call.id,
+            "tool_name": name,
+            "status": "preparing"
+        })
+        yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+            "type": "tool_call_executing",
+            "tool_call_id": tool_call.id,
+            "tool_name": name,
+            "status": "executing"
+        })
+
+        try:
+            # 工具产生的中间结果通过队列实时转发
+            progress_queue: asyncio.Queue = asyncio.Queue()
+            tool_task = asyncio.create_task(chat_tool_handler.handle_tool_calls(
+                [tool_call],
+                self.agent,
+                self.db,
+                self.session_id,
+                message_id=self.message_id,
+                user_id=self.user_id,
+                agent_id=self.agent_db_id,
+                on_progress=progress_queue.put_nowait,
+                persist=False  # 工具历史在后台保存，不阻塞后续的LLM请求
+            ))
+            try:
+                async for progress in _iter_tool_progress(tool_task, progress_queue):
+                    yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+                        "type": "tool_call_progress",
+                        "tool_call_id": progress["tool_call_id"],
+                        "tool_name": progress["tool_name"],
+                        "status": "executing",
+                        "partial": progress["partial"]
+                    })
+            finally:
+                if not tool_task.done():
+                    tool_task.cancel()
+            single_result, single_tool_data = await tool_task
+        except Exception as e:
+            api_logger.error(f"工具调用失败: {e}")
+            tool_call_record["status"] = "failed"
+            tool_call_record["completed_at"] = datetime.now().isoformat()
+            tool_call_record["error"] = str(e)
+            self._consecutive_failures += 1
+            yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+                "type": "tool_call_failed",
+                "tool_call_id": tool_call.id,
+                "tool_name": name,
+                "status": "failed",
+                "error": str(e)
+            })
+            if self._consecutive_failures >= self.max_consecutive_failures:
+                api_logger.warning(f"连续工具调用失败 {self._consecutive_failures} 次，结束所有工具处理")
+                self.state = ToolLoopState.DONE
+            return
+
+        self._consecutive_failures = 0
+
+        # 工具历史使用独立会话在后台保存
+        if self.message_id:
+            self._persist_tasks.append(asyncio.create_task(
+                chat_tool_handler.persist_tool_calls(
+                    single_tool_data, self.session_id, self.message_id,
+                    user_id=self.user_id, agent_id=self.agent_db_id
+                )
+            ))
+
+        tool_result_content = single_result[0]["content"] if single_result else ""
+        tool_call_record["status"] = "completed"
+        tool_call_record["completed_at"] = datetime.now().isoformat()
+        tool_call_record["result"] = json.loads(tool_result_content) if tool_result_content else None
+
+        api_logger.info(f"✅ 工具调用完成: {name} (ID: {tool_call.id}), 结果长度: {len(tool_result_content)}")
+        yield ({
+            "type": "tool_call_completed",
+            "tool_call_id": tool_call.id,
+            "tool_name": name,
+            "status": "completed",
+            "result": tool_result_content
+        }, single_result, tool_call_record)
+
+    async def _create_completion(self):
+        """发起后续LLM请求"""
+        return await openai_client_service.create_chat_completion(
+            model=self.use_model,
+            messages=self.messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            stream=self.stream,
+            tools=self.tools if self.has_tools else None
+        )
+
+    async def _follow_up(self) -> AsyncGenerator[ToolLoopEvent, None]:
+        """读取后续响应，收集文本和新的工具调用"""
+        text_parts: List[str] = []
+        try:
+            response = await self._follow_up_task
+            self._follow_up_task = None
+
+            if self.stream:
+                accumulator = ToolCallAccumulator()
+                try:
+                    async for chunk in response:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        if delta.content:
+                            text_parts.append(delta.content)
+                            yield ToolLoopEvent(ToolLoopEvent.CONTENT, delta.content)
+                        if delta.tool_calls:
+                            accumulator.add_all(delta.tool_calls)
+                finally:
+                    # 调用方提前停止读取时释放网关的并发名额
+                    await close_stream(response)
+                new_calls = accumulator.finalize()
+            else:
+                assistant_message = response.choices[0].message
+                text_parts.append(assistant_message.content or "")
+                new_calls = tool_calls_to_dicts(assistant_message.tool_calls or [])
+                if text_parts[0]:
+                    yield ToolLoopEvent(ToolLoopEvent.CONTENT, text_parts[0])
+        except Exception as e:
+            self._follow_up_task = None
+            # 已发送的部分内容仍然保留
+            self._record_text("".join(text_parts))
+            for event in self._follow_up_failed(e):
+                yield event
+            return
+
+        text = "".join(text_parts)
+        self._record_text(text)
+
+        api_logger.info(f"第 {self.iteration} 轮后得到 AI 响应，内容长度: {len(text)}, 新工具调用数量: {len(new_calls)}")
+
+        if new_calls:
+            self._pending_calls = new_calls
+            self.state = ToolLoopState.VALIDATE
+        elif self._batch_pos < len(self._batch):
+            # 逐个模式下继续执行本批次剩余的工具
+            self.state = ToolLoopState.EXECUTE
+        else:
+            self.state = ToolLoopState.DONE
+
+    async def _discard_follow_up(self) -> None:
+        """结束时丢弃尚未读取的后续请求：未完成的取消，已返回的流式响应关闭"""
+        task, self._follow_up_task = self._follow_up_task, None
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            await close_stream(task.result())
+
+    def _record_text(self, text: str) -> None:
+        """记录一次后续响应的文本"""
+        if text.strip():
+            self.interaction_flow.append({
+                "type": "text",
+                "content": text,
+                "timestamp": datetime.now().isoformat()
+            })
+        self._content_parts.append(text)
+        self._assistant_text = text
+
+    def _follow_up_failed(self, error: Exception):
+        """后续LLM请求失败：与工具执行失败一样处理，标记本次工具调用失败后继续下一个工具"""
+        api_logger.error(f"第 {self.iteration} 轮工具执行后获取AI响应失败: {error}")
+        for record in self._follow_up_records:
+            record["status"] = "failed"
+            record["completed_at"] = datetime.now().isoformat()
+            record["error"] = str(error)
+            yield ToolLoopEvent(ToolLoopEvent.STATUS, {
+                "type": "tool_call_failed",
+                "tool_call_id": record["id"],
+                "tool_name": record["name"],
+                "status": "failed",
+                "error": str(error)
+            })
+        self._follow_up_records = []
+
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.max_consecutive_failures:
+            api_logger.warning(f"连续工具调用失败 {self._consecutive_failures} 次，结束所有工具处理")
+            self.state = ToolLoopState.DONE
+        elif self._batch_pos < len(self._batch):
+            self.state = ToolLoopState.EXECUTE
+        else:
+            self.state = ToolLoopState.DONE
+
+
+async def _iter_tool_progress(tool_task: asyncio.Task, progress_queue: asyncio.Queue):
+    """在工具任务执行期间逐条产出其中间结果，任务结束后排空队列并返回"""
+    while not tool_task.done():
+        getter = asyncio.ensure_future(progress_queue.get())
+        try:
+            await asyncio.wait({tool_task, getter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not getter.done():
+                getter.cancel()
+        if getter.done() and not getter.cancelled():
+            yield getter.result()
+    while not progress_queue.empty():
+        yield progress_queue.get_nowait()
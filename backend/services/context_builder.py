@@ -0,0 +1,221 @@
+"""
+上下文窗口管理
+
+按模型的上下文窗口组装发送给LLM的消息：
+- 使用本地分词器统计token（安装了 tiktoken 时使用，否则使用兼顾中文的估算）
+- 扣除系统提示词、工具定义和预留的回复token后，从最新的对话轮次往前装入历史，
+  超出预算的最早轮次被丢弃
+- 返回准确的提示词token数，用于记录用量
+"""
+
+import json
+import math
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from backend.core.config import settings
+from backend.utils.logging import api_logger
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖，未安装时使用估算
+    tiktoken = None
+
+
+# 每条消息的格式开销，以及回复前缀的开销（参照OpenAI的计数方式）
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+# 图片按高清模式的典型开销估算
+IMAGE_TOKEN_ESTIMATE = 765
+
+# 中日韩字符（含全角标点），在常见分词器中基本每字一个token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+    except Exception:
+        return None
+
+
+class TokenCounter:
+    """token计数器"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = _get_encoding(model)
+
+    @property
+    def exact(self) -> bool:
+        """是否使用真实分词器"""
+        return self._encoding is not None
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        cjk = len(_CJK_PATTERN.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        tokens = MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "text":
+                    tokens += self.count_text(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    tokens += IMAGE_TOKEN_ESTIMATE
+        if message.get("name"):
+            tokens += 1
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            tokens += self.count_text(function.get("name", "")) + self.count_text(function.get("arguments", ""))
+        return tokens
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(m) for m in messages) + REPLY_PRIMING_TOKENS
+
+    def count_tools(self, tools: Optional[List[Dict[str, Any]]]) -> int:
+        if not tools:
+            return 0
+        return self.count_text(json.dumps(tools, ensure_ascii=False, separators=(",", ":")))
+
+
+def _load_context_windows() -> Dict[str, int]:
+    if not settings.MODEL_CONTEXT_WINDOWS.strip():
+        return {}
+    try:
+        return {k: int(v) for k, v in json.loads(settings.MODEL_CONTEXT_WINDOWS).items()}
+    except (ValueError, AttributeError) as e:
+        api_logger.error(f"MODEL_CONTEXT_WINDOWS 配置格式错误: {e}")
+        return {}
+
+
+def split_turns(messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """按用户消息切分对话轮次，避免工具结果与其调用分离"""
+    turns: List[List[Dict[str, Any]]] = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+class ContextWindow:
+    """组装结果"""
+
+    def __init__(
+        self,
+        messages: List[Dict[str, Any]],
+        prompt_tokens: int,
+        tools_tokens: int,
+        max_tokens: int,
+        context_window: int,
+        history_budget: int,
+        dropped_messages: List[Dict[str, Any]]
+    ):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens  # 消息与工具定义合计
+        self.tools_tokens = tools_tokens
+        self.max_tokens = max_tokens  # 调整后的回复token上限
+        self.context_window = context_window
+        self.history_budget = history_budget  # 可用于历史对话的token预算
+        self.dropped_messages = dropped_messages
+
+
+class ContextBuilder:
+    """按token预算组装对话上下文"""
+
+    def __init__(self):
+        self._context_windows = _load_context_windows()
+
+    def context_window_for(self, model: str) -> int:
+        """获取模型的上下文窗口，支持按前缀匹配（最长前缀优先）"""
+        if model in self._context_windows:
+            return self._context_windows[model]
+        matches = [k for k in self._context_windows if model and model.startswith(k)]
+        if matches:
+            return self._context_windows[max(matches, key=len)]
+        return settings.DEFAULT_MODEL_CONTEXT_WINDOW
+
+    def counter(self, model: str) -> TokenCounter:
+        return TokenCounter(model)
+
+    def build(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        tools: Optional[List[Dict[str, Any]]] = None
+    ) -> ContextWindow:
+        """把消息装入模型的上下文窗口
+
+        开头的系统消息和最后一轮对话总是保留，其余历史按轮次（以用户消息开始）
+        从新到旧装入，装不下的最早轮次被丢弃；若仍超出窗口则压缩回复token上限。
+        """
+        counter = self.counter(model)
+        window = self.context_window_for(model)
+
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        system_messages = messages[:head]
+
+        turns = split_turns(messages[head:])
+
+        tools_tokens = counter.count_tools(tools)
+        fixed_tokens = tools_tokens + REPLY_PRIMING_TOKENS + sum(counter.count_message(m) for m in system_messages)
+        reserved = max(settings.CONTEXT_MIN_COMPLETION_TOKENS, min(max_tokens, window // 2))
+        budget = window - reserved - settings.CONTEXT_SAFETY_MARGIN - fixed_tokens
+
+        kept: List[List[Dict[str, Any]]] = []
+        used = 0
+        for index in range(len(turns) - 1, -1, -1):
+            turn_tokens = sum(counter.count_message(m) for m in turns[index])
+            if kept and used + turn_tokens > budget:
+                break
+            kept.append(turns[index])
+            used += turn_tokens
+        kept.reverse()
+
+        dropped_turns = len(turns) - len(kept)
+        dropped_messages = [m for turn in turns[:dropped_turns] for m in turn]
+        result_messages = system_messages + [m for turn in kept for m in turn]
+        prompt_tokens = fixed_tokens + used
+
+        # 提示词本身已接近窗口时压缩回复上限，避免请求超长
+        available = window - prompt_tokens - settings.CONTEXT_SAFETY_MARGIN
+        adjusted_max_tokens = max_tokens
+        if available < max_tokens:
+            adjusted_max_tokens = max(settings.CONTEXT_MIN_COMPLETION_TOKENS, available)
+            api_logger.warning(f"上下文接近窗口上限，回复token上限由 {max_tokens} 调整为 {adjusted_max_tokens}")
+
+        api_logger.info(
+            f"上下文组装完成: 模型={model}, 窗口={window}, 提示词token={prompt_tokens}"
+            f"（工具定义 {tools_tokens}）, 保留消息 {len(result_messages)} 条, 丢弃最早 {len(dropped_messages)} 条, "
+            f"计数方式={'tiktoken' if counter.exact else '估算'}"
+        )
+        return ContextWindow(
+            result_messages, prompt_tokens, tools_tokens, adjusted_max_tokens, window, max(budget, 0), dropped_messages
+        )
+
+
+# 创建全局上下文组装器实例
+context_builder = ContextBuilder()
@@ -0,0 +1,184 @@
+"""
+会话滚动摘要（动态上下文压缩）
+
+长会话的历史不再简单截断：每轮对话开始组装上下文后，在后台检查记忆中的历史
+占模型上下文预算的比例，超过阈值时把最早的轮次移出记忆，连同因超出记忆条数
+上限而移出的消息一起，增量折叠进该会话保存在Redis中的滚动摘要。
+组装上下文时，摘要以系统消息的形式放在被移出的轮次原来的位置。
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from backend.core.config import settings
+from backend.services.context_builder import ContextWindow, context_builder, split_turns
+from backend.services.memory import memory_service
+from backend.services.usage_service import usage_service
+from backend.utils.logging import api_logger
+
+
+SUMMARY_MESSAGE_PREFIX = "以下是本会话较早对话的摘要，请结合它理解后续对话："
+
+SUMMARY_SYSTEM_PROMPT = """你负责维护一段对话的滚动摘要。根据已有摘要和新移出的对话内容，输出更新后的完整摘要。
+
+要求：
+1. 保留用户的目标、偏好、约束以及已确认的事实和结论
+2. 保留仍未解决的问题和待办事项
+3. 保留关键的名称、数字、代码标识符等细节
+4. 删除寒暄和重复内容，使用与对话相同的语言
+5. 直接输出摘要正文，不要添加标题或说明"""
+
+# 对话内容中单条消息的长度上限（字符），避免个别超长消息占满摘要请求
+MAX_MESSAGE_CHARS = 4000
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                parts.append(part.get("text", ""))
+            elif isinstance(part, dict) and part.get("type") == "image_url":
+                parts.append("[图片]")
+        content = " ".join(parts)
+    content = str(content or "")
+    if len(content) > MAX_MESSAGE_CHARS:
+        content = content[:MAX_MESSAGE_CHARS] + "…"
+    return content
+
+
+def _format_transcript(messages: List[Dict[str, Any]]) -> str:
+    role_names = {"user": "用户", "assistant": "助手", "tool": "工具"}
+    return "\n".join(
+        f"{role_names.get(m.get('role'), m.get('role', ''))}: {_message_text(m)}"
+        for m in messages
+    )
+
+
+class ConversationSummarizer:
+    """会话滚动摘要服务"""
+
+    def __init__(self):
+        # 每个会话同时只运行一个摘要任务
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return settings.CONVERSATION_SUMMARY_ENABLED
+
+    def inject(self, session_id: Optional[str], messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """在开头的系统消息之后插入会话摘要"""
+        if not self.enabled or not session_id:
+            return messages
+        summary = memory_service.get_summary(session_id)
+        if not summary:
+            return messages
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        summary_message = {"role": "system", "content": f"{SUMMARY_MESSAGE_PREFIX}\n{summary}"}
+        return messages[:head] + [summary_message] + messages[head:]
+
+    def schedule(self, session_id: Optional[str], model: str, context: ContextWindow) -> None:
+        """本轮上下文组装完成后，在后台折叠超出预算的历史"""
+        if not self.enabled or not session_id:
+            return
+        running = self._tasks.get(session_id)
+        if running is not None and not running.done():
+            return
+        task = asyncio.create_task(
+            self._run(session_id, model, context.history_budget),
+            name=f"conversation-summary-{session_id}"
+        )
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda t: self._forget(session_id, t))
+
+    def _forget(self, session_id: str, task: asyncio.Task) -> None:
+        if self._tasks.get(session_id) is task:
+            del self._tasks[session_id]
+
+    def _evict_old_turns(self, session_id: str, model: str, history_budget: int) -> int:
+        """历史超过触发比例时，把最早的轮次移出记忆，返回移出的消息数"""
+        messages = memory_service.get_messages(session_id)
+        if not messages or history_budget <= 0:
+            return 0
+        counter = context_builder.counter(model)
+        turns = split_turns(messages)
+        turn_tokens = [sum(counter.count_message(m) for m in turn) for turn in turns]
+        total = sum(turn_tokens)
+        if total <= history_budget * settings.CONVERSATION_SUMMARY_TRIGGER_RATIO:
+            return 0
+
+        target = history_budget * settings.CONVERSATION_SUMMARY_TARGET_RATIO
+        evictable_turns = max(0, len(turns) - settings.CONVERSATION_SUMMARY_KEEP_TURNS)
+        evict_count = 0
+        for index in range(evictable_turns):
+            if total <= target:
+                break
+            total -= turn_tokens[index]
+            evict_count += len(turns[index])
+        if evict_count:
+            memory_service.evict_oldest_messages(session_id, evict_count)
+        return evict_count
+
+    def _next_chunk(self, pending: List[Dict[str, Any]], model: str) -> List[Dict[str, Any]]:
+        """取出单次摘要请求能容纳的消息（至少一条）"""
+        counter = context_builder.counter(model)
+        chunk: List[Dict[str, Any]] = []
+        used = 0
+        for message in pending:
+            tokens = counter.count_text(_message_text(message))
+            if chunk and used + tokens > settings.CONVERSATION_SUMMARY_CHUNK_TOKENS:
+                break
+            chunk.append(message)
+            used += tokens
+        return chunk
+
+    async def _summarize(self, model: str, summary: Optional[str], messages: List[Dict[str, Any]]) -> Optional[str]:
+        from backend.services.openai_client import openai_client_service
+
+        prompt = f"已有摘要：\n{summary or '（无）'}\n\n新移出的对话：\n{_format_transcript(messages)}"
+        response = await openai_client_service.create_chat_completion(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=settings.CONVERSATION_SUMMARY_MAX_TOKENS,
+            temperature=0.3,
+            stream=False
+        )
+        content = response.choices[0].message.content if response.choices else None
+        return content.strip() if content else None
+
+    async def _run(self, session_id: str, model: str, history_budget: int) -> None:
+        summary_model = settings.CONVERSATION_SUMMARY_MODEL or model
+        # 摘要请求的用量不计入触发它的消息
+        usage_service.detach()
+        try:
+            evicted = self._evict_old_turns(session_id, model, history_budget)
+            folded = 0
+            # 逐块折叠待摘要消息；摘要保存成功后才从队列移除，失败的消息留待下一轮
+            while True:
+                pending = memory_service.peek_overflow(session_id)
+                if not pending:
+                    break
+                chunk = self._next_chunk(pending, summary_model)
+                summary = await self._summarize(summary_model, memory_service.get_summary(session_id), chunk)
+                if not summary:
+                    api_logger.warning(f"会话摘要生成结果为空: session_id={session_id}")
+                    break
+                memory_service.save_summary(session_id, summary)
+                memory_service.discard_overflow(session_id, len(chunk))
+                folded += len(chunk)
+            if evicted or folded:
+                api_logger.info(f"会话摘要已更新: session_id={session_id}, 移出记忆 {evicted} 条, 折叠 {folded} 条")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            api_logger.error(f"更新会话摘要失败: session_id={session_id}, 错误: {e}")
+
+
+# 创建全局会话摘要服务实例
+conversation_summarizer = ConversationSummarizer()
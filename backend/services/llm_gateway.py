@@ -0,0 +1,330 @@
+"""
+LLM网关
+
+在多个OpenAI兼容端点之间路由对话补全请求：
+- 按模型筛选端点，根据首字延迟（TTFT）和错误率的指数滑动平均排序
+- 每个端点独立限制并发数
+- 流式请求在向调用方返回任何内容之前失败时，自动切换到下一个端点
+- 统计各端点提示词token中命中上游缓存的比例
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from backend.services.usage_service import usage_service
+from backend.utils.logging import api_logger
+
+
+# 滑动平均的平滑系数
+EWMA_ALPHA = 0.3
+# 错误率对得分的放大倍数
+ERROR_PENALTY = 4.0
+# 连续失败达到该次数后进入冷却
+COOLDOWN_FAILURES = 3
+
+
+class LLMEndpoint:
+    """单个OpenAI兼容端点及其运行统计"""
+
+    def __init__(
+        self,
+        name: str,
+        client: AsyncOpenAI,
+        models: Optional[Iterable[str]] = None,
+        max_concurrency: int = 32,
+        cooldown: float = 30.0
+    ):
+        self.name = name
+        self.client = client
+        self.models = set(models or [])  # 为空表示支持所有模型
+        self.max_concurrency = max_concurrency
+        self.cooldown = cooldown
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        # 统计信息
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ttft_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.last_failure_at = 0.0
+        # 上游提示词缓存统计
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def supports(self, model: Optional[str]) -> bool:
+        return not self.models or model in self.models
+
+    @property
+    def busy(self) -> bool:
+        return self.inflight >= self.max_concurrency
+
+    def cooling_down(self, now: float) -> bool:
+        return self.consecutive_failures >= COOLDOWN_FAILURES and now - self.last_failure_at < self.cooldown
+
+    def score(self) -> float:
+        """路由得分，越小越优先；尚无测量数据的端点优先探测"""
+        if self.ttft_ewma is None:
+            return 0.0
+        load = self.inflight / self.max_concurrency
+        return self.ttft_ewma * (1 + ERROR_PENALTY * self.error_ewma) * (1 + load)
+
+    async def acquire(self, timeout: Optional[float] = None) -> None:
+        if timeout is None:
+            await self._semaphore.acquire()
+        else:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        self.inflight += 1
+        self.requests += 1
+
+    def release(self) -> None:
+        self.inflight -= 1
+        self._semaphore.release()
+
+    def record_success(self, ttft: float) -> None:
+        self.consecutive_failures = 0
+        self.ttft_ewma = ttft if self.ttft_ewma is None else EWMA_ALPHA * ttft + (1 - EWMA_ALPHA) * self.ttft_ewma
+        self.error_ewma = (1 - EWMA_ALPHA) * self.error_ewma
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure_at = time.monotonic()
+        self.error_ewma = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_ewma
+
+    def record_usage(self, usage: Any) -> None:
+        """记录响应中的提示词token及其中命中上游缓存的部分，并计入当前生成的用量"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        cached = _cached_tokens(usage)
+        usage_service.record(usage, cached)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached
+        if prompt_tokens:
+            api_logger.debug(f"LLM端点 {self.name} 提示词token: {prompt_tokens}, 命中缓存: {cached} ({cached * 100 // prompt_tokens}%)")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": str(self.client.base_url),
+            "models": sorted(self.models),
+            "inflight": self.inflight,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ttft_ewma": round(self.ttft_ewma, 3) if self.ttft_ewma is not None else None,
+            "error_rate": round(self.error_ewma, 3),
+            "cooling_down": self.cooling_down(time.monotonic()),
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_rate": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None,
+        }
+
+
+def _cached_tokens(usage: Any) -> int:
+    """读取 usage.prompt_tokens_details.cached_tokens，兼容对象和字典"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None and isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details")
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def _is_retryable(error: Exception) -> bool:
+    """连接错误、超时、限流和服务端错误可以切换端点重试，请求本身的错误不重试
+
+    流式响应读取过程中连接中断时SDK直接抛出httpx的传输错误。
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def _has_payload(chunk) -> bool:
+    """数据块是否包含需要发给调用方的内容"""
+    if not getattr(chunk, "choices", None):
+        return False
+    delta = chunk.choices[0].delta
+    return bool(
+        getattr(delta, "content", None)
+        or getattr(delta, "tool_calls", None)
+        or getattr(delta, "reasoning_content", None)
+        or chunk.choices[0].finish_reason
+    )
+
+
+class LLMGateway:
+    """多端点LLM网关"""
+
+    def __init__(self, endpoints: List[LLMEndpoint], queue_timeout: float = 30.0):
+        if not endpoints:
+            raise ValueError("LLM网关至少需要一个端点")
+        self.endpoints = endpoints
+        self.queue_timeout = queue_timeout
+
+    def candidates(self, model: Optional[str]) -> List[LLMEndpoint]:
+        """按路由得分排序的候选端点，冷却中的端点排在最后"""
+        matched = [e for e in self.endpoints if e.supports(model)] or list(self.endpoints)
+        now = time.monotonic()
+        return sorted(matched, key=lambda e: (e.cooling_down(now), e.score()))
+
+    async def create_chat_completion(self, **params) -> Any:
+        """发起对话补全，失败时依次切换端点
+
+        非流式请求返回完整响应；流式请求返回异步迭代器，
+        首个有效数据块到达之前的任何可重试错误都会切换到下一个端点。
+        """
+        stream = bool(params.get("stream"))
+        remaining = self.candidates(params.get("model"))
+        last_error: Optional[Exception] = None
+
+        while remaining:
+            # 优先选择未满载的端点，全部满载时排队等待得分最优的端点
+            endpoint = next((e for e in remaining if not e.busy), remaining[0])
+            remaining.remove(endpoint)
+            try:
+                await endpoint.acquire(self.queue_timeout)
+            except asyncio.TimeoutError:
+                api_logger.warning(f"LLM端点 {endpoint.name} 并发已满，等待超时")
+                last_error = last_error or RuntimeError(f"LLM端点 {endpoint.name} 并发已满")
+                continue
+
+            started = time.monotonic()
+            response = None
+            try:
+                response = await endpoint.client.chat.completions.create(**params)
+                if not stream:
+                    endpoint.record_success(time.monotonic() - started)
+                    endpoint.record_usage(getattr(response, "usage", None))
+                    endpoint.release()
+                    return response
+
+                buffered = []
+                exhausted = False
+                try:
+                    while True:
+                        chunk = await response.__anext__()
+                        buffered.append(chunk)
+                        if _has_payload(chunk):
+                            break
+                except StopAsyncIteration:
+                    exhausted = True
+                endpoint.record_success(time.monotonic() - started)
+                return GatewayStream(endpoint, response, buffered, exhausted)
+            except Exception as e:
+                endpoint.release()
+                await close_stream(response)
+                if not _is_retryable(e):
+                    # 请求本身的错误（如上下文超长、内容过滤）与端点健康无关，不计入失败
+                    raise
+                endpoint.record_failure()
+                api_logger.warning(f"LLM端点 {endpoint.name} 请求失败，尝试切换端点: {e}")
+                last_error = e
+            except BaseException:
+                # 调用方取消
+                endpoint.release()
+                await close_stream(response)
+                raise
+
+        raise last_error or RuntimeError("没有可用的LLM端点")
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        return [e.get_stats() for e in self.endpoints]
+
+
+class GatewayStream:
+    """网关返回的流式响应
+
+    转发端点的数据块，读完、出错或关闭时释放端点的并发名额并关闭上游响应。
+    调用方不再读取时应调用 aclose()；即使从未开始迭代，关闭后名额也会释放。
+    """
+
+    def __init__(self, endpoint: LLMEndpoint, response, buffered: List[Any], exhausted: bool):
+        self._endpoint = endpoint
+        self._response = response
+        self._buffered = deque(buffered)
+        self._exhausted = exhausted
+        self._released = False
+
+    def __aiter__(self) -> "GatewayStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._buffered:
+            chunk = self._buffered.popleft()
+        elif self._exhausted or self._released:
+            await self.aclose()
+            raise StopAsyncIteration
+        else:
+            try:
+                chunk = await self._response.__anext__()
+            except StopAsyncIteration:
+                await self.aclose()
+                raise
+            except Exception as e:
+                # 内容已经发出，无法再切换端点，只记录端点错误
+                if _is_retryable(e):
+                    self._endpoint.record_failure()
+                await self.aclose()
+                raise
+            except BaseException:
+                # 调用方取消
+                await self.aclose()
+                raise
+        # 开启 include_usage 时用量在最后一个数据块中返回
+        self._endpoint.record_usage(getattr(chunk, "usage", None))
+        return chunk
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._endpoint.release()
+
+    async def aclose(self) -> None:
+        """释放并发名额并关闭上游响应（可重复调用）"""
+        self._release()
+        self._buffered.clear()
+        response, self._response = self._response, None
+        await close_stream(response)
+
+    async def close(self) -> None:
+        """与 openai.AsyncStream.close 兼容"""
+        await self.aclose()
+
+    def __del__(self):
+        # 调用方既没有读完也没有关闭就丢弃了响应
+        if self._released:
+            return
+        self._release()
+        api_logger.warning(f"LLM端点 {self._endpoint.name} 的流式响应未关闭就被丢弃")
+        if self._response is not None:
+            try:
+                asyncio.get_running_loop().create_task(close_stream(self._response))
+            except RuntimeError:
+                pass
+
+
+async def close_stream(response) -> None:
+    """关闭流式响应（GatewayStream 或 openai.AsyncStream），非流式响应直接忽略"""
+    close = getattr(response, "aclose", None) or getattr(response, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        api_logger.debug(f"关闭LLM响应流失败: {e}")
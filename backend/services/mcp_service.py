@@ -6,7 +6,7 @@ MCP服务管理器
 """
 
 import asyncio
-from typing import Dict, List, Optional, Any, Union
+from typing import Callable, Dict, List, Optional, Any, Tuple, Union
 from backend.mcp.schemas.protocol import Tool, Resource, Prompt, ToolResult, ResourceContent, PromptResult
 
 from backend.core.config import settings
@@ -26,6 +26,8 @@ class MCPService:
     def __init__(self):
         self.session_manager = MCPSessionManager()
         self._initialized = False
+        # 聊天工具列表缓存：user_id -> (工具版本, 工具列表)，工具版本变化后重新生成
+        self._chat_tools_cache: Dict[Optional[int], Tuple[Tuple[int, ...], List[Dict[str, Any]]]] = {}
     
     async def initialize(self, user_id: int = None) -> None:
         """初始化MCP服务"""
@@ -155,6 +157,7 @@ class MCPService:
         if not self.is_enabled():
             raise MCPError("MCP服务未启用")
             
+        server = None
         # 如果传入的是public_id，需要转换为数据库ID
         if server_id.startswith("mcp-"):
             async for db in get_async_session():
@@ -194,7 +197,12 @@ class MCPService:
                         raise MCPError(f"服务器不存在或无权限访问: {db_id}")
                     break
             
-        await self.session_manager.reconnect_server(db_id)
+        # 使用数据库中的最新配置重连；未查询到时使用连接池中记录的配置
+        await self.session_manager.reconnect_server(
+            db_id,
+            server.to_config_dict() if server else None,
+            user_id=server.user_id if server else None
+        )
     
     # 用户级别的服务器管理方法
     async def get_user_servers(self, user_id: int, skip: int = 0, limit: int = 100) -> List[MCPServer]:
@@ -228,9 +236,10 @@ class MCPService:
             # 如果启用了自动启动，立即连接
             if server.enabled and server.auto_start and self.is_enabled():
                 try:
-                    await self.session_manager.add_server(server.id, server.to_config_dict())
+                    await self.session_manager.add_server(server.id, server.to_config_dict(), user_id=user_id)
                 except Exception as e:
                     logger.error(f"连接新创建的服务器失败 ID {server.id}: {e}")
+            self.session_manager.invalidate_user(user_id)
             
             return server
             break
@@ -250,9 +259,6 @@ class MCPService:
                 if not server:
                     raise MCPError(f"服务器不存在: ID {server_id}")
                 
-                old_enabled = server.enabled
-                old_config = server.to_config_dict()
-                
                 # 更新服务器配置
                 for key, value in update_data.items():
                     if hasattr(server, key):
@@ -276,22 +282,15 @@ class MCPService:
                 # 如果MCP服务已启用，同步更新会话管理器
                 if self.is_enabled():
                     try:
-                        # 如果启用状态改变
-                        if "enabled" in update_data:
-                            if update_data["enabled"] and server.auto_start:
-                                # 启用服务器
-                                await self.session_manager.add_server(server.id, server.to_config_dict())
-                            elif not update_data["enabled"]:
-                                # 禁用服务器
-                                await self.session_manager.remove_server(server.id)
-                        # 如果其他配置改变且服务器已启用
-                        elif old_enabled and server.enabled:
-                            # 重新连接服务器
+                        if server.enabled and server.auto_start:
+                            # 配置指纹未变时复用已有连接，变化时自动重连
+                            await self.session_manager.add_server(server.id, server.to_config_dict(), user_id=user_id)
+                        else:
+                            # 禁用或取消自动启动
                             await self.session_manager.remove_server(server.id)
-                            if server.auto_start:
-                                await self.session_manager.add_server(server.id, server.to_config_dict())
                     except Exception as e:
                         logger.error(f"同步会话管理器失败 ID {server.id}: {e}")
+                    self.session_manager.invalidate_user(user_id)
                 
                 logger.info(f"成功更新用户服务器: user_id={user_id}, server_id={server_id}, server={server}")
                 return server
@@ -326,6 +325,7 @@ class MCPService:
                         await self.session_manager.remove_server(server.id)
                     except Exception as e:
                         logger.error(f"从会话管理器移除服务器失败 ID {server.id}: {e}")
+                    self.session_manager.invalidate_user(user_id)
                 
                 # 删除数据库记录
                 await db.delete(server)
@@ -383,12 +383,13 @@ class MCPService:
                     try:
                         if server.enabled and server.auto_start:
                             # 启用服务器
-                            await self.session_manager.add_server(server.id, server.to_config_dict())
+                            await self.session_manager.add_server(server.id, server.to_config_dict(), user_id=user_id)
                         elif not server.enabled:
                             # 禁用服务器
                             await self.session_manager.remove_server(server.id)
                     except Exception as e:
                         logger.error(f"同步会话管理器失败 ID {server.id}: {e}")
+                    self.session_manager.invalidate_user(user_id)
                 
                 result_data = {
                     "server": server,
@@ -521,9 +522,10 @@ class MCPService:
                     try:
                         server = await mcp_server.get_by_name(db, name=server_name, user_id=user_id)
                         if server and server.enabled and server.auto_start:
-                            await self.session_manager.add_server(server.name, server.to_config_dict())
+                            await self.session_manager.add_server(server.id, server.to_config_dict(), user_id=user_id)
                     except Exception as e:
                         logger.error(f"连接导入的服务器失败 {server_name}: {e}")
+                self.session_manager.invalidate_user(user_id)
             
             return results
             break
@@ -569,7 +571,12 @@ class MCPService:
             logger.error(f"加载系统默认MCP服务器配置失败: {e}")
     
     # 工具调用相关方法（保持不变）
-    async def list_tools(self, server_name: Optional[str] = None, force_refresh: bool = False) -> Union[List[Tool], Dict[str, List[Tool]]]:
+    async def list_tools(
+        self,
+        server_name: Optional[str] = None,
+        force_refresh: bool = False,
+        user_id: Optional[int] = None
+    ) -> Union[List[Tool], Dict[str, List[Tool]]]:
         """列出可用工具"""
         if not self.is_enabled():
             raise MCPError("MCP服务未启用")
@@ -579,10 +586,13 @@ class MCPService:
             client = self.session_manager.get_client(server_name)
             if not client:
                 raise MCPError(f"服务器不存在: {server_name}")
-            return await client.list_tools(force_refresh)
+            tools = await client.list_tools(force_refresh)
+            if force_refresh:
+                self.session_manager.invalidate_tools(server_name)
+            return tools
         else:
-            # 获取所有服务器的工具
-            return await self.session_manager.list_all_tools(force_refresh)
+            # 获取用户可见服务器（未指定用户时为所有服务器）的工具
+            return await self.session_manager.list_all_tools(force_refresh, user_id=user_id)
     
     async def list_resources(self, server_name: Optional[str] = None, force_refresh: bool = False) -> Union[List[Resource], Dict[str, List[Resource]]]:
         """列出可用资源"""
@@ -614,19 +624,27 @@ class MCPService:
             # 获取所有服务器的提示
             return await self.session_manager.list_all_prompts(force_refresh)
     
-    async def call_tool(self, server_name: str, tool_name: str, arguments: Dict[str, Any] = None) -> ToolResult:
-        """调用指定服务器的工具"""
+    async def call_tool(
+        self,
+        server_name: str,
+        tool_name: str,
+        arguments: Dict[str, Any] = None,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> ToolResult:
+        """调用指定服务器的工具，progress_callback用于接收服务器的进度通知"""
         if not self.is_enabled():
             raise MCPError("MCP服务未启用")
-        return await self.session_manager.call_tool(server_name, tool_name, arguments or {})
+        return await self.session_manager.call_tool(
+            server_name, tool_name, arguments or {}, progress_callback=progress_callback
+        )
     
-    async def call_tool_auto(self, tool_name: str, arguments: Dict[str, Any] = None) -> ToolResult:
-        """自动选择服务器调用工具"""
+    async def call_tool_auto(self, tool_name: str, arguments: Dict[str, Any] = None, user_id: Optional[int] = None) -> ToolResult:
+        """自动选择服务器调用工具（在用户可见的服务器中按工具索引查找）"""
         if not self.is_enabled():
             raise MCPError("MCP服务未启用")
         
         # 查找工具所在的服务器
-        result = await self.session_manager.find_tool(tool_name)
+        result = await self.session_manager.find_tool(tool_name, user_id=user_id)
         if not result:
             raise MCPError(f"未找到工具: {tool_name}")
         
@@ -672,55 +690,49 @@ class MCPService:
         return await self.session_manager.get_prompt(server_name, prompt_name, arguments or {})
     
     # 聊天集成方法（保持不变）
-    async def get_available_tools_for_chat(self) -> List[Dict[str, Any]]:
-        """获取可用于聊天的工具列表 - 返回原生MCP格式"""
+    async def get_available_tools_for_chat(self, user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """获取可用于聊天的工具列表 - 返回原生MCP格式
+        
+        传入user_id时只包含该用户自己的服务器和系统级服务器的工具。
+        """
         if not self.is_enabled():
             return []
         
+        version = self.session_manager.get_tools_version(user_id)
+        cached = self._chat_tools_cache.get(user_id)
+        if cached is not None and cached[0] == version:
+            return list(cached[1])
+        
         try:
-            tools = await self.list_tools()
+            all_tools, status = await self.session_manager.list_all_tools_with_status(user_id=user_id)
             
-            # 如果返回的是字典（按服务器分组），需要展平
-            if isinstance(tools, dict):
-                all_tools = []
-                for server_name, server_tools in tools.items():
-                    for tool in server_tools:
-                        # 返回标准OpenAI MCP格式
-                        tool_info = {
-                            "type": "mcp",
-                            "mcp": {
-                                "server": server_name,
-                                "tool": {
-                                    "name": tool.name,
-                                    "description": tool.description,
-                                    "inputSchema": tool.inputSchema.model_dump() if hasattr(tool.inputSchema, 'model_dump') else tool.inputSchema.__dict__
-                                }
-                            }
-                        }
-                        all_tools.append(tool_info)
-                return all_tools
-            else:
-                # 如果是列表，直接转换
-                return [
-                    {
+            chat_tools = []
+            for server_name, server_tools in all_tools.items():
+                for tool in server_tools:
+                    # 返回标准OpenAI MCP格式
+                    chat_tools.append({
                         "type": "mcp",
                         "mcp": {
-                            "server": "unknown",
+                            "server": server_name,
                             "tool": {
                                 "name": tool.name,
                                 "description": tool.description,
                                 "inputSchema": tool.inputSchema.model_dump() if hasattr(tool.inputSchema, 'model_dump') else tool.inputSchema.__dict__
                             }
                         }
-                    }
-                    for tool in tools
-                ]
+                    })
+            
+            # 有服务器获取失败或期间工具发生变化时不缓存
+            complete = all(item["status"] in ("ok", "disconnected") for item in status.values())
+            if complete and self.session_manager.get_tools_version(user_id) == version:
+                self._chat_tools_cache[user_id] = (version, chat_tools)
+            return list(chat_tools)
                 
         except Exception as e:
             logger.error(f"获取可用工具失败: {e}")
             return []
     
-    async def execute_mcp_tool_for_chat(self, tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    async def execute_mcp_tool_for_chat(self, tool_name: str, arguments: Dict[str, Any], user_id: Optional[int] = None) -> Dict[str, Any]:
         """为聊天执行MCP工具调用"""
         if not self.is_enabled():
             return {
@@ -731,7 +743,7 @@ class MCPService:
         
         try:
             # 尝试自动调用工具
-            result = await self.call_tool_auto(tool_name, arguments)
+            result = await self.call_tool_auto(tool_name, arguments, user_id=user_id)
             
             return {
                 "success": True,
@@ -761,12 +773,23 @@ class MCPService:
                 "details": status
             }
         
-        connected_ratio = status["connected_count"] / max(status["server_count"], 1)
+        # 已连接且未熔断的服务器才算可用
+        servers = status.get("servers", {})
+        open_count = sum(1 for s in servers.values() if s.get("health", {}).get("breaker") == "open")
+        available_count = sum(
+            1 for s in servers.values()
+            if s.get("connected", False) and s.get("health", {}).get("breaker") != "open"
+        )
+        available_ratio = available_count / max(status["server_count"], 1)
         
         return {
-            "healthy": connected_ratio > 0.5,  # 至少一半的服务器连接正常
-            "message": f"已连接 {status['connected_count']}/{status['server_count']} 个服务器",
-            "details": status
+            "healthy": available_ratio > 0.5,  # 至少一半的服务器可用
+            "message": f"已连接 {status['connected_count']}/{status['server_count']} 个服务器，熔断 {open_count} 个",
+            "details": status,
+            "servers": {
+                str(server_id): metrics
+                for server_id, metrics in self.session_manager.health.get_all_metrics().items()
+            }
         }
 
     async def ensure_user_servers_loaded(self, user_id: int) -> None:
@@ -31,6 +31,14 @@ class MemoryService:
         """生成Redis中记忆的key"""
         return f"memory:session:{session_id}"
         
+    def _get_overflow_key(self, session_id: str) -> str:
+        """生成待摘要消息队列的key（超出记忆窗口、尚未折叠进摘要的消息）"""
+        return f"memory:overflow:{session_id}"
+    
+    def _get_summary_key(self, session_id: str) -> str:
+        """生成会话摘要的key"""
+        return f"memory:summary:{session_id}"
+        
     def _get_user_memories_key(self, user_id: int) -> str:
         """生成用户记忆索引的Redis键名"""
         return f"memory:user:{user_id}"
@@ -65,8 +73,9 @@ class MemoryService:
         try:
             key = self._get_key(session_id)
             
-            # 限制消息数量
+            # 限制消息数量，超出的消息转入待摘要队列
             if len(messages) > self.max_messages:
+                self._stash_overflow(session_id, messages[:-self.max_messages])
                 messages = messages[-self.max_messages:]
                 
             # 保存到Redis
@@ -75,6 +84,62 @@ class MemoryService:
             api_logger.error(f"保存消息到Redis失败: {str(e)}", exc_info=True)
             # 即使保存失败也不抛出异常，允许应用继续运行
     
+    def _stash_overflow(self, session_id: str, messages: List[Dict[str, Any]]):
+        """将移出记忆的消息追加到待摘要队列"""
+        if not messages or not settings.CONVERSATION_SUMMARY_ENABLED:
+            return
+        key = self._get_overflow_key(session_id)
+        pipe = self.redis.pipeline()
+        pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+    
+    def evict_oldest_messages(self, session_id: str, count: int) -> int:
+        """将最早的若干条消息移出记忆并转入待摘要队列，返回移出的数量"""
+        try:
+            messages = self._get_messages_from_redis(session_id)
+            count = min(count, len(messages))
+            if count <= 0:
+                return 0
+            self._stash_overflow(session_id, messages[:count])
+            self.redis.set(self._get_key(session_id), json.dumps(messages[count:]), ex=self.ttl)
+            api_logger.debug(f"会话 {session_id} 移出 {count} 条最早的消息等待摘要")
+            return count
+        except Exception as e:
+            api_logger.error(f"移出记忆消息失败: {str(e)}", exc_info=True)
+            return 0
+    
+    def peek_overflow(self, session_id: str, limit: int = -1) -> List[Dict[str, Any]]:
+        """读取待摘要队列中的消息（不移除）"""
+        try:
+            end = -1 if limit < 0 else limit - 1
+            return [json.loads(item) for item in self.redis.lrange(self._get_overflow_key(session_id), 0, end)]
+        except Exception as e:
+            api_logger.error(f"读取待摘要消息失败: {str(e)}", exc_info=True)
+            return []
+    
+    def discard_overflow(self, session_id: str, count: int):
+        """移除待摘要队列开头已折叠进摘要的消息"""
+        try:
+            self.redis.ltrim(self._get_overflow_key(session_id), count, -1)
+        except Exception as e:
+            api_logger.error(f"移除待摘要消息失败: {str(e)}", exc_info=True)
+    
+    def get_summary(self, session_id: str) -> Optional[str]:
+        """获取会话的滚动摘要"""
+        try:
+            return self.redis.get(self._get_summary_key(session_id))
+        except Exception as e:
+            api_logger.error(f"获取会话摘要失败: {str(e)}", exc_info=True)
+            return None
+    
+    def save_summary(self, session_id: str, summary: str):
+        """保存会话的滚动摘要"""
+        try:
+            self.redis.set(self._get_summary_key(session_id), summary, ex=self.ttl)
+        except Exception as e:
+            api_logger.error(f"保存会话摘要失败: {str(e)}", exc_info=True)
+    
     def _register_memory_to_user(self, user_id: int, session_id: str):
         """将记忆关联到用户，用于用户记忆管理"""
         try:
@@ -174,7 +239,7 @@ class MemoryService:
         """清空指定会话的记忆"""
         try:
             key = self._get_key(session_id)
-            self.redis.delete(key)
+            self.redis.delete(key, self._get_overflow_key(session_id), self._get_summary_key(session_id))
             api_logger.info(f"已清空会话 {session_id} 的记忆")
         except Exception as e:
             api_logger.error(f"清空记忆失败: {e}")
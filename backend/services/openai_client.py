@@ -1,61 +1,175 @@
+import importlib.util
+import json
+from typing import Any, List, Optional
+
+import httpx
 from openai import OpenAI, AsyncOpenAI
 from backend.core.config import settings
 from backend.utils.logging import api_logger
+from backend.services.llm_gateway import LLMEndpoint, LLMGateway
+
+
+def _http2_available() -> bool:
+    """HTTP/2 需要安装 h2，未安装时退回 HTTP/1.1"""
+    return settings.LLM_HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+
+
+def _llm_limits() -> httpx.Limits:
+    """LLM调用的连接池限制"""
+    return httpx.Limits(
+        max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY
+    )
+
+
+def _llm_timeout() -> httpx.Timeout:
+    """LLM调用的超时设置，读超时按流式响应的块间隔设置"""
+    return httpx.Timeout(
+        connect=settings.LLM_HTTP_CONNECT_TIMEOUT,
+        read=settings.LLM_HTTP_READ_TIMEOUT,
+        write=settings.LLM_HTTP_WRITE_TIMEOUT,
+        pool=settings.LLM_HTTP_POOL_TIMEOUT
+    )
+
+
+def normalize_base_url(base_url: str) -> str:
+    """确保base_url以/v1结尾"""
+    if base_url and not base_url.endswith('/v1'):
+        base_url = base_url.rstrip() + '/v1'
+    return base_url
 
 
 class OpenAIClientService:
-    """OpenAI客户端服务"""
-    
+    """OpenAI客户端服务
+
+    所有LLM调用共享同一个调优过的HTTP连接池，并发对话复用已建立的连接。
+    """
+
     def __init__(self):
         self._client = None
         self._async_client = None
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._gateway: Optional[LLMGateway] = None
         self._initialize_clients()
-    
+
     def _initialize_clients(self):
         """初始化OpenAI客户端"""
         # 获取配置并进行调整
         api_key = settings.OPENAI_API_KEY
-        base_url = settings.OPENAI_BASE_URL
         model = settings.OPENAI_MODEL
-        
-        # 确保base_url以/v1结尾
-        if base_url and not base_url.endswith('/v1'):
-            base_url = base_url.rstrip() + '/v1'
+        base_url = normalize_base_url(settings.OPENAI_BASE_URL)
+        if base_url != settings.OPENAI_BASE_URL:
             api_logger.info(f"修正后的BASE URL: {base_url}")
-        
+
         # 打印OpenAI配置信息
         api_logger.info(f"OpenAI配置 - API KEY: {api_key[:5]}*****, BASE URL: {base_url}, 模型: {model}")
-        
+
+        # 共享的异步HTTP连接池
+        http2 = _http2_available()
+        self._http_client = httpx.AsyncClient(
+            limits=_llm_limits(),
+            timeout=_llm_timeout(),
+            http2=http2,
+            follow_redirects=True
+        )
+
         # 配置OpenAI客户端
         self._client = OpenAI(
             api_key=api_key,
-            base_url=base_url
+            base_url=base_url,
+            http_client=httpx.Client(limits=_llm_limits(), timeout=_llm_timeout(), follow_redirects=True)
         )
-        
+
         # 配置异步OpenAI客户端
-        self._async_client = AsyncOpenAI(
-            api_key=api_key,
-            base_url=base_url
+        self._async_client = self.create_async_client(api_key, base_url)
+
+        # 多端点网关
+        self._gateway = LLMGateway(
+            self._build_endpoints(api_key),
+            queue_timeout=settings.LLM_GATEWAY_QUEUE_TIMEOUT
         )
-        
+
         # 打印客户端信息
-        api_logger.info(f"OpenAI客户端初始化完成 - 同步客户端: {self._client.base_url}, 异步客户端: {self._async_client.base_url}")
-    
+        api_logger.info(
+            f"OpenAI客户端初始化完成 - 同步客户端: {self._client.base_url}, 异步客户端: {self._async_client.base_url}, "
+            f"最大连接数: {settings.LLM_HTTP_MAX_CONNECTIONS}, HTTP/2: {http2}, "
+            f"网关端点: {[e.name for e in self._gateway.endpoints]}"
+        )
+
+    def _build_endpoints(self, api_key: str) -> List[LLMEndpoint]:
+        """根据 LLM_ENDPOINTS 构建网关端点，未配置时只使用默认端点"""
+        endpoint_configs = []
+        if settings.LLM_ENDPOINTS.strip():
+            try:
+                endpoint_configs = json.loads(settings.LLM_ENDPOINTS)
+            except json.JSONDecodeError as e:
+                api_logger.error(f"LLM_ENDPOINTS 配置格式错误，使用默认端点: {e}")
+
+        endpoints = []
+        for i, config in enumerate(endpoint_configs):
+            if not config.get("base_url"):
+                api_logger.warning(f"LLM端点配置缺少base_url，已忽略: {config.get('name', i)}")
+                continue
+            endpoints.append(LLMEndpoint(
+                name=config.get("name") or f"endpoint-{i}",
+                client=self.create_async_client(config.get("api_key") or api_key, config["base_url"]),
+                models=config.get("models"),
+                max_concurrency=int(config.get("max_concurrency") or settings.LLM_ENDPOINT_MAX_CONCURRENCY),
+                cooldown=settings.LLM_ENDPOINT_COOLDOWN
+            ))
+
+        if not endpoints:
+            endpoints.append(LLMEndpoint(
+                name="default",
+                client=self._async_client,
+                max_concurrency=settings.LLM_ENDPOINT_MAX_CONCURRENCY,
+                cooldown=settings.LLM_ENDPOINT_COOLDOWN
+            ))
+        return endpoints
+
+    def create_async_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        """创建使用共享连接池的异步OpenAI客户端（用于不同的密钥或地址）"""
+        return AsyncOpenAI(
+            api_key=api_key,
+            base_url=normalize_base_url(base_url),
+            http_client=self._http_client
+        )
+
     @property
     def client(self) -> OpenAI:
         """获取同步OpenAI客户端"""
         return self._client
-    
+
     @property
     def async_client(self) -> AsyncOpenAI:
         """获取异步OpenAI客户端"""
         return self._async_client
-    
+
+    @property
+    def gateway(self) -> LLMGateway:
+        """获取LLM网关"""
+        return self._gateway
+
+    async def create_chat_completion(self, **params) -> Any:
+        """通过网关发起对话补全（参数与 chat.completions.create 相同）"""
+        if params.get("stream") and settings.LLM_STREAM_INCLUDE_USAGE:
+            # 流式响应默认不返回用量，要求在最后一个数据块中返回
+            params.setdefault("stream_options", {"include_usage": True})
+        return await self._gateway.create_chat_completion(**params)
+
     @property
     def model(self) -> str:
         """获取默认模型"""
         return settings.OPENAI_MODEL
 
+    async def close(self):
+        """关闭共享连接池"""
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        if self._client is not None:
+            self._client.close()
+
 
 # 创建全局客户端服务实例
-openai_client_service = OpenAIClientService() 
\ No newline at end of file
+openai_client_service = OpenAIClientService()
@@ -0,0 +1,91 @@
+"""
+提示词布局
+
+上游的提示词缓存按请求前缀匹配，前缀中任何字节的变化都会使缓存失效。
+发送请求前把消息和工具整理成确定的布局：
+- 系统消息（Agent提示词、会话摘要）固定在最前面
+- 历史消息只保留接口需要的字段，同一条历史在每轮中序列化结果相同
+- 工具按名称排序，字段按键名排序，并去掉工具顶层仅供本地使用的字段（如 _mcp_metadata）
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.utils.logging import api_logger
+
+
+# 发送给接口的消息字段
+MESSAGE_FIELDS = ("role", "content", "name", "tool_calls", "tool_call_id")
+
+
+def _sort_keys(value: Any) -> Any:
+    """递归按键名排序"""
+    if isinstance(value, dict):
+        return {k: _sort_keys(value[k]) for k in sorted(value)}
+    if isinstance(value, list):
+        return [_sort_keys(v) for v in value]
+    return value
+
+
+def _strip_private(tool: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉工具顶层以下划线开头的本地字段，并按键名排序
+
+    只处理顶层：参数schema中的属性名（如 _id）可能以下划线开头，不能删除。
+    """
+    return {k: _sort_keys(tool[k]) for k in sorted(tool) if not str(k).startswith("_")}
+
+
+def _tool_name(tool: Dict[str, Any]) -> str:
+    return tool.get("function", {}).get("name") or tool.get("type", "")
+
+
+class PromptLayout:
+    """整理请求的消息和工具布局"""
+
+    @staticmethod
+    def canonicalize_tools(tools: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """工具按名称排序并规范化字段顺序；同名工具只保留第一个"""
+        if not tools:
+            return []
+        seen = set()
+        result = []
+        for tool in sorted(tools, key=_tool_name):
+            name = _tool_name(tool)
+            if name in seen:
+                api_logger.warning(f"存在重名工具，忽略重复项: {name}")
+                continue
+            seen.add(name)
+            result.append(_strip_private(tool))
+        return result
+
+    @staticmethod
+    def canonicalize_message(message: Dict[str, Any]) -> Dict[str, Any]:
+        """只保留接口需要的字段（记忆中可能带有tokens、agent_id等本地字段）"""
+        return {k: message[k] for k in MESSAGE_FIELDS if k in message and message[k] is not None}
+
+    @staticmethod
+    def arrange_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """系统消息保持相对顺序移到最前，其余消息顺序不变"""
+        system_messages = [m for m in messages if m.get("role") == "system"]
+        others = [m for m in messages if m.get("role") != "system"]
+        return [PromptLayout.canonicalize_message(m) for m in system_messages + others]
+
+    def apply(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]]
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """返回整理后的消息和工具"""
+        return self.arrange_messages(messages), self.canonicalize_tools(tools)
+
+    @staticmethod
+    def prefix_hash(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]]) -> str:
+        """稳定前缀（工具和系统消息）的摘要，同一会话各轮应保持一致，用于排查缓存未命中"""
+        head = [m for m in messages if m.get("role") == "system"]
+        data = json.dumps({"tools": tools or [], "system": head}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+
+# 创建全局提示词布局实例
+prompt_layout = PromptLayout()
@@ -0,0 +1,263 @@
+"""
+流式生成取消注册表
+
+每个进行中的流式对话在注册表中登记一个句柄（以会话ID为键）。
+客户端断开连接或调用停止接口时取消生成任务：取消会沿着生成器传递，
+关闭上游LLM响应流并取消未完成的工具任务，随后由服务端保存已生成的部分内容。
+"""
+
+import asyncio
+import json
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+
+from backend.utils.logging import api_logger
+
+
+class StreamHandle:
+    """单个流式生成的取消句柄"""
+
+    def __init__(self, user_id: Optional[int], request_id: Optional[str] = None):
+        self.user_id = user_id
+        self.request_id = request_id
+        self.session_id: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+
+        # 已生成的内容，用于取消时保存
+        self.content_parts: List[str] = []
+        self.reasoning_parts: List[str] = []
+        # 生成过程中已创建的助手消息及交互流程
+        self.message_id: Optional[str] = None
+        self.interaction_flow: Optional[List[Dict[str, Any]]] = None
+        # 最终内容已由生成流程保存，取消时无需再保存
+        self.saved = False
+        # 取消后保存的部分内容长度（None表示未保存）
+        self.saved_content_length: Optional[int] = None
+        # 用量统计：已完成请求的真实用量，以及本轮组装上下文时的提示词信息
+        self.usage = None
+        self.model: Optional[str] = None
+        self.agent_id: Optional[str] = None
+        self.prompt_tokens = 0
+        # 后台标题生成的Future，回答完成后用于追加推送标题
+        self.title_future: Optional[asyncio.Future] = None
+        # 在工作池中排队时由运行器设置，排队期间被取消时调用以移出队列
+        self.on_queued_cancel: Optional[Callable[[], None]] = None
+
+    @property
+    def content(self) -> str:
+        return "".join(self.content_parts)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_reason is not None
+
+    def append(self, content: str, reasoning: str = "") -> None:
+        if content:
+            self.content_parts.append(content)
+        if reasoning:
+            self.reasoning_parts.append(reasoning)
+
+    def start(self, coro: Coroutine) -> asyncio.Task:
+        """在独立任务中运行生成过程，使其可以被其他请求取消"""
+        self.task = asyncio.create_task(
+            _run_with_handle(self, coro),
+            name=f"chat-stream-{self.request_id or id(self)}"
+        )
+        return self.task
+
+    def cancel(self, reason: str) -> bool:
+        """取消生成任务，任务已结束时返回False
+
+        任务尚未开始（例如仍在工作池中排队）时记录取消原因并通知运行器移出队列，
+        生成流程开始时检查 cancelled 并直接结束。
+        重复取消不会再次取消任务，避免打断第一次取消后正在进行的部分内容保存。
+        """
+        if self.task is not None and self.task.done():
+            return False
+        if self.cancel_reason is not None:
+            return True
+        self.cancel_reason = reason
+        api_logger.info(f"取消流式生成: session_id={self.session_id}, 原因: {reason}")
+        if self.task is not None:
+            self.task.cancel()
+        elif self.on_queued_cancel is not None:
+            self.on_queued_cancel()
+        return True
+
+    async def wait(self, timeout: float) -> None:
+        """等待生成任务（包括取消后的保存）结束"""
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            pass
+
+
+# 当前任务所属的流式句柄，生成流程通过它上报已保存的消息
+_current_handle: ContextVar[Optional[StreamHandle]] = ContextVar("current_stream_handle", default=None)
+
+
+async def _run_with_handle(handle: StreamHandle, coro: Coroutine):
+    _current_handle.set(handle)
+    return await coro
+
+
+class StreamCancellationRegistry:
+    """流式生成取消注册表"""
+
+    def __init__(self):
+        self._streams: Dict[str, StreamHandle] = {}
+
+    def create(self, user_id: Optional[int], request_id: Optional[str] = None) -> StreamHandle:
+        return StreamHandle(user_id, request_id)
+
+    def bind(self, handle: StreamHandle, session_id: Optional[str]) -> None:
+        """以会话ID登记句柄；同一会话的旧生成会被新的生成替换"""
+        if not session_id or handle.session_id == session_id:
+            return
+        handle.session_id = session_id
+        previous = self._streams.get(session_id)
+        if previous is not None and previous is not handle:
+            previous.cancel("superseded")
+        self._streams[session_id] = handle
+
+    def unregister(self, handle: StreamHandle) -> None:
+        if handle.session_id and self._streams.get(handle.session_id) is handle:
+            del self._streams[handle.session_id]
+
+    def cancel(self, session_id: str, user_id: Optional[int], reason: str) -> Optional[StreamHandle]:
+        """取消指定会话的生成，返回被取消的句柄"""
+        handle = self._streams.get(session_id)
+        if handle is None or (user_id is not None and handle.user_id != user_id):
+            return None
+        return handle if handle.cancel(reason) else None
+
+    def active_count(self) -> int:
+        return len(self._streams)
+
+    # 以下方法在生成流程内部调用，作用于当前任务所属的句柄
+
+    def track_message(self, message_id: Optional[str]) -> None:
+        """记录生成过程中创建的助手消息"""
+        handle = _current_handle.get()
+        if handle is not None and message_id:
+            handle.message_id = message_id
+
+    def track_interaction_flow(self, interaction_flow: List[Dict[str, Any]]) -> None:
+        """记录交互流程，取消时一并保存"""
+        handle = _current_handle.get()
+        if handle is not None:
+            handle.interaction_flow = interaction_flow
+
+    def track_usage(self, meter) -> None:
+        """记录当前生成的用量计量器"""
+        handle = _current_handle.get()
+        if handle is not None:
+            handle.usage = meter
+
+    def track_context(self, model: str, prompt_tokens: int, agent_id: Optional[str] = None) -> None:
+        """记录本轮使用的模型和提示词token数，取消时用于统计用量"""
+        handle = _current_handle.get()
+        if handle is not None:
+            handle.model = model
+            handle.prompt_tokens = prompt_tokens
+            handle.agent_id = agent_id
+
+    def track_title(self, future: Optional[asyncio.Future]) -> None:
+        """记录标题生成Future，回答完成后可追加推送标题事件"""
+        handle = _current_handle.get()
+        if handle is not None and future is not None:
+            handle.title_future = future
+
+    def mark_saved(self) -> None:
+        """生成流程已保存最终内容"""
+        handle = _current_handle.get()
+        if handle is not None:
+            handle.saved = True
+
+
+async def persist_partial_response(handle: StreamHandle) -> None:
+    """保存被取消的生成已产出的部分内容（使用独立的数据库会话）"""
+    if handle.saved or not handle.session_id:
+        return
+
+    from backend.db.session import get_async_session
+    from backend.crud.chat import add_message, update_message_content
+    from backend.core.config import settings
+    from backend.services.context_builder import context_builder
+    from backend.services.memory import memory_service
+    from backend.services.usage_service import usage_service
+    from backend.utils.id_converter import IDConverter
+
+    content = handle.content
+    if not content.strip() and not handle.message_id:
+        handle.saved_content_length = 0
+        return
+
+    # 有交互流程（工具调用）时保持与正常完成相同的JSON结构
+    stored_content = content
+    flow = handle.interaction_flow
+    if flow:
+        flow_text = "".join(item.get("content", "") for item in flow if item.get("type") == "text")
+        tail = content[len(flow_text):] if content.startswith(flow_text) else ""
+        items = list(flow)
+        if tail.strip():
+            items.append({"type": "text", "content": tail})
+        stored_content = json.dumps({
+            "type": "agent_response",
+            "interaction_flow": items,
+            "stopped": True
+        }, ensure_ascii=False)
+
+    # 已完成的请求使用接口返回的用量；被中断的请求没有返回用量，按已生成的内容统计
+    completion_tokens = context_builder.counter(handle.model or settings.OPENAI_MODEL).count_text(content)
+    prompt_tokens = handle.prompt_tokens
+    meter = handle.usage
+    if meter is not None and meter.has_data:
+        prompt_tokens = meter.prompt_tokens
+        completion_tokens = max(meter.completion_tokens, completion_tokens)
+    total_tokens = prompt_tokens + completion_tokens
+
+    try:
+        async for db in get_async_session():
+            if handle.message_id:
+                await update_message_content(
+                    db, handle.message_id, stored_content,
+                    tokens=completion_tokens, prompt_tokens=prompt_tokens, total_tokens=total_tokens
+                )
+            else:
+                await add_message(
+                    db=db,
+                    session_id=handle.session_id,
+                    role="assistant",
+                    content=stored_content,
+                    tokens=completion_tokens,
+                    prompt_tokens=prompt_tokens,
+                    total_tokens=total_tokens,
+                    agent_id=handle.agent_id
+                )
+            if handle.user_id:
+                session_db_id = await IDConverter.get_chat_db_id(db, handle.session_id)
+                agent_db_id = await IDConverter.get_agent_db_id(db, handle.agent_id) if handle.agent_id else None
+                if session_db_id:
+                    await usage_service.record_message_usage(
+                        db, handle.user_id, session_db_id, agent_db_id, prompt_tokens, completion_tokens,
+                        cached_tokens=meter.cached_tokens if meter is not None else 0,
+                        request_count=meter.request_count if meter is not None else 0
+                    )
+            break
+        if content.strip():
+            memory_service.add_assistant_message(handle.session_id, content, handle.user_id)
+        handle.saved = True
+        handle.saved_content_length = len(content)
+        api_logger.info(f"已保存取消时的部分响应: session_id={handle.session_id}, content_length={len(content)}, 原因: {handle.cancel_reason}")
+    except Exception as e:
+        api_logger.error(f"保存取消时的部分响应失败: session_id={handle.session_id}, 错误: {e}")
+
+
+# 创建全局取消注册表实例
+stream_cancellation_registry = StreamCancellationRegistry()
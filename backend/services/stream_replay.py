@@ -0,0 +1,128 @@
+"""
+流式响应回放缓冲区
+
+每个流式生成的SSE事件写入一个有界的内存环形缓冲区（按会话ID登记），
+事件带有递增的ID。客户端断线后可以携带 Last-Event-ID 重新连接，
+先回放错过的事件，再继续接收实时事件；生成完成后缓冲区保留一段时间供回放。
+"""
+
+import asyncio
+from collections import deque
+from itertools import islice
+from typing import AsyncGenerator, Deque, Dict, Optional, Tuple
+
+from backend.utils.logging import api_logger
+
+
+class ReplayBuffer:
+    """单个流式生成的事件缓冲区"""
+
+    def __init__(self, user_id: Optional[int], maxlen: int):
+        self.user_id = user_id
+        self.session_id: Optional[str] = None
+        self.closed = False
+        self._events: Deque[Tuple[int, str]] = deque(maxlen=maxlen)
+        self._next_id = 1
+        self._changed = asyncio.Event()
+
+    @property
+    def last_event_id(self) -> int:
+        return self._next_id - 1
+
+    def publish(self, data: str) -> int:
+        """写入一个事件，返回事件ID"""
+        event_id = self._next_id
+        self._next_id += 1
+        self._events.append((event_id, data))
+        self._notify()
+        return event_id
+
+    def close(self) -> None:
+        """生成结束，订阅者读完剩余事件后退出"""
+        self.closed = True
+        self._notify()
+
+    def has_gap(self, after_id: int) -> bool:
+        """请求的位置之后是否有事件已被环形缓冲区覆盖"""
+        return bool(self._events) and after_id < self._events[0][0] - 1
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _events_after(self, after_id: int):
+        if not self._events or after_id >= self.last_event_id:
+            return []
+        offset = max(0, after_id - self._events[0][0] + 1)
+        return list(islice(self._events, offset, None))
+
+    async def subscribe(
+        self,
+        after_id: int = 0,
+        idle_timeout: Optional[float] = None
+    ) -> AsyncGenerator[Optional[Tuple[int, str]], None]:
+        """从指定事件之后开始读取，先回放已有事件再跟随实时事件
+
+        等待超过 idle_timeout 时产出None，便于调用方检测客户端是否断开。
+        """
+        while True:
+            pending = self._events_after(after_id)
+            if pending:
+                for event in pending:
+                    after_id = event[0]
+                    yield event
+                continue
+            if self.closed:
+                return
+            waiter = self._changed
+            try:
+                await asyncio.wait_for(waiter.wait(), idle_timeout)
+            except asyncio.TimeoutError:
+                yield None
+
+
+def format_sse_event(event_id: int, data: str) -> str:
+    """格式化为带ID的SSE事件"""
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+
+class StreamReplayRegistry:
+    """回放缓冲区注册表"""
+
+    def __init__(self):
+        self._buffers: Dict[str, ReplayBuffer] = {}
+
+    def create(self, user_id: Optional[int], maxlen: int) -> ReplayBuffer:
+        return ReplayBuffer(user_id, maxlen)
+
+    def bind(self, buffer: ReplayBuffer, session_id: Optional[str]) -> None:
+        """以会话ID登记缓冲区，同一会话只保留最新一次生成"""
+        if not session_id or buffer.session_id == session_id:
+            return
+        buffer.session_id = session_id
+        self._buffers[session_id] = buffer
+
+    def get(self, session_id: str) -> Optional[ReplayBuffer]:
+        return self._buffers.get(session_id)
+
+    def release(self, buffer: ReplayBuffer, ttl: float) -> None:
+        """生成结束后保留缓冲区一段时间，之后移除"""
+        buffer.close()
+        if not buffer.session_id:
+            return
+        if ttl <= 0:
+            self._drop(buffer.session_id, buffer)
+            return
+        asyncio.get_running_loop().call_later(ttl, self._drop, buffer.session_id, buffer)
+
+    def _drop(self, session_id: str, buffer: ReplayBuffer) -> None:
+        if self._buffers.get(session_id) is buffer:
+            del self._buffers[session_id]
+            api_logger.debug(f"移除流式回放缓冲区: session_id={session_id}")
+
+    def active_count(self) -> int:
+        return len(self._buffers)
+
+
+# 创建全局回放注册表实例
+stream_replay_registry = StreamReplayRegistry()
@@ -1,27 +1,17 @@
 import asyncio
-from typing import Optional
-from openai import AsyncOpenAI
+import json
+from typing import List, Optional
 
 from backend.core.config import settings
 from backend.utils.logging import api_logger
 from backend.utils.id_converter import IDConverter
+from backend.services.openai_client import openai_client_service
+from backend.services.usage_service import usage_service
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # 获取配置
-api_key = settings.OPENAI_API_KEY
-base_url = settings.OPENAI_BASE_URL
 model = settings.OPENAI_MODEL
 
-# 确保base_url以/v1结尾
-if base_url and not base_url.endswith('/v1'):
-    base_url = base_url.rstrip() + '/v1'
-
-# 配置OpenAI客户端
-client = AsyncOpenAI(
-    api_key=api_key,
-    base_url=base_url
-)
-
 async def generate_title_with_ai(session_id: str, user_message: str, db: Optional[AsyncSession] = None) -> str:
     """
     使用AI生成会话标题
@@ -52,24 +42,22 @@ async def generate_title_with_ai(session_id: str, user_message: str, db: Optiona
 直接返回标题，不要其他内容。"""
 
         # 调用AI生成标题
-        response = await client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "你是一个专业的标题生成助手，擅长为对话生成简洁明了的标题。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=50,
-            temperature=0.7
-        )
+        # 标题生成的用量不计入当前消息
+        with usage_service.untracked():
+            response = await openai_client_service.create_chat_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "你是一个专业的标题生成助手，擅长为对话生成简洁明了的标题。"},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=50,
+                temperature=0.7
+            )
         
-        title = response.choices[0].message.content.strip()
+        title = _normalize_title(response.choices[0].message.content)
         
         api_logger.info(f"[标题生成响应] 生成标题长度: {len(title)}")
         
-        # 确保标题不超过20个字符
-        if len(title) > 20:
-            title = title[:17] + "..."
-        
         api_logger.info(f"AI生成标题成功: session_id={session_id}, title={title}")
         return title
         
@@ -84,6 +72,58 @@ async def generate_title_with_ai(session_id: str, user_message: str, db: Optiona
         api_logger.info(f"使用备用标题: session_id={session_id}, title={fallback_title}")
         return fallback_title
 
+def _normalize_title(title: Optional[str]) -> str:
+    """去掉首尾空白和引号，确保标题不超过20个字符"""
+    title = (title or "").strip().strip('"\'“”「」《》')
+    if len(title) > 20:
+        title = title[:17] + "..."
+    return title
+
+
+async def generate_titles_batch(user_messages: List[str]) -> List[Optional[str]]:
+    """
+    一次LLM调用为多个会话生成标题
+    
+    Args:
+        user_messages: 各会话的用户消息内容
+        
+    Returns:
+        与输入顺序对应的标题列表，解析失败的位置为None
+    """
+    numbered = "\n".join(f"{i + 1}. {message[:200]}" for i, message in enumerate(user_messages))
+    prompt = f"""请分别为以下 {len(user_messages)} 段对话生成简洁的标题（每个不超过20个字符）：
+
+{numbered}
+
+要求：
+1. 标题要简洁明了，能体现对话主题
+2. 使用中文，不要包含特殊字符
+3. 只返回JSON字符串数组，顺序与对话编号一致，例如 ["标题一", "标题二"]"""
+
+    with usage_service.untracked():
+        response = await openai_client_service.create_chat_completion(
+            model=model,
+            messages=[
+                {"role": "system", "content": "你是一个专业的标题生成助手，擅长为对话生成简洁明了的标题。"},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=30 * len(user_messages) + 20,
+            temperature=0.7
+        )
+
+    content = (response.choices[0].message.content or "").strip()
+    # 兼容模型用代码块包裹JSON的情况
+    start, end = content.find("["), content.rfind("]")
+    try:
+        titles = json.loads(content[start:end + 1]) if start != -1 and end > start else None
+    except json.JSONDecodeError:
+        titles = None
+    if not isinstance(titles, list) or len(titles) != len(user_messages):
+        api_logger.warning(f"批量生成标题结果无法解析: {content[:200]}")
+        return [None] * len(user_messages)
+    return [_normalize_title(str(t)) or None for t in titles]
+
+
 def generate_simple_title(user_message: str) -> str:
     """
     生成简单标题（不使用AI）
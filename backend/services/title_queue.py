@@ -0,0 +1,226 @@
+"""
+会话标题生成队列
+
+标题生成不再阻塞回答的完成：回答保存后把会话加入队列立即返回，
+由固定数量的工作协程在后台生成标题并写入数据库。
+- 同一会话同时只有一个待生成任务（重复加入返回同一个Future）
+- 队列有上限，已满时直接使用基于用户消息的简单标题
+- 可选批量模式：在短时间窗口内收集多个待生成的会话，一次LLM调用生成全部标题
+生成结果通过Future返回，流式接口可以据此追加推送标题事件；
+客户端也可以在下次获取会话列表时拿到新标题。
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from backend.core.config import settings
+from backend.utils.logging import api_logger
+
+
+# 视为未命名的默认标题
+DEFAULT_TITLES = ("新对话", "新会话", "新聊天", None, "")
+# 记录已有标题的会话数上限，用于跳过重复检查
+TITLED_CACHE_SIZE = 10000
+
+
+class TitleJob:
+    """待生成标题的会话"""
+    __slots__ = ("session_id", "user_content", "future")
+
+    def __init__(self, session_id: str, user_content: str, future: asyncio.Future):
+        self.session_id = session_id
+        self.user_content = user_content
+        self.future = future
+
+
+class TitleQueue:
+    """后台标题生成队列"""
+
+    def __init__(self, concurrency: int, max_pending: int, batch_enabled: bool, batch_max: int, batch_window: float):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.batch_enabled = batch_enabled
+        self.batch_max = max(1, batch_max)
+        self.batch_window = batch_window
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._titled: "OrderedDict[str, None]" = OrderedDict()
+
+        # 统计信息
+        self.generated = 0
+        self.batched_calls = 0
+        self.overflowed = 0
+
+    def _ensure_started(self) -> None:
+        """首次加入任务时在当前事件循环中启动工作协程"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"title-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        api_logger.info(f"标题生成队列已启动，工作协程数: {self.concurrency}，批量模式: {self.batch_enabled}")
+
+    def _remember_titled(self, session_id: str) -> None:
+        self._titled[session_id] = None
+        self._titled.move_to_end(session_id)
+        while len(self._titled) > TITLED_CACHE_SIZE:
+            self._titled.popitem(last=False)
+
+    def enqueue(self, session_id: Optional[str], user_content: str) -> Optional[asyncio.Future]:
+        """加入标题生成队列，返回结果Future（值为新标题，无需生成时为None）"""
+        if not session_id or not user_content or session_id in self._titled:
+            return None
+        existing = self._pending.get(session_id)
+        if existing is not None:
+            return existing
+
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[session_id] = future
+        job = TitleJob(session_id, user_content, future)
+        if self._queue.qsize() >= self.max_pending:
+            # 队列已满，不再调用LLM
+            self.overflowed += 1
+            asyncio.create_task(self._apply_simple_title(job))
+        else:
+            self._queue.put_nowait(job)
+        return future
+
+    async def wait(self, future: Optional[asyncio.Future], timeout: float) -> Optional[str]:
+        """等待标题生成结果，超时返回None"""
+        if future is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            return None
+        except Exception:
+            return None
+
+    async def _collect_batch(self, first: TitleJob) -> List[TitleJob]:
+        """在批量窗口内收集更多任务"""
+        jobs = [first]
+        if not self.batch_enabled or self.batch_max <= 1:
+            return jobs
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(jobs) < self.batch_max:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return jobs
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            first = await self._queue.get()
+            jobs = await self._collect_batch(first)
+            try:
+                await self._process(jobs)
+            except Exception as e:
+                api_logger.error(f"标题生成任务异常: {e}", exc_info=True)
+                for job in jobs:
+                    self._finish(job, None)
+
+    async def _process(self, jobs: List[TitleJob]) -> None:
+        from backend.crud.chat import get_chat, update_chat_title
+        from backend.db.session import get_async_session
+        from backend.services.title_generator import generate_title_with_ai, generate_titles_batch
+
+        async for db in get_async_session():
+            # 只为仍是默认标题的会话生成
+            untitled = []
+            for job in jobs:
+                chat = await get_chat(db, job.session_id)
+                if chat is None or chat.title not in DEFAULT_TITLES:
+                    if chat is not None:
+                        self._remember_titled(job.session_id)
+                    self._finish(job, None)
+                else:
+                    untitled.append(job)
+            if not untitled:
+                return
+
+            titles: List[Optional[str]] = [None] * len(untitled)
+            if len(untitled) > 1:
+                self.batched_calls += 1
+                try:
+                    titles = await generate_titles_batch([job.user_content for job in untitled])
+                except Exception as e:
+                    api_logger.warning(f"批量生成标题失败，改为逐个生成: {e}")
+            for i, job in enumerate(untitled):
+                if not titles[i]:
+                    titles[i] = await generate_title_with_ai(job.session_id, job.user_content, db)
+
+            for job, title in zip(untitled, titles):
+                updated = await update_chat_title(db, job.session_id, title)
+                if updated:
+                    self.generated += 1
+                    self._remember_titled(job.session_id)
+                    api_logger.info(f"后台生成标题成功: session_id={job.session_id}, title={title}")
+                self._finish(job, title if updated else None)
+            break
+
+    async def _apply_simple_title(self, job: TitleJob) -> None:
+        from backend.crud.chat import get_chat, update_chat_title
+        from backend.db.session import get_async_session
+        from backend.services.title_generator import generate_simple_title
+
+        title = None
+        try:
+            async for db in get_async_session():
+                chat = await get_chat(db, job.session_id)
+                if chat is not None and chat.title in DEFAULT_TITLES:
+                    title = generate_simple_title(job.user_content)
+                    if not await update_chat_title(db, job.session_id, title):
+                        title = None
+                break
+        except Exception as e:
+            api_logger.error(f"设置简单标题失败: session_id={job.session_id}, 错误: {e}")
+        self._finish(job, title)
+
+    def _finish(self, job: TitleJob, title: Optional[str]) -> None:
+        if self._pending.get(job.session_id) is job.future:
+            del self._pending[job.session_id]
+        if not job.future.done():
+            job.future.set_result(title)
+
+    async def shutdown(self) -> None:
+        """停止工作协程，未完成的任务随之丢弃"""
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for future in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        self._pending.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "workers": len(self._workers),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending": len(self._pending),
+            "generated": self.generated,
+            "batched_calls": self.batched_calls,
+            "overflowed": self.overflowed,
+        }
+
+
+# 创建全局标题生成队列实例
+title_queue = TitleQueue(
+    concurrency=settings.TITLE_QUEUE_CONCURRENCY,
+    max_pending=settings.TITLE_QUEUE_MAX,
+    batch_enabled=settings.TITLE_BATCH_ENABLED,
+    batch_max=settings.TITLE_BATCH_MAX,
+    batch_window=settings.TITLE_BATCH_WINDOW
+)
@@ -0,0 +1,122 @@
+"""
+流式工具调用增量累积器
+
+按索引收集流式响应中的工具调用增量：参数片段写入列表缓冲区，
+流结束时拼接一次、解析一次JSON，解析结果随工具调用一起向下游传递，
+避免逐片段字符串拼接和对同一参数的多次解析。
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+from backend.utils.logging import api_logger
+
+
+class _PendingToolCall:
+    """正在累积中的单个工具调用"""
+    __slots__ = ("id", "type", "name", "argument_parts")
+
+    def __init__(self, id: Optional[str], type: Optional[str]):
+        self.id = id
+        self.type = type or "function"
+        self.name = ""
+        self.argument_parts: List[str] = []
+
+
+class ToolCallAccumulator:
+    """流式工具调用增量累积器"""
+
+    def __init__(self):
+        # 按到达顺序保存的工具调用，以及索引到调用的映射
+        self._calls: List[_PendingToolCall] = []
+        self._by_index: Dict[int, _PendingToolCall] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def add(self, delta_tool_call) -> None:
+        """合并一个工具调用增量"""
+        index = getattr(delta_tool_call, "index", None)
+        call_id = delta_tool_call.id
+
+        if index is not None:
+            pending = self._by_index.get(index)
+        else:
+            # 没有索引时按ID匹配，缺少ID的增量归入最后一个调用
+            pending = None
+            if call_id:
+                pending = next((c for c in self._calls if c.id == call_id), None)
+            elif self._calls:
+                pending = self._calls[-1]
+
+        if pending is None:
+            pending = _PendingToolCall(call_id or f"call_{len(self._calls)}", getattr(delta_tool_call, "type", None))
+            self._calls.append(pending)
+            if index is not None:
+                self._by_index[index] = pending
+        elif call_id:
+            pending.id = call_id
+
+        function = delta_tool_call.function
+        if function:
+            if function.name:
+                pending.name = function.name
+            if function.arguments:
+                pending.argument_parts.append(function.arguments)
+
+    def add_all(self, delta_tool_calls) -> None:
+        """合并一批工具调用增量"""
+        for delta_tool_call in delta_tool_calls:
+            self.add(delta_tool_call)
+
+    def finalize(self) -> List[Dict[str, Any]]:
+        """生成完整的工具调用列表（按索引排序，忽略没有函数名的调用）
+
+        每个调用的参数只解析一次，结果保存在 parsed_arguments 中；
+        解析失败时 parsed_arguments 为 None，并记录 parse_error。
+        """
+        ordered = sorted(self._by_index.items())
+        indexed_ids = {id(c) for _, c in ordered}
+        calls = [c for _, c in ordered] + [c for c in self._calls if id(c) not in indexed_ids]
+
+        result = []
+        for pending in calls:
+            if not pending.name:
+                api_logger.warning(f"工具调用 {pending.id} 函数名为空，跳过")
+                continue
+            arguments = "".join(pending.argument_parts)
+            tool_call = {
+                "id": pending.id,
+                "type": pending.type,
+                "function": {"name": pending.name, "arguments": arguments},
+                "parsed_arguments": None
+            }
+            parse_arguments(tool_call)
+            result.append(tool_call)
+        return result
+
+
+def parse_arguments(tool_call: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """解析工具调用参数并缓存到 parsed_arguments，已解析过的直接返回
+
+    空参数解析为空字典；JSON格式错误时返回None并记录 parse_error。
+    """
+    parsed = tool_call.get("parsed_arguments")
+    if parsed is not None:
+        return parsed
+
+    arguments = (tool_call["function"].get("arguments") or "").strip()
+    if not arguments:
+        parsed = {}
+    else:
+        try:
+            parsed = json.loads(arguments)
+        except json.JSONDecodeError as e:
+            tool_call["parse_error"] = str(e)
+            return None
+        if not isinstance(parsed, dict):
+            tool_call["parse_error"] = "工具参数必须是JSON对象"
+            return None
+
+    tool_call["parsed_arguments"] = parsed
+    return parsed
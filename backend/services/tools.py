@@ -1,12 +1,15 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable
 import os
 import json
+import asyncio
 import requests
 import http.client
 from datetime import datetime, timedelta
 import pytz
 from datetime import timezone as dt_timezone
 from backend.utils.logging import api_logger
+from backend.utils.single_flight import SingleFlight, make_call_key
+from backend.core.config import settings
 
 class TavilyTool:
     """Tavily搜索和网页解析工具"""
@@ -117,6 +120,46 @@ class TavilyTool:
             return {"error": str(e)}
 
 
+    async def extract_stream(
+        self,
+        urls: List[str],
+        include_images: bool = False
+    ):
+        """逐个URL并发提取网页内容，每完成一个URL就产出一条中间结果
+
+        产出 {"partial": {...}} 表示单个URL的结果，最后产出 {"result": {...}}
+        作为与 extract 相同结构的汇总结果。同时进行的请求数受
+        TAVILY_EXTRACT_CONCURRENCY 限制；只在调用方需要中间结果时使用。
+        """
+        if not self.api_key or not urls or len(urls) == 1:
+            # 未配置密钥时与 extract 返回相同的错误
+            yield {"result": await asyncio.to_thread(self.extract, urls, include_images)}
+            return
+        
+        semaphore = asyncio.Semaphore(max(1, settings.TAVILY_EXTRACT_CONCURRENCY))
+        
+        async def extract_one(url: str):
+            async with semaphore:
+                return url, await asyncio.to_thread(self.extract, [url], include_images)
+        
+        results = []
+        failed_results = []
+        for next_done in asyncio.as_completed([extract_one(url) for url in urls]):
+            url, single = await next_done
+            if single.get("error"):
+                failed = {"url": url, "error": single.get("error")}
+                failed_results.append(failed)
+                yield {"partial": failed}
+                continue
+            for item in single.get("results", []):
+                results.append(item)
+                yield {"partial": item}
+            failed_results.extend(single.get("failed_results", []))
+        
+        api_logger.info(f"Tavily流式内容提取完成，成功 {len(results)} 个，失败 {len(failed_results)} 个")
+        yield {"result": {"results": results, "failed_results": failed_results}}
+
+
 class SerperTool:
     """Serper Google搜索工具"""
     
@@ -983,6 +1026,9 @@ class ToolsService:
             "note_editor": NoteEditorTool,
             "get_time": TimeTool
         }
+        # 只读的网络类工具：相同参数的并发调用可以安全地共享同一次上游请求
+        self.coalescible_tools = {"tavily", "serper"}
+        self.single_flight = SingleFlight("tools")
         api_logger.info(f"工具服务初始化，可用工具: {list(self.available_tools.keys())}")
     
     def get_tool(self, tool_name: str, config: Dict[str, Any] = None) -> Any:
@@ -1059,11 +1105,41 @@ class ToolsService:
         tool_name: str, 
         action: str, 
         params: Dict[str, Any] = None, 
-        config: Dict[str, Any] = None
+        config: Dict[str, Any] = None,
+        on_progress: Optional[Callable[[Any], None]] = None
     ) -> Dict[str, Any]:
-        """执行工具操作（异步版本，专门用于笔记工具）"""
-        import asyncio  # 将导入移到方法开头
+        """执行工具操作（异步版本）
+
+        同步工具方法放到线程池执行，避免阻塞事件循环；只读网络工具的
+        相同并发调用通过single-flight合并为一次上游请求。
+        若工具提供 `<action>_stream` 异步生成器且传入了 on_progress，
+        中间结果会在产生时立即回调。合并的调用由第一个调用方决定是否流式执行，
+        之后加入的调用方只能收到此后产生的中间结果。
+        """
+        if settings.TOOL_SINGLE_FLIGHT_ENABLED and tool_name in self.coalescible_tools:
+            key = make_call_key(tool_name, action, params or {}, config or {})
+            # 没有调用方需要进度时不传emit，避免无谓地走流式执行
+            result = await self.single_flight.do_with_progress(
+                key,
+                lambda emit: self._execute_tool_async(
+                    tool_name, action, params, config, emit if on_progress is not None else None
+                ),
+                on_progress
+            )
+            # 共享结果的调用方各自持有一份浅拷贝，避免下游修改互相影响
+            return dict(result) if isinstance(result, dict) else result
         
+        return await self._execute_tool_async(tool_name, action, params, config, on_progress)
+    
+    async def _execute_tool_async(
+        self, 
+        tool_name: str, 
+        action: str, 
+        params: Dict[str, Any] = None, 
+        config: Dict[str, Any] = None,
+        on_progress: Optional[Callable[[Any], None]] = None
+    ) -> Dict[str, Any]:
+        """实际执行工具操作"""
         tool = self.get_tool(tool_name, config)
         if not tool:
             return {"error": f"工具 {tool_name} 不可用"}
@@ -1074,17 +1150,20 @@ class ToolsService:
         
         try:
             method = getattr(tool, action)
-            if params:
-                # 检查方法是否为协程
-                if asyncio.iscoroutinefunction(method):
-                    result = await method(**params)
-                else:
-                    result = method(**params)
+            kwargs = params or {}
+            stream_method = getattr(tool, f"{action}_stream", None) if on_progress else None
+            if stream_method is not None:
+                # 流式执行：中间结果立即回调，最后一条result作为最终结果
+                result = None
+                async for item in stream_method(**kwargs):
+                    if "partial" in item:
+                        on_progress(item["partial"])
+                    if "result" in item:
+                        result = item["result"]
+            elif asyncio.iscoroutinefunction(method):
+                result = await method(**kwargs)
             else:
-                if asyncio.iscoroutinefunction(method):
-                    result = await method()
-                else:
-                    result = method()
+                result = await asyncio.to_thread(method, **kwargs)
             
             api_logger.info(f"工具 {tool_name} 异步执行 {action} 操作成功")
             return result
@@ -0,0 +1,207 @@
+"""
+token用量统计服务
+
+- 每次生成开始时创建一个用量计量器，LLM网关把每个响应返回的真实用量
+  （流式响应通过 stream_options.include_usage 在最后一个数据块返回）
+  累加到当前任务的计量器，工具调用后的后续请求也计入同一条消息
+- 消息完成时用计量结果更新消息的token字段，并增量累加到用量汇总表
+- 汇总表按会话、Agent、日期分行，统计查询只读取汇总表
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.crud.usage_summary import ROLLUP_GROUPS, add_usage, get_usage_rollup
+from backend.utils.logging import api_logger
+
+
+class UsageMeter:
+    """单次生成（可能包含多次LLM请求）的用量计量器"""
+    __slots__ = ("prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens", "request_count")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cached_tokens = 0
+        self.request_count = 0
+
+    @property
+    def has_data(self) -> bool:
+        return self.request_count > 0
+
+    def add(self, usage: Any, cached_tokens: int = 0) -> None:
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.total_tokens += getattr(usage, "total_tokens", None) or prompt_tokens + completion_tokens
+        self.cached_tokens += cached_tokens
+        self.request_count += 1
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cached_tokens": self.cached_tokens,
+            "request_count": self.request_count,
+        }
+
+
+# 当前生成任务的计量器；子任务创建时复制上下文，共享同一个计量器
+_current_meter: ContextVar[Optional[UsageMeter]] = ContextVar("current_usage_meter", default=None)
+
+
+class UsageService:
+    """token用量统计服务"""
+
+    @staticmethod
+    def start_meter() -> UsageMeter:
+        """为当前生成任务创建计量器"""
+        meter = UsageMeter()
+        _current_meter.set(meter)
+        from backend.services.stream_cancellation import stream_cancellation_registry
+        stream_cancellation_registry.track_usage(meter)
+        return meter
+
+    @staticmethod
+    def record(usage: Any, cached_tokens: int = 0) -> None:
+        """由LLM网关调用，把响应用量计入当前任务的计量器"""
+        meter = _current_meter.get()
+        if meter is not None and usage is not None:
+            meter.add(usage, cached_tokens)
+
+    @staticmethod
+    def detach() -> None:
+        """当前任务之后的LLM请求不再计入（用于从生成过程中派生的后台任务）"""
+        _current_meter.set(None)
+
+    @staticmethod
+    @contextmanager
+    def untracked():
+        """其间的LLM请求（如生成标题）不计入当前消息的用量"""
+        token = _current_meter.set(None)
+        try:
+            yield
+        finally:
+            _current_meter.reset(token)
+
+    @staticmethod
+    async def settle_message(
+        db: AsyncSession,
+        message,
+        meter: UsageMeter,
+        user_id: Optional[int]
+    ) -> None:
+        """用真实用量更新助手消息的token字段，并累加到用量汇总
+
+        计量器没有数据（接口未返回用量）时保留消息上已有的本地统计值。
+        """
+        if message is None:
+            return
+        try:
+            if meter.has_data:
+                message.tokens = meter.completion_tokens
+                message.prompt_tokens = meter.prompt_tokens
+                message.total_tokens = meter.total_tokens
+                await db.commit()
+            if user_id:
+                await add_usage(
+                    db,
+                    user_id=user_id,
+                    session_id=message.session_id,
+                    agent_id=message.agent_id,
+                    prompt_tokens=message.prompt_tokens or 0,
+                    completion_tokens=message.tokens or 0,
+                    total_tokens=message.total_tokens or 0,
+                    cached_tokens=meter.cached_tokens,
+                    request_count=meter.request_count
+                )
+            api_logger.info(
+                f"消息用量已记录: message_id={message.public_id}, 来源={'接口返回' if meter.has_data else '本地统计'}, "
+                f"prompt={message.prompt_tokens}, completion={message.tokens}, cached={meter.cached_tokens}, 请求次数={meter.request_count}"
+            )
+        except Exception as e:
+            api_logger.error(f"记录消息用量失败: {e}")
+
+    @staticmethod
+    async def record_message_usage(
+        db: AsyncSession,
+        user_id: int,
+        session_db_id: int,
+        agent_db_id: Optional[int],
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+        request_count: int = 0
+    ) -> None:
+        """直接累加一条消息的用量（用于没有计量器的保存路径）"""
+        try:
+            await add_usage(
+                db,
+                user_id=user_id,
+                session_id=session_db_id,
+                agent_id=agent_db_id,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+                cached_tokens=cached_tokens,
+                request_count=request_count
+            )
+        except Exception as e:
+            api_logger.error(f"累加用量汇总失败: {e}")
+
+    @staticmethod
+    async def get_rollup(
+        db: AsyncSession,
+        user_id: int,
+        group_by: str = "total",
+        start_day: Optional[date] = None,
+        end_day: Optional[date] = None,
+        session_id: Optional[str] = None,
+        agent_id: Optional[str] = None,
+        limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        """按维度汇总用户用量，会话和Agent以public_id表示"""
+        from backend.models.agent import Agent
+        from backend.models.chat import Chat
+        from backend.utils.id_converter import IDConverter
+
+        if group_by not in ROLLUP_GROUPS:
+            raise ValueError(f"不支持的汇总维度: {group_by}")
+
+        session_db_id = None
+        if session_id:
+            session_db_id = await IDConverter.get_chat_db_id(db, session_id)
+            if not session_db_id:
+                return []
+        agent_db_id = None
+        if agent_id:
+            agent_db_id = await IDConverter.get_agent_db_id(db, agent_id)
+            if not agent_db_id:
+                return []
+
+        rows = await get_usage_rollup(db, user_id, group_by, start_day, end_day, session_db_id, agent_db_id, limit)
+
+        # 批量转换为public_id
+        if group_by == "session":
+            mapping = await IDConverter.batch_get_public_ids(db, [r["session_id"] for r in rows], Chat)
+            for row in rows:
+                row["session_id"] = mapping.get(row["session_id"])
+        elif group_by == "agent":
+            mapping = await IDConverter.batch_get_public_ids(db, [r["agent_id"] for r in rows if r["agent_id"]], Agent)
+            for row in rows:
+                row["agent_id"] = mapping.get(row["agent_id"]) if row["agent_id"] else None
+        elif group_by == "day":
+            for row in rows:
+                row["day"] = row["day"].isoformat()
+        return rows
+
+
+# 创建全局用量统计服务实例
+usage_service = UsageService()
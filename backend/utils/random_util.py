@@ -78,6 +78,12 @@ class RandomUtil:
         random_str = RandomUtil.generate_random_str(12)
         return f"mcp-{random_str}"
     
+    @staticmethod
+    def generate_usage_summary_id():
+        """生成用量汇总ID，格式为：usage-随机字符串"""
+        random_str = RandomUtil.generate_random_str(12)
+        return f"usage-{random_str}"
+    
     @staticmethod
     def generate_random_number(min_val=1, max_val=100):
         """生成指定范围内的随机整数"""
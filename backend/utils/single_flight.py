@@ -0,0 +1,103 @@
+"""
+请求合并（single-flight）工具模块
+
+当多个协程同时发起完全相同的调用时，只执行一次真正的上游请求，
+其余调用方共享同一个进行中的结果。
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from backend.utils.logging import app_logger
+
+
+def make_call_key(*parts: Any) -> str:
+    """根据调用参数生成稳定的合并键（对字典做规范化JSON序列化）"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """进行中调用的合并器
+
+    以键区分调用，同一键在执行期间只会运行一次，后到的调用方等待
+    同一个任务的结果；任务完成（成功或异常）后立即移除，不做结果缓存。
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # 进度监听器：同一键的所有调用方都能收到上游任务产生的中间结果
+        self._listeners: Dict[str, List[Callable[[Any], None]]] = {}
+        # 统计信息
+        self.executed = 0
+        self.shared = 0
+
+    def inflight_count(self) -> int:
+        """当前进行中的调用数量"""
+        return len(self._inflight)
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """执行调用，若同一键已有进行中的调用则直接共享其结果
+
+        上游任务独立于调用方运行：某个调用方被取消不会影响其他等待者。
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+            app_logger.debug(f"[{self.name}] 合并进行中的调用: {key[:12]}")
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(func())
+        self._inflight[key] = task
+        self.executed += 1
+        task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        return await asyncio.shield(task)
+
+    async def do_with_progress(
+        self,
+        key: str,
+        func: Callable[[Callable[[Any], None]], Awaitable[Any]],
+        on_progress: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """执行会产生中间结果的调用
+
+        func接收一个emit回调，上游每产生一条中间结果就调用一次，
+        结果会广播给当前所有等待同一键的调用方。
+        """
+        listeners = self._listeners.setdefault(key, [])
+        if on_progress is not None:
+            listeners.append(on_progress)
+        try:
+            return await self.do(key, lambda: func(lambda item, k=key: self._emit(k, item)))
+        finally:
+            if on_progress is not None and on_progress in listeners:
+                listeners.remove(on_progress)
+            if not listeners and self._listeners.get(key) is listeners:
+                del self._listeners[key]
+
+    def _emit(self, key: str, item: Any) -> None:
+        """向同一键的所有监听器广播中间结果"""
+        for listener in list(self._listeners.get(key, ())):
+            try:
+                listener(item)
+            except Exception as e:
+                app_logger.warning(f"[{self.name}] 进度回调异常: {e}")
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        """任务完成后移除进行中记录"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 标记异常已被读取，避免所有调用方都已取消时出现未读取异常的警告
+        if not task.cancelled():
+            task.exception()
+
+    def get_stats(self) -> Dict[str, Optional[int]]:
+        """获取合并统计"""
+        return {
+            "executed": self.executed,
+            "shared": self.shared,
+            "inflight": len(self._inflight),
+        }
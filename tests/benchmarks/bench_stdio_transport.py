@@ -0,0 +1,67 @@
+"""
+stdio传输基准测试
+
+用 MCPClient 连接本地回显服务器子进程（tests/support/echo_mcp_server.py），
+多个并发调用方循环调用回显工具，输出各响应大小下的吞吐量和延迟（p50/p99）。
+
+运行: python -m tests.benchmarks.bench_stdio_transport [--sizes 200 204800] [--concurrency 8] [--duration 3]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+from backend.mcp.client.mcp_client import MCPClient
+
+
+async def caller(client: MCPClient, size: int, deadline: float, latencies: list) -> None:
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        started = loop.time()
+        result = await client.call_tool("echo", {"size": size})
+        latencies.append(loop.time() - started)
+        assert len(result.content[0]["text"]) == size
+
+
+async def run_size(client: MCPClient, size: int, concurrency: int, duration: float) -> None:
+    await client.call_tool("echo", {"size": size})  # 预热
+    latencies: list = []
+    deadline = asyncio.get_running_loop().time() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(caller(client, size, deadline, latencies) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{size:>10} {len(latencies) / elapsed:>12.0f} {statistics.median(latencies) * 1000:>10.2f}ms "
+          f"{p99 * 1000:>10.2f}ms")
+
+
+async def main(sizes, concurrency: int, duration: float) -> None:
+    client = MCPClient(
+        "echo-bench",
+        transport_config={"command": sys.executable, "args": ["-m", "tests.support.echo_mcp_server"],
+                          "env": {"PYTHONPATH": "."}},
+        timeout=60.0
+    )
+    await client.connect("stdio")
+    try:
+        print(f"并发调用方: {concurrency}，每种大小运行 {duration:.0f}s")
+        print(f"{'响应字节':>10} {'请求/秒':>12} {'p50':>12} {'p99':>12}")
+        for size in sizes:
+            await run_size(client, size, concurrency, duration)
+        transport = client.transport
+        print(f"写入合并: {transport.messages_sent} 条消息 / {transport.write_calls} 次写入")
+    finally:
+        await client.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="stdio传输基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 20480, 204800])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.concurrency, args.duration))
@@ -0,0 +1,92 @@
+"""
+工具调用增量累积基准测试
+
+对比 ToolCallAccumulator 与原来的做法（按索引补None、参数字符串 += 拼接、
+校验/记录/执行时各解析一次JSON），参数为整篇笔记替换这样的长文本，
+按流式响应的典型粒度拆成小片段。
+
+运行: python -m tests.benchmarks.bench_tool_call_accumulator [--sizes 1024 16384 131072] [--fragment 8]
+"""
+
+import argparse
+import json
+import timeit
+
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall, ChoiceDeltaToolCallFunction
+
+from backend.services.tool_call_accumulator import ToolCallAccumulator
+
+
+def make_deltas(size: int, fragment: int, calls: int = 2):
+    """生成多个工具调用交错到达的增量，参数为长度约为size的笔记内容"""
+    deltas = []
+    for index in range(calls):
+        deltas.append(ChoiceDeltaToolCall.construct(
+            index=index, id=f"call_{index}", type="function",
+            function=ChoiceDeltaToolCallFunction(name="edit_note", arguments="")
+        ))
+    payloads = [
+        json.dumps({"note_id": index, "content": "笔记内容 " * (size // 5)}, ensure_ascii=False)
+        for index in range(calls)
+    ]
+    longest = max(len(p) for p in payloads)
+    for start in range(0, longest, fragment):
+        for index, payload in enumerate(payloads):
+            part = payload[start:start + fragment]
+            if part:
+                deltas.append(ChoiceDeltaToolCall.construct(
+                    index=index, function=ChoiceDeltaToolCallFunction(arguments=part)
+                ))
+    return deltas
+
+
+def legacy(deltas):
+    """原来的累积方式"""
+    stream_tool_calls = []
+    for delta_tool_call in deltas:
+        while len(stream_tool_calls) <= delta_tool_call.index:
+            stream_tool_calls.append(None)
+        if stream_tool_calls[delta_tool_call.index] is None:
+            stream_tool_calls[delta_tool_call.index] = {
+                "id": delta_tool_call.id,
+                "type": "function",
+                "function": {
+                    "name": delta_tool_call.function.name or "",
+                    "arguments": delta_tool_call.function.arguments or ""
+                }
+            }
+        elif delta_tool_call.function.arguments:
+            stream_tool_calls[delta_tool_call.index]["function"]["arguments"] += delta_tool_call.function.arguments
+    calls = [tc for tc in stream_tool_calls if tc is not None]
+    for tc in calls:
+        json.loads(tc["function"]["arguments"])  # 校验
+        json.loads(tc["function"]["arguments"])  # 交互记录
+        json.loads(tc["function"]["arguments"])  # 工具执行
+    return calls
+
+
+def accumulator(deltas):
+    acc = ToolCallAccumulator()
+    acc.add_all(deltas)
+    return acc.finalize()
+
+
+def main(sizes, fragment: int, repeat: int) -> None:
+    print(f"{'参数大小':>10} {'片段数':>8} {'原做法':>12} {'累积器':>12} {'加速':>8}")
+    for size in sizes:
+        deltas = make_deltas(size, fragment)
+        assert [c["function"]["arguments"] for c in legacy(deltas)] == \
+            [c["function"]["arguments"] for c in accumulator(deltas)]
+        number = max(1, 2_000_000 // (size * 2))
+        old = min(timeit.repeat(lambda: legacy(deltas), number=number, repeat=repeat)) / number
+        new = min(timeit.repeat(lambda: accumulator(deltas), number=number, repeat=repeat)) / number
+        print(f"{size:>10} {len(deltas):>8} {old * 1000:>10.3f}ms {new * 1000:>10.3f}ms {old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="工具调用增量累积基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 16384, 131072])
+    parser.add_argument("--fragment", type=int, default=8, help="每个增量中的参数字符数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.sizes, args.fragment, args.repeat)
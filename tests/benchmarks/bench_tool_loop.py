@@ -0,0 +1,113 @@
+"""
+工具调用循环基准测试
+
+用本地OpenAI替身端点驱动 ToolLoopEngine：每轮后续流式请求返回一个新的工具调用，
+直到达到指定轮数。工具执行替换为立即返回，测量结果只包含引擎本身和HTTP开销。
+输出每轮延迟（p50/p95）、引擎代码的内存分配次数和峰值内存。
+工具参数按 --chunk-size 拆成多个数据块，参数较长时延迟主要来自SDK逐块解析。
+
+运行: python -m tests.benchmarks.bench_tool_loop [--runs 50] [--iterations 10] [--chunk-size 16]
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+
+from backend.services.chat_tool_handler import chat_tool_handler
+from backend.services.chat_tool_loop import ToolLoopEngine
+from backend.services.llm_gateway import LLMGateway
+from backend.services.openai_client import openai_client_service
+from tests.support.fake_openai import FakeOpenAIServer, FakeReply, make_endpoint
+
+
+ENGINE_FILES = ("chat_tool_loop.py", "tool_call_accumulator.py")
+
+
+async def instant_tools(tool_calls, agent, db=None, session_id=None, **kwargs):
+    return [
+        {"role": "tool", "tool_call_id": tc.id, "content": json.dumps({"ok": True, "args": tc.parsed_arguments})}
+        for tc in tool_calls
+    ], []
+
+
+def make_reply(iterations: int, argument_size: int, chunk_size: int):
+    payload = "x" * argument_size
+
+    def reply(body):
+        done = sum(1 for m in body["messages"] if m["role"] == "tool")
+        if done >= iterations:
+            return FakeReply("全部完成。" * 20)
+        arguments = json.dumps({"step": done, "content": payload}, ensure_ascii=False)
+        return FakeReply(
+            f"第{done}步，继续调用工具。",
+            tool_calls=[{"id": f"call_{done}", "name": "get_time", "arguments": arguments}],
+            chunk_size=chunk_size
+        )
+    return reply
+
+
+async def run_once(iterations: int) -> float:
+    engine = ToolLoopEngine(
+        messages=[{"role": "user", "content": "benchmark"}],
+        agent=None,
+        use_model="fake-model",
+        max_tokens=100,
+        temperature=0,
+        top_p=1,
+        tools=[],
+        has_tools=False,
+        session_id=1,
+        max_iterations=iterations
+    )
+    first = {"id": "call_init", "type": "function", "function": {"name": "get_time", "arguments": "{}"}}
+    started = time.perf_counter()
+    async for _ in engine.run("", [first]):
+        pass
+    elapsed = time.perf_counter() - started
+    assert engine.iteration == iterations, engine.iteration
+    return elapsed / engine.iteration
+
+
+async def main(runs: int, iterations: int, argument_size: int, chunk_size: int) -> None:
+    chat_tool_handler.handle_tool_calls = instant_tools
+    server = FakeOpenAIServer(make_reply(iterations, argument_size, chunk_size))
+    await server.start()
+    endpoint = make_endpoint("fake", server)
+    openai_client_service._gateway = LLMGateway([endpoint])
+    try:
+        await run_once(iterations)  # 预热连接
+
+        per_iteration = [await run_once(iterations) for _ in range(runs)]
+        per_iteration.sort()
+        p95 = per_iteration[min(len(per_iteration) - 1, int(len(per_iteration) * 0.95))]
+        print(f"每轮延迟: p50={statistics.median(per_iteration) * 1000:.2f}ms p95={p95 * 1000:.2f}ms "
+              f"({runs} 次 x {iterations} 轮，参数 {argument_size} 字节，每块 {chunk_size} 字符)")
+
+        tracemalloc.start(1)
+        before = tracemalloc.take_snapshot()
+        await run_once(iterations)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = after.compare_to(before, "filename")
+        engine_blocks = sum(s.count_diff for s in stats if s.traceback[0].filename.endswith(ENGINE_FILES))
+        engine_bytes = sum(s.size_diff for s in stats if s.traceback[0].filename.endswith(ENGINE_FILES))
+        print(f"引擎代码保留的分配: {engine_blocks} 块 / {engine_bytes / 1024:.1f}KiB "
+              f"(每轮 {engine_blocks / iterations:.1f} 块)，峰值内存: {peak / 1024:.0f}KiB")
+    finally:
+        await endpoint.client.close()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="工具调用循环基准测试")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--argument-size", type=int, default=4096)
+    parser.add_argument("--chunk-size", type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.runs, args.iterations, args.argument_size, args.chunk_size))
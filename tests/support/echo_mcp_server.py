@@ -0,0 +1,52 @@
+"""
+stdio MCP回显服务器替身
+
+只依赖标准库，按行读取JSON-RPC请求并立即响应：
+- initialize / ping / tools/list 返回固定结果
+- tools/call 的 echo 工具返回 arguments.size 字节的文本（默认回显 arguments.text），
+  arguments.id_last 为真时把 id 放在 result 之后
+"""
+
+import json
+import sys
+
+
+def handle(request):
+    method = request.get("method")
+    params = request.get("params") or {}
+    if method == "initialize":
+        return {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {"tools": {}},
+            "serverInfo": {"name": "echo", "version": "1.0.0"},
+        }
+    if method == "tools/list":
+        return {"tools": [{"name": "echo", "description": "回显", "inputSchema": {"type": "object"}}]}
+    if method == "tools/call":
+        arguments = params.get("arguments") or {}
+        text = "x" * arguments["size"] if "size" in arguments else arguments.get("text", "")
+        return {"content": [{"type": "text", "text": text}], "isError": False}
+    return {}
+
+
+def main():
+    stdout = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        line = line.strip()
+        if not line:
+            continue
+        request = json.loads(line)
+        if "id" not in request:
+            continue
+        result = handle(request)
+        arguments = (request.get("params") or {}).get("arguments") or {}
+        if arguments.get("id_last"):
+            response = {"jsonrpc": "2.0", "result": result, "id": request["id"]}
+        else:
+            response = {"jsonrpc": "2.0", "id": request["id"], "result": result}
+        stdout.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
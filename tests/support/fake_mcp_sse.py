@@ -0,0 +1,110 @@
+"""
+本地HTTP+SSE MCP服务器替身（2024-11-05）
+
+基于aiohttp实现：GET /sse 为每个事件流开启新会话并先发送endpoint事件，
+POST /messages?session_id=... 提交的请求从对应会话的事件流返回响应。
+会话必须先完成initialize，否则返回 "request before initialization" 错误。
+drop_streams() 断开所有事件流，用于模拟网络中断后的重连。
+"""
+
+import asyncio
+import itertools
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+class FakeSession:
+    """一个事件流对应的服务器会话"""
+    __slots__ = ("session_id", "queue", "initialized")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.initialized = False
+
+
+class FakeMCPSSEServer:
+    """HTTP+SSE传输的MCP服务器"""
+
+    def __init__(self):
+        self.sessions: Dict[str, FakeSession] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self._ids = itertools.count(1)
+        self._streams: List[Tuple[web.Request, FakeSession]] = []
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/sse", self._stream)
+        app.router.add_post("/messages", self._message)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/sse"
+        return self.url
+
+    async def stop(self) -> None:
+        self.drop_streams()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def drop_streams(self) -> None:
+        """断开所有事件流连接"""
+        for request, session in self._streams:
+            if request.transport is not None:
+                request.transport.close()
+            # 连接断开不会取消处理协程，放入结束标记让它退出
+            session.queue.put_nowait(None)
+        self._streams.clear()
+
+    async def _stream(self, request: web.Request) -> web.StreamResponse:
+        session = FakeSession(f"s{next(self._ids)}")
+        self.sessions[session.session_id] = session
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        self._streams.append((request, session))
+        await response.write(f"event: endpoint\ndata: /messages?session_id={session.session_id}\n\n".encode())
+        try:
+            while True:
+                message = await session.queue.get()
+                if message is None:
+                    break
+                await response.write(b"event: message\ndata: " + json.dumps(message).encode() + b"\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+
+    async def _message(self, request: web.Request) -> web.Response:
+        session = self.sessions.get(request.query.get("session_id", ""))
+        if session is None:
+            return web.Response(status=404, text="unknown session")
+        body = await request.json()
+        self.requests.append({"session_id": session.session_id, **body})
+        if "id" not in body:
+            if body.get("method") == "notifications/initialized":
+                session.initialized = True
+            return web.Response(status=202)
+
+        method = body.get("method")
+        reply: Dict[str, Any] = {"jsonrpc": "2.0", "id": body["id"]}
+        if method == "initialize":
+            reply["result"] = {
+                "protocolVersion": "2024-11-05",
+                "capabilities": {"tools": {}},
+                "serverInfo": {"name": "fake-sse", "version": "1.0.0"},
+            }
+        elif not session.initialized:
+            reply["error"] = {"code": -32600, "message": "request before initialization"}
+        elif method == "tools/call":
+            text = (body.get("params") or {}).get("arguments", {}).get("text", "")
+            reply["result"] = {"content": [{"type": "text", "text": text}], "isError": False}
+        else:
+            reply["result"] = {}
+        session.queue.put_nowait(reply)
+        return web.Response(status=202)
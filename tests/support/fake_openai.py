@@ -0,0 +1,181 @@
+"""
+本地OpenAI兼容端点替身
+
+基于aiohttp实现 /v1/chat/completions（流式与非流式），可以注入首字延迟、
+块间延迟、错误状态码和流式中途断开，并记录收到的请求和最大并发数。
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeReply:
+    """一次补全的回复内容"""
+    __slots__ = ("content", "tool_calls", "chunk_size")
+
+    def __init__(self, content: str = "", tool_calls: Optional[List[Dict[str, str]]] = None, chunk_size: int = 8):
+        self.content = content
+        # [{"id": ..., "name": ..., "arguments": ...}]
+        self.tool_calls = tool_calls or []
+        self.chunk_size = chunk_size
+
+
+class FakeOpenAIServer:
+    """OpenAI兼容的本地HTTP端点"""
+
+    def __init__(
+        self,
+        reply: Optional[Callable[[Dict[str, Any]], FakeReply]] = None,
+        ttft: float = 0.0,
+        chunk_delay: float = 0.0,
+        status: int = 200,
+        drop_after: Optional[int] = None
+    ):
+        self.reply = reply or (lambda body: FakeReply("ok"))
+        self.ttft = ttft                # 返回响应头（首个数据块）之前的延迟
+        self.chunk_delay = chunk_delay  # 流式数据块之间的延迟
+        self.status = status            # 非200时直接返回错误
+        self.drop_after = drop_after    # 流式响应发送该数量的数据块后断开连接
+
+        self.requests: List[Dict[str, Any]] = []
+        self.active = 0
+        self.max_active = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "FakeOpenAIServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests.append(body)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.ttft:
+                await asyncio.sleep(self.ttft)
+            if self.status != 200:
+                return web.json_response(
+                    {"error": {"message": "injected failure", "type": "server_error"}},
+                    status=self.status
+                )
+            reply = self.reply(body)
+            if not body.get("stream"):
+                return web.json_response(_completion(body, reply))
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i, chunk in enumerate(_chunks(body, reply)):
+                if self.drop_after is not None and i >= self.drop_after:
+                    # 模拟上游中途断开
+                    request.transport.close()
+                    return response
+                if i and self.chunk_delay:
+                    await asyncio.sleep(self.chunk_delay)
+                await response.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.active -= 1
+
+
+def _usage(body: Dict[str, Any], reply: FakeReply) -> Dict[str, Any]:
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in body.get("messages", []))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(reply.content),
+        "total_tokens": prompt_tokens + len(reply.content),
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+
+def _completion(body: Dict[str, Any], reply: FakeReply) -> Dict[str, Any]:
+    message: Dict[str, Any] = {"role": "assistant", "content": reply.content}
+    if reply.tool_calls:
+        message["tool_calls"] = [
+            {"id": tc["id"], "type": "function", "function": {"name": tc["name"], "arguments": tc["arguments"]}}
+            for tc in reply.tool_calls
+        ]
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake-model"),
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": "tool_calls" if reply.tool_calls else "stop",
+        }],
+        "usage": _usage(body, reply),
+    }
+
+
+def _chunks(body: Dict[str, Any], reply: FakeReply):
+    """按OpenAI流式格式拆分回复：角色块、内容块、工具调用增量、结束块、用量块"""
+    model = body.get("model", "fake-model")
+
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    yield chunk({"role": "assistant", "content": ""})
+    size = max(1, reply.chunk_size)
+    for start in range(0, len(reply.content), size):
+        yield chunk({"content": reply.content[start:start + size]})
+    for index, tc in enumerate(reply.tool_calls):
+        yield chunk({"tool_calls": [{
+            "index": index, "id": tc["id"], "type": "function",
+            "function": {"name": tc["name"], "arguments": ""},
+        }]})
+        arguments = tc["arguments"]
+        for start in range(0, len(arguments), size):
+            yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + size]}}]})
+    yield chunk({}, "tool_calls" if reply.tool_calls else "stop")
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": model,
+            "choices": [],
+            "usage": _usage(body, reply),
+        }
+
+
+def make_endpoint(name: str, server: FakeOpenAIServer, **kwargs):
+    """创建指向替身服务器的网关端点（关闭SDK自带的重试，由网关负责切换）"""
+    from openai import AsyncOpenAI
+    from backend.services.llm_gateway import LLMEndpoint
+
+    client = AsyncOpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+    return LLMEndpoint(name, client, **kwargs)
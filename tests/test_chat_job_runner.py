@@ -0,0 +1,126 @@
+"""聊天生成任务运行器测试"""
+
+import asyncio
+import contextvars
+
+import pytest
+
+from backend.services.chat_job_runner import ChatJobRejected, ChatJobRunner
+from backend.services.stream_cancellation import StreamCancellationRegistry
+
+
+request_var: contextvars.ContextVar = contextvars.ContextVar("request_var", default=None)
+
+
+@pytest.fixture
+async def runner():
+    runner = ChatJobRunner(workers=1, queue_max=2, per_user_limit=1, per_user_pending_max=2)
+    yield runner
+    await runner.shutdown()
+
+
+async def test_cancelled_queued_jobs_leave_the_queue(runner):
+    registry = StreamCancellationRegistry()
+    release = asyncio.Event()
+    finished = []
+
+    def make_job(handle, name):
+        async def produce():
+            if handle.cancelled:
+                finished.append(f"{name}:cancelled")
+                return
+            await release.wait()
+            finished.append(f"{name}:done")
+        return produce
+
+    running = registry.create(user_id=1)
+    runner.submit(1, running, make_job(running, "running"))
+    await asyncio.sleep(0.01)
+
+    queued = [registry.create(user_id=1) for _ in range(2)]
+    for i, handle in enumerate(queued):
+        runner.submit(1, handle, make_job(handle, f"queued{i}"))
+    with pytest.raises(ChatJobRejected):
+        runner.check_admission(1)
+
+    # 排队中被停止的任务立即让出名额，并执行自身的结束流程
+    assert queued[0].cancel("stop") is True
+    assert runner.get_stats()["pending"] == 1
+    runner.check_admission(1)
+    await queued[0].wait(1)
+    assert finished == ["queued0:cancelled"]
+
+    # 重复取消不会重复处理
+    assert queued[0].cancel("stop") is False
+
+    release.set()
+    while queued[1].task is None:
+        await asyncio.sleep(0.01)
+    await queued[1].wait(1)
+    assert finished == ["queued0:cancelled", "running:done", "queued1:done"]
+    assert runner.get_stats()["pending"] == 0
+
+
+async def test_workers_do_not_inherit_request_context(runner):
+    registry = StreamCancellationRegistry()
+    seen = []
+
+    async def submit(value):
+        request_var.set(value)
+        handle = registry.create(user_id=value)
+
+        async def produce():
+            seen.append(request_var.get())
+
+        runner.submit(value, handle, produce)
+        return handle
+
+    # 第一个请求的上下文中启动了工作协程
+    first = await asyncio.create_task(submit("first-request"))
+    while first.task is None:
+        await asyncio.sleep(0.01)
+    await first.wait(1)
+
+    assert seen == [None]
+
+
+@pytest.mark.parametrize("resumable", [False, True])
+async def test_client_disconnect_while_queued(runner, monkeypatch, resumable):
+    from backend.api.v1.endpoints.chat import _release_stream
+    from backend.core.config import settings
+
+    monkeypatch.setattr(settings, "CHAT_STREAM_RESUMABLE", resumable)
+    registry = StreamCancellationRegistry()
+    release = asyncio.Event()
+    generated = []
+
+    async def blocking():
+        await release.wait()
+
+    running = registry.create(user_id=1)
+    runner.submit(1, running, blocking)
+    await asyncio.sleep(0.01)
+
+    queued = registry.create(user_id=1)
+
+    async def produce():
+        if queued.cancelled:
+            return
+        generated.append("queued")
+
+    runner.submit(1, queued, produce)
+    # 排队期间客户端断开（SSE生成器的finally）
+    _release_stream(queued)
+
+    if resumable:
+        assert not queued.cancelled
+        assert runner.get_stats()["pending"] == 1
+    else:
+        assert queued.cancel_reason == "client_disconnected"
+        assert runner.get_stats()["pending"] == 0
+
+    release.set()
+    while queued.task is None:
+        await asyncio.sleep(0.01)
+    await queued.wait(1)
+    assert generated == (["queued"] if resumable else [])
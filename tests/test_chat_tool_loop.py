@@ -0,0 +1,119 @@
+"""工具调用循环引擎测试：使用本地OpenAI替身端点和替身工具执行"""
+
+import json
+
+import pytest
+
+from backend.services.chat_tool_handler import chat_tool_handler
+from backend.services.chat_tool_loop import ToolLoopEngine, ToolLoopEvent
+from backend.services.llm_gateway import LLMGateway
+from backend.services.openai_client import openai_client_service
+from tests.support.fake_openai import FakeOpenAIServer, FakeReply, make_endpoint
+
+
+def tool_call(i: int, name: str = "get_time"):
+    return {"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": json.dumps({"n": i})}}
+
+
+@pytest.fixture
+def fake_tools(monkeypatch):
+    """替换工具执行，记录调用的工具ID"""
+    executed = []
+
+    async def handle_tool_calls(tool_calls, agent, db=None, session_id=None, **kwargs):
+        results = []
+        for tc in tool_calls:
+            executed.append(tc.id)
+            results.append({"role": "tool", "tool_call_id": tc.id, "content": json.dumps({"ok": tc.id})})
+        return results, []
+
+    monkeypatch.setattr(chat_tool_handler, "handle_tool_calls", handle_tool_calls)
+    return executed
+
+
+@pytest.fixture
+async def use_server(monkeypatch):
+    """启动替身端点并让 openai_client_service 通过它发起请求"""
+    started = []
+
+    async def start(server: FakeOpenAIServer) -> None:
+        await server.start()
+        endpoint = make_endpoint("fake", server)
+        started.append((server, endpoint))
+        monkeypatch.setattr(openai_client_service, "_gateway", LLMGateway([endpoint]))
+
+    yield start
+    for server, endpoint in started:
+        await endpoint.client.close()
+        await server.stop()
+
+
+def make_engine(stream: bool = True, **kwargs) -> ToolLoopEngine:
+    return ToolLoopEngine(
+        messages=[{"role": "user", "content": "hi"}],
+        agent=None,
+        use_model="fake-model",
+        max_tokens=100,
+        temperature=0,
+        top_p=1,
+        tools=[],
+        has_tools=False,
+        session_id=1,
+        stream=stream,
+        follow_up_per_tool=stream,
+        **kwargs
+    )
+
+
+async def collect(engine: ToolLoopEngine, calls):
+    return [event async for event in engine.run("", calls)]
+
+
+def statuses(events, kind):
+    return [e.data for e in events if e.kind == ToolLoopEvent.STATUS and e.data["type"] == kind]
+
+
+@pytest.mark.parametrize("stream", [True, False])
+async def test_follow_up_text_and_new_tool_calls(use_server, fake_tools, stream):
+    def reply(body):
+        tool_messages = sum(1 for m in body["messages"] if m["role"] == "tool")
+        if tool_messages == 1:
+            return FakeReply("再查一次", tool_calls=[{"id": "call_9", "name": "get_time", "arguments": '{"n": 9}'}])
+        return FakeReply("完成")
+
+    await use_server(FakeOpenAIServer(reply))
+    engine = make_engine(stream)
+    events = await collect(engine, [tool_call(1)])
+
+    assert fake_tools == ["call_1", "call_9"]
+    assert engine.final_content == "再查一次完成"
+    assert len(statuses(events, "tool_call_completed")) == 2
+    assert statuses(events, "tools_processing_completed")[0]["total_iterations"] == 2
+
+
+@pytest.mark.parametrize("stream", [True, False])
+async def test_follow_up_error_reported_as_tool_failure(use_server, fake_tools, stream):
+    await use_server(FakeOpenAIServer(status=400))
+    engine = make_engine(stream)
+    events = await collect(engine, [tool_call(1), tool_call(2)])
+
+    # 后续请求失败不会中断循环，逐个模式下继续执行下一个工具
+    failed = statuses(events, "tool_call_failed")
+    if stream:
+        assert fake_tools == ["call_1", "call_2"]
+        assert [f["tool_call_id"] for f in failed] == ["call_1", "call_2"]
+    else:
+        assert sorted(f["tool_call_id"] for f in failed) == ["call_1", "call_2"]
+    assert all(r["status"] == "failed" for r in engine.interaction_flow if r["type"] == "tool_call")
+    assert statuses(events, "tools_processing_completed")
+
+
+async def test_follow_up_errors_end_after_batch(use_server, fake_tools):
+    await use_server(FakeOpenAIServer(status=400))
+    engine = make_engine(max_consecutive_failures=2)
+    events = await collect(engine, [tool_call(i) for i in range(4)])
+
+    # 工具本身执行成功会重置连续失败计数，每个工具各尝试一次后循环结束
+    assert fake_tools == ["call_0", "call_1", "call_2", "call_3"]
+    assert len(statuses(events, "tool_call_failed")) == 4
+    assert engine.iteration == 1
@@ -0,0 +1,277 @@
+"""LLM网关测试：使用多个注入了延迟和故障的本地OpenAI替身端点"""
+
+import asyncio
+import gc
+import json
+import time
+
+import pytest
+
+from backend.services.chat_tool_handler import chat_tool_handler
+from backend.services.chat_tool_loop import ToolLoopEngine, ToolLoopEvent
+from backend.services.llm_gateway import GatewayStream, LLMGateway
+from backend.services.openai_client import openai_client_service
+from tests.support.fake_openai import FakeOpenAIServer, FakeReply, make_endpoint
+
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+DROPPED_WARNING = "未关闭就被丢弃"
+
+
+@pytest.fixture
+async def endpoints():
+    """启动替身服务器并创建对应的网关端点，测试结束后全部关闭"""
+    created = []
+
+    async def create(name: str, server: FakeOpenAIServer, **kwargs):
+        await server.start()
+        endpoint = make_endpoint(name, server, **kwargs)
+        created.append((server, endpoint))
+        return endpoint
+
+    yield create
+    for server, endpoint in created:
+        await endpoint.client.close()
+        await server.stop()
+
+
+async def read_text(stream) -> str:
+    parts = []
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+    return "".join(parts)
+
+
+async def test_routes_to_lower_ttft_endpoint(endpoints):
+    slow_server = FakeOpenAIServer(lambda body: FakeReply("slow"), ttft=0.05)
+    fast_server = FakeOpenAIServer(lambda body: FakeReply("fast"))
+    slow = await endpoints("slow", slow_server)
+    fast = await endpoints("fast", fast_server)
+    gateway = LLMGateway([slow, fast])
+
+    # 尚无测量数据的端点先被探测，之后按首字延迟路由
+    texts = [await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True))
+             for _ in range(6)]
+
+    assert len(slow_server.requests) == 1
+    assert texts[2:] == ["fast"] * 4
+    assert fast.ttft_ewma < slow.ttft_ewma
+    assert slow.inflight == fast.inflight == 0
+
+
+async def test_routes_by_model(endpoints):
+    a_server = FakeOpenAIServer(lambda body: FakeReply("a"))
+    b_server = FakeOpenAIServer(lambda body: FakeReply("b"))
+    gateway = LLMGateway([
+        await endpoints("a", a_server, models=["model-a"]),
+        await endpoints("b", b_server, models=["model-b"]),
+    ])
+
+    response = await gateway.create_chat_completion(model="model-b", messages=MESSAGES)
+
+    assert response.choices[0].message.content == "b"
+    assert not a_server.requests
+
+
+@pytest.mark.parametrize("stream", [True, False])
+async def test_fails_over_on_server_error(endpoints, stream):
+    broken = await endpoints("broken", FakeOpenAIServer(status=503))
+    healthy = await endpoints("healthy", FakeOpenAIServer(lambda body: FakeReply("ok")))
+    gateway = LLMGateway([broken, healthy])
+
+    response = await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=stream)
+    text = await read_text(response) if stream else response.choices[0].message.content
+
+    assert text == "ok"
+    assert broken.failures == 1
+    assert broken.inflight == healthy.inflight == 0
+
+
+async def test_fails_over_when_stream_drops_before_content(endpoints):
+    # 只发送了角色块就断开，调用方还没有收到任何内容
+    dropping = await endpoints("dropping", FakeOpenAIServer(lambda body: FakeReply("lost"), drop_after=1))
+    healthy_server = FakeOpenAIServer(lambda body: FakeReply("ok"))
+    healthy = await endpoints("healthy", healthy_server)
+    gateway = LLMGateway([dropping, healthy])
+
+    text = await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True))
+
+    assert text == "ok"
+    assert dropping.failures == 1
+    assert len(healthy_server.requests) == 1
+    assert dropping.inflight == healthy.inflight == 0
+
+
+async def test_no_failover_after_content_was_sent(endpoints):
+    dropping = await endpoints(
+        "dropping", FakeOpenAIServer(lambda body: FakeReply("abcdefgh" * 4, chunk_size=8), drop_after=3)
+    )
+    healthy_server = FakeOpenAIServer(lambda body: FakeReply("ok"))
+    gateway = LLMGateway([dropping, await endpoints("healthy", healthy_server)])
+
+    stream = await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+    received = []
+    with pytest.raises(Exception):
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                received.append(chunk.choices[0].delta.content)
+
+    assert received == ["abcdefgh", "abcdefgh"]
+    assert not healthy_server.requests
+    assert dropping.failures == 1
+    assert dropping.inflight == 0
+
+
+@pytest.mark.parametrize("stream", [True, False])
+async def test_request_errors_are_not_retried(endpoints, stream):
+    bad_server = FakeOpenAIServer(status=400)
+    other_server = FakeOpenAIServer()
+    bad = await endpoints("bad", bad_server)
+    other = await endpoints("other", other_server)
+    gateway = LLMGateway([bad, other])
+
+    for _ in range(5):
+        with pytest.raises(Exception) as exc_info:
+            await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=stream)
+        assert getattr(exc_info.value, "status_code", None) == 400
+
+    assert len(bad_server.requests) + len(other_server.requests) == 5
+    # 请求本身的错误不影响端点健康：错误率、冷却和得分都不变
+    for endpoint in (bad, other):
+        assert endpoint.failures == 0
+        assert endpoint.error_ewma == 0
+        assert not endpoint.cooling_down(time.monotonic())
+        assert endpoint.inflight == 0
+
+
+async def test_request_errors_leave_score_unchanged(endpoints):
+    server = FakeOpenAIServer(lambda body: FakeReply("ok"))
+    endpoint = await endpoints("single", server)
+    gateway = LLMGateway([endpoint])
+    assert await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)) == "ok"
+    score = endpoint.score()
+
+    # 例如上下文超长：请求被端点拒绝，但端点本身是健康的
+    server.status = 400
+    for _ in range(5):
+        with pytest.raises(Exception):
+            await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+
+    assert endpoint.score() == score
+    assert endpoint.consecutive_failures == 0
+
+
+async def test_concurrency_cap_per_endpoint(endpoints):
+    server = FakeOpenAIServer(lambda body: FakeReply("x" * 32), ttft=0.02, chunk_delay=0.005)
+    endpoint = await endpoints("capped", server, max_concurrency=2)
+    gateway = LLMGateway([endpoint])
+
+    async def one():
+        return await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True))
+
+    texts = await asyncio.gather(*(one() for _ in range(8)))
+
+    assert texts == ["x" * 32] * 8
+    assert server.max_active == 2
+    assert endpoint.requests == 8
+    assert endpoint.inflight == 0
+
+
+async def test_queue_timeout_when_endpoint_is_full(endpoints):
+    endpoint = await endpoints("single", FakeOpenAIServer(), max_concurrency=1)
+    gateway = LLMGateway([endpoint], queue_timeout=0.05)
+
+    held = await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+    with pytest.raises(RuntimeError, match="并发已满"):
+        await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+
+    await held.aclose()
+    assert await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)) == "ok"
+
+
+async def test_closing_unconsumed_streams_releases_permits(endpoints):
+    endpoint = await endpoints("capped", FakeOpenAIServer(), max_concurrency=2)
+    gateway = LLMGateway([endpoint], queue_timeout=0.5)
+
+    for _ in range(3):
+        streams = [await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True) for _ in range(2)]
+        assert all(isinstance(s, GatewayStream) for s in streams)
+        assert endpoint.inflight == 2
+        for stream in streams:
+            await stream.aclose()
+            await stream.aclose()  # 重复关闭不会多释放
+        assert endpoint.inflight == 0
+
+    # 关闭后继续迭代直接结束
+    stream = await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+    await stream.aclose()
+    assert await read_text(stream) == ""
+    assert endpoint.inflight == 0
+
+
+async def test_dropped_stream_releases_permit(endpoints, caplog):
+    endpoint = await endpoints("capped", FakeOpenAIServer(), max_concurrency=1)
+    gateway = LLMGateway([endpoint], queue_timeout=0.5)
+
+    stream = await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)
+    del stream
+    gc.collect()
+    await asyncio.sleep(0)
+
+    # 兜底释放会记录警告，正常路径应当显式关闭
+    assert DROPPED_WARNING in caplog.text
+    assert endpoint.inflight == 0
+    assert await read_text(await gateway.create_chat_completion(model="m", messages=MESSAGES, stream=True)) == "ok"
+
+
+async def test_tool_loop_stop_releases_unconsumed_follow_up(endpoints, monkeypatch, caplog):
+    """工具执行完成后、后续响应被读取前停止，后续请求的名额必须释放"""
+    endpoint = await endpoints("capped", FakeOpenAIServer(lambda body: FakeReply("answer")), max_concurrency=2)
+    monkeypatch.setattr(openai_client_service, "_gateway", LLMGateway([endpoint], queue_timeout=0.5))
+
+    async def handle_tool_calls(tool_calls, agent, db=None, session_id=None, **kwargs):
+        return [{"role": "tool", "tool_call_id": tc.id, "content": json.dumps({"ok": True})} for tc in tool_calls], []
+
+    monkeypatch.setattr(chat_tool_handler, "handle_tool_calls", handle_tool_calls)
+    call = {"id": "call_1", "type": "function", "function": {"name": "get_time", "arguments": "{}"}}
+
+    for _ in range(3):
+        engine = ToolLoopEngine(
+            messages=list(MESSAGES), agent=None, use_model="m", max_tokens=10, temperature=0, top_p=1,
+            tools=[], has_tools=False, session_id=1
+        )
+        events = engine.run("", [call])
+        async for event in events:
+            if event.kind == ToolLoopEvent.STATUS and event.data["type"] == "tool_call_completed":
+                # 等后续请求返回后再停止
+                await asyncio.sleep(0.1)
+                break
+        await events.aclose()
+        assert endpoint.inflight == 0
+
+    # 停在后续响应读取到一半时同样释放
+    engine = ToolLoopEngine(
+        messages=list(MESSAGES), agent=None, use_model="m", max_tokens=10, temperature=0, top_p=1,
+        tools=[], has_tools=False, session_id=1
+    )
+    events = engine.run("", [call])
+    async for event in events:
+        if event.kind == ToolLoopEvent.CONTENT:
+            break
+    await events.aclose()
+    assert endpoint.inflight == 0
+    # 名额由引擎显式关闭释放，而不是靠垃圾回收兜底
+    assert DROPPED_WARNING not in caplog.text
+
+
+async def test_records_cached_prompt_tokens(endpoints):
+    endpoint = await endpoints("usage", FakeOpenAIServer(lambda body: FakeReply("ok")))
+    gateway = LLMGateway([endpoint])
+
+    await read_text(await gateway.create_chat_completion(
+        model="m", messages=MESSAGES, stream=True, stream_options={"include_usage": True}
+    ))
+
+    assert endpoint.prompt_tokens == len("hi")
+    assert endpoint.get_stats()["cache_hit_rate"] == 0
@@ -0,0 +1,51 @@
+"""提示词布局测试"""
+
+import json
+
+from backend.services.prompt_layout import prompt_layout
+
+
+def make_tool(name, properties, required, **extra):
+    tool = {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": f"{name} tool",
+            "parameters": {"type": "object", "properties": properties, "required": required},
+        },
+    }
+    tool.update(extra)
+    return tool
+
+
+def test_strips_only_top_level_private_fields():
+    tool = make_tool(
+        "mcp_lookup",
+        {"_id": {"type": "string"}, "query": {"type": "string", "_hint": "kept"}},
+        ["_id", "query"],
+        _mcp_metadata={"server_id": 1},
+    )
+
+    [result] = prompt_layout.canonicalize_tools([tool])
+
+    assert "_mcp_metadata" not in result
+    parameters = result["function"]["parameters"]
+    # 参数schema中以下划线开头的属性名保留，required仍然与属性一致
+    assert set(parameters["properties"]) == {"_id", "query"}
+    assert parameters["properties"]["query"]["_hint"] == "kept"
+    assert set(parameters["required"]) <= set(parameters["properties"])
+    assert "_mcp_metadata" in tool
+
+
+def test_tools_sorted_and_serialization_is_stable():
+    a = make_tool("b_tool", {"z": {"type": "string"}, "a": {"type": "integer"}}, ["z"])
+    b = make_tool("a_tool", {}, [])
+    reordered = json.loads(json.dumps(a))
+    reordered["function"] = dict(reversed(list(reordered["function"].items())))
+
+    first = prompt_layout.canonicalize_tools([a, b])
+    second = prompt_layout.canonicalize_tools([b, reordered])
+
+    assert [t["function"]["name"] for t in first] == ["a_tool", "b_tool"]
+    assert json.dumps(first) == json.dumps(second)
+    assert list(first[1]["function"]["parameters"]["properties"]) == ["a", "z"]
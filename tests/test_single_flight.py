@@ -0,0 +1,265 @@
+"""single-flight请求合并测试：相同键的并发调用只触发一次上游请求"""
+
+import asyncio
+
+import pytest
+
+from backend.mcp.client.session_manager import MCPSessionManager
+from backend.mcp.schemas.protocol import Tool, ToolAnnotations, ToolInputSchema
+from backend.services.tools import ToolsService
+from backend.utils.single_flight import SingleFlight, make_call_key
+
+
+N = 20
+
+
+class Upstream:
+    """记录调用次数的上游，等待 release 后才返回"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def fetch(self, emit=None):
+        self.calls += 1
+        if emit is not None:
+            emit("first")
+        await self.release.wait()
+        if emit is not None:
+            emit("second")
+        return {"value": 42}
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_make_call_key_ignores_dict_order():
+    assert make_call_key("t", {"a": 1, "b": 2}) == make_call_key("t", {"b": 2, "a": 1})
+    assert make_call_key("t", {"a": 1}) != make_call_key("t", {"a": 2})
+
+
+async def test_identical_calls_hit_upstream_once():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+
+    callers = [asyncio.create_task(flight.do("k", upstream.fetch)) for _ in range(N)]
+    await settle()
+    assert flight.inflight_count() == 1
+    upstream.release.set()
+    results = await asyncio.gather(*callers)
+
+    assert upstream.calls == 1
+    assert all(r == {"value": 42} for r in results)
+    assert flight.get_stats() == {"executed": 1, "shared": N - 1, "inflight": 0}
+
+
+async def test_different_keys_are_not_coalesced():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+    upstream.release.set()
+
+    await asyncio.gather(flight.do("a", upstream.fetch), flight.do("b", upstream.fetch))
+
+    assert upstream.calls == 2
+
+
+async def test_no_result_caching_after_completion():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+    upstream.release.set()
+
+    await flight.do("k", upstream.fetch)
+    await flight.do("k", upstream.fetch)
+
+    assert upstream.calls == 2
+
+
+async def test_error_is_shared_and_key_released():
+    flight = SingleFlight("test")
+    calls = 0
+    release = asyncio.Event()
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        raise ValueError("boom")
+
+    callers = [asyncio.create_task(flight.do("k", failing)) for _ in range(N)]
+    await settle()
+    release.set()
+    results = await asyncio.gather(*callers, return_exceptions=True)
+
+    assert calls == 1
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.inflight_count() == 0
+
+
+async def test_progress_fans_out_to_all_callers():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+    received = [[] for _ in range(N)]
+
+    callers = [
+        asyncio.create_task(flight.do_with_progress("k", upstream.fetch, received[i].append))
+        for i in range(N)
+    ]
+    await settle()
+    upstream.release.set()
+    await asyncio.gather(*callers)
+
+    assert upstream.calls == 1
+    # 上游开始后才加入的调用方只能收到之后的中间结果
+    assert received[0] == ["first", "second"]
+    assert all("second" in items for items in received)
+    assert flight._listeners == {}
+
+
+async def test_cancelled_caller_does_not_cancel_upstream():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+    leader_received = []
+    received = []
+
+    leader = asyncio.create_task(flight.do_with_progress("k", upstream.fetch, leader_received.append))
+    follower = asyncio.create_task(flight.do_with_progress("k", upstream.fetch, received.append))
+    await settle()
+
+    leader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    upstream.release.set()
+
+    assert await follower == {"value": 42}
+    assert upstream.calls == 1
+    # 已取消的调用方不再收到中间结果，剩余调用方照常收到
+    assert leader_received == ["first"]
+    assert received == ["first", "second"]
+
+
+async def test_all_callers_cancelled_upstream_still_finishes():
+    flight = SingleFlight("test")
+    upstream = Upstream()
+
+    callers = [asyncio.create_task(flight.do("k", upstream.fetch)) for _ in range(3)]
+    await settle()
+    for caller in callers:
+        caller.cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    assert flight.inflight_count() == 1
+
+    upstream.release.set()
+    await settle()
+    assert flight.inflight_count() == 0
+    assert upstream.calls == 1
+
+
+class SlowSearchTool:
+    """只读网络工具的替身"""
+    calls = 0
+    release: asyncio.Event
+
+    async def search(self, query):
+        SlowSearchTool.calls += 1
+        await SlowSearchTool.release.wait()
+        return {"query": query, "results": []}
+
+
+async def test_tools_service_coalesces_identical_calls(monkeypatch):
+    service = ToolsService()
+    SlowSearchTool.calls = 0
+    SlowSearchTool.release = asyncio.Event()
+    monkeypatch.setitem(service.available_tools, "tavily", SlowSearchTool)
+
+    callers = [
+        asyncio.create_task(service.execute_tool_async("tavily", "search", {"query": "q"}))
+        for _ in range(N)
+    ]
+    await settle()
+    SlowSearchTool.release.set()
+    results = await asyncio.gather(*callers)
+
+    assert SlowSearchTool.calls == 1
+    assert all(r == {"query": "q", "results": []} for r in results)
+    # 每个调用方拿到独立的副本
+    assert len({id(r) for r in results}) == N
+
+
+async def test_tools_service_does_not_coalesce_write_tools(monkeypatch):
+    service = ToolsService()
+    SlowSearchTool.calls = 0
+    SlowSearchTool.release = asyncio.Event()
+    SlowSearchTool.release.set()
+    monkeypatch.setitem(service.available_tools, "get_time", SlowSearchTool)
+
+    await asyncio.gather(*(service.execute_tool_async("get_time", "search", {"query": "q"}) for _ in range(3)))
+
+    assert SlowSearchTool.calls == 3
+
+
+class FakeMCPClient:
+    is_connected = True
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.tools = {
+            "lookup": Tool(name="lookup", inputSchema=ToolInputSchema(), annotations=ToolAnnotations(readOnlyHint=True)),
+            "create_note": Tool(name="create_note", inputSchema=ToolInputSchema(),
+                                annotations=ToolAnnotations(readOnlyHint=False, destructiveHint=False)),
+            "unannotated": Tool(name="unannotated", inputSchema=ToolInputSchema()),
+        }
+
+    def cached_tool(self, name):
+        return self.tools.get(name)
+
+    async def call_tool(self, tool_name, arguments=None, progress_callback=None):
+        self.calls += 1
+        if progress_callback is not None:
+            progress_callback({"progress": 1})
+        await self.release.wait()
+        return {"tool": tool_name, "arguments": arguments}
+
+
+async def test_session_manager_coalesces_mcp_tool_calls():
+    manager = MCPSessionManager()
+    client = FakeMCPClient()
+    manager._clients[1] = client
+    progress = [[] for _ in range(N)]
+
+    callers = [
+        asyncio.create_task(manager.call_tool(1, "lookup", {"id": 7}, progress_callback=progress[i].append))
+        for i in range(N)
+    ]
+    await settle()
+    client.release.set()
+    results = await asyncio.gather(*callers)
+
+    assert client.calls == 1
+    assert all(r == {"tool": "lookup", "arguments": {"id": 7}} for r in results)
+    assert progress[0] == [{"progress": 1}]
+
+    # 参数不同的调用不合并
+    await asyncio.gather(manager.call_tool(1, "lookup", {"id": 1}), manager.call_tool(1, "lookup", {"id": 2}))
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("tool_name", ["create_note", "unannotated", "unknown"])
+async def test_session_manager_does_not_coalesce_write_tools(tool_name):
+    manager = MCPSessionManager()
+    client = FakeMCPClient()
+    manager._clients[1] = client
+
+    callers = [
+        asyncio.create_task(manager.call_tool(1, tool_name, {"title": "same"}))
+        for _ in range(3)
+    ]
+    await settle()
+    client.release.set()
+    results = await asyncio.gather(*callers)
+
+    # 两次相同的创建必须各自执行，不能合并成一次写入
+    assert client.calls == 3
+    assert len({id(r) for r in results}) == 3
@@ -0,0 +1,71 @@
+"""HTTP+SSE传输测试：使用本地MCP服务器替身验证断线重连后的会话处理"""
+
+import asyncio
+
+import pytest
+
+from backend.core.config import settings
+from backend.mcp.client.mcp_client import MCPClient
+from backend.mcp.client.transport import http_client_pool
+from backend.mcp.schemas.exceptions import MCPConnectionError
+from tests.support.fake_mcp_sse import FakeMCPSSEServer
+
+
+@pytest.fixture
+async def server(monkeypatch):
+    monkeypatch.setattr(settings, "MCP_HTTP_RECONNECT_BASE_DELAY", 0.01)
+    monkeypatch.setattr(settings, "MCP_HTTP_RECONNECT_MAX_DELAY", 0.05)
+    server = FakeMCPSSEServer()
+    await server.start()
+    yield server
+    await server.stop()
+    await http_client_pool.close()
+
+
+async def connect(server: FakeMCPSSEServer) -> MCPClient:
+    client = MCPClient("fake-sse", transport_config={"url": server.url}, timeout=2.0)
+    await client.connect("sse")
+    return client
+
+
+async def wait_until(predicate, timeout: float = 2.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+async def test_call_tool_over_sse(server):
+    client = await connect(server)
+    try:
+        result = await client.call_tool("echo", {"text": "hello"})
+        assert result.content[0]["text"] == "hello"
+        assert client.transport.message_url.endswith("session_id=s1")
+    finally:
+        await client.disconnect()
+
+
+async def test_new_session_after_reconnect_closes_transport(server):
+    client = await connect(server)
+    try:
+        # 重连后的新会话未初始化，传输层应关闭而不是把请求发到新会话
+        server.drop_streams()
+        await wait_until(lambda: "s2" in server.sessions)
+        await wait_until(lambda: not client.connected)
+
+        with pytest.raises(MCPConnectionError):
+            await client.call_tool("echo", {"text": "lost"})
+        assert not [r for r in server.requests if r["session_id"] == "s2"]
+    finally:
+        await client.disconnect()
+
+    # 重新连接会完成完整的初始化握手
+    client = await connect(server)
+    try:
+        result = await client.call_tool("echo", {"text": "again"})
+        assert result.content[0]["text"] == "again"
+        session_id = client.transport.message_url.rsplit("=", 1)[1]
+        assert server.sessions[session_id].initialized
+    finally:
+        await client.disconnect()
@@ -0,0 +1,112 @@
+"""stdio传输测试：分帧、超长消息处理，以及与本地回显服务器子进程的完整交互"""
+
+import asyncio
+import sys
+import time
+
+import pytest
+
+from backend.core.config import settings
+from backend.mcp.client.mcp_client import MCPClient
+from backend.mcp.client.transport import LineFramer, oversized_request_id
+from backend.mcp.schemas.exceptions import MCPParseError
+
+
+ECHO_SERVER = ["-m", "tests.support.echo_mcp_server"]
+
+
+def test_framer_splits_across_chunks():
+    framer = LineFramer(1024)
+    assert framer.feed(b'{"a": 1}\n{"b"') == [b'{"a": 1}']
+    assert framer.feed(b": 2}\n\n") == [b'{"b": 2}', b""]
+    assert framer.feed(b'{"c": 3}') == []
+    assert framer.flush() == b'{"c": 3}'
+
+
+def test_framer_skips_rest_of_oversized_line():
+    dropped = []
+    framer = LineFramer(16, lambda head, size: dropped.append((head, size)))
+
+    # 超长消息之前已完整的消息照常返回
+    assert framer.feed(b'{"ok": 1}\n{"id": 7, "result": "' + b"x" * 20) == [b'{"ok": 1}']
+    assert dropped == [(b'{"id": 7, "result": "' + b"x" * 20, 41)]
+    # 超长消息的剩余部分被跳过，不会被当作新消息
+    assert framer.feed(b"x" * 50) == []
+    assert framer.feed(b'xx"}\n{"next": 2}\n') == [b'{"next": 2}']
+    assert len(dropped) == 1
+
+
+def test_oversized_request_id():
+    assert oversized_request_id(b'{"jsonrpc": "2.0", "id": "srv_3_17", "result": {"content": [') == "srv_3_17"
+    assert oversized_request_id(b'{"jsonrpc":"2.0","id":42,"result"') == 42
+    assert oversized_request_id(b'{"jsonrpc": "2.0", "result": {"content": [{"text": "xxxx') is None
+
+
+@pytest.fixture
+async def echo_client(monkeypatch):
+    monkeypatch.setattr(settings, "MCP_STDIO_MAX_MESSAGE_BYTES", 64 * 1024)
+    monkeypatch.setattr(settings, "MCP_STDIO_READ_CHUNK", 4096)
+    client = MCPClient(
+        "echo",
+        transport_config={"command": sys.executable, "args": ECHO_SERVER, "env": {"PYTHONPATH": "."}},
+        timeout=5.0
+    )
+    await client.connect("stdio")
+    yield client
+    await client.disconnect()
+
+
+async def test_round_trip_with_large_message(echo_client):
+    result = await echo_client.call_tool("echo", {"size": 60 * 1024})
+    assert len(result.content[0]["text"]) == 60 * 1024
+    assert await echo_client.ping()
+
+
+async def test_oversized_response_fails_its_request_immediately(echo_client):
+    started = time.monotonic()
+    with pytest.raises(MCPParseError, match="最大长度"):
+        await echo_client.call_tool("echo", {"size": 200 * 1024})
+    assert time.monotonic() - started < echo_client.timeout / 2
+
+    # 并发的其他请求不受影响，之后的消息也能正常解析
+    small, big = await asyncio.gather(
+        echo_client.call_tool("echo", {"text": "small"}),
+        echo_client.call_tool("echo", {"size": 200 * 1024}),
+        return_exceptions=True
+    )
+    assert small.content[0]["text"] == "small"
+    assert isinstance(big, MCPParseError)
+    assert (await echo_client.call_tool("echo", {"text": "after"})).content[0]["text"] == "after"
+    assert echo_client.connected
+
+
+async def test_oversized_response_without_id_fails_pending_requests(echo_client):
+    with pytest.raises(MCPParseError):
+        await echo_client.call_tool("echo", {"size": 200 * 1024, "id_last": True})
+    assert (await echo_client.call_tool("echo", {"text": "after"})).content[0]["text"] == "after"
+
+
+async def test_concurrent_requests_share_writes_and_respect_inflight_limit(echo_client):
+    echo_client.max_inflight = 4
+    echo_client._inflight = asyncio.Semaphore(4)
+    transport = echo_client.transport
+    outstanding = {"now": 0, "max": 0}
+    send, on_message = transport.send, transport._on_message
+
+    async def counting_send(message):
+        outstanding["now"] += 1
+        outstanding["max"] = max(outstanding["max"], outstanding["now"])
+        await send(message)
+
+    def counting_on_message(message):
+        outstanding["now"] -= 1
+        on_message(message)
+
+    transport.send, transport._on_message = counting_send, counting_on_message
+    texts = [f"m{i}" for i in range(100)]
+    results = await asyncio.gather(*(echo_client.call_tool("echo", {"text": text}) for text in texts))
+
+    assert [r.content[0]["text"] for r in results] == texts
+    # 同一连接上未完成的请求不超过上限，同一轮事件循环发出的请求合并写入
+    assert outstanding["max"] == 4
+    assert transport.write_calls < transport.messages_sent / 2
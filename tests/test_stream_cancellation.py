@@ -0,0 +1,55 @@
+"""流式生成取消测试"""
+
+import asyncio
+
+from backend.services.stream_cancellation import StreamCancellationRegistry
+
+
+async def test_repeated_cancel_does_not_interrupt_partial_save():
+    registry = StreamCancellationRegistry()
+    handle = registry.create(user_id=1)
+    registry.bind(handle, "session-1")
+    saving = asyncio.Event()
+    saved = []
+
+    async def produce():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            # 与生成流程一样在取消后保存部分内容
+            saving.set()
+            await asyncio.sleep(0.05)
+            saved.append(handle.cancel_reason)
+            raise
+
+    handle.start(produce())
+    await asyncio.sleep(0)
+
+    assert registry.cancel("session-1", 1, "stop") is handle
+    await saving.wait()
+    # 停止后客户端断开、或重复点击停止
+    assert handle.cancel("client_disconnected") is True
+    assert registry.cancel("session-1", 1, "stop") is handle
+    await handle.wait(1)
+
+    assert saved == ["stop"]
+    assert handle.cancel_reason == "stop"
+    assert handle.cancel("stop") is False
+
+
+async def test_cancel_before_start_only_records_reason():
+    registry = StreamCancellationRegistry()
+    handle = registry.create(user_id=1)
+
+    assert handle.cancel("stop") is True
+    assert handle.cancelled
+    assert handle.task is None
+
+
+async def test_cancel_checks_owner():
+    registry = StreamCancellationRegistry()
+    handle = registry.create(user_id=1)
+    registry.bind(handle, "session-1")
+
+    assert registry.cancel("session-1", 2, "stop") is None
+    assert not handle.cancelled
@@ -0,0 +1,153 @@
+"""流式工具调用增量累积器测试"""
+
+import json
+
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall, ChoiceDeltaToolCallFunction
+
+from backend.services.tool_call_accumulator import ToolCallAccumulator, parse_arguments
+
+
+def delta(index=None, id=None, name=None, arguments=None, type=None):
+    return ChoiceDeltaToolCall.construct(
+        index=index,
+        id=id,
+        type=type,
+        function=ChoiceDeltaToolCallFunction(name=name, arguments=arguments)
+    )
+
+
+def fragments(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_indexed_deltas_accumulate_arguments():
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, "call_a", "read_note", ""))
+    for part in fragments('{"note_id": 12}', 3):
+        acc.add(delta(0, arguments=part))
+
+    [call] = acc.finalize()
+    assert call["id"] == "call_a"
+    assert call["type"] == "function"
+    assert call["function"] == {"name": "read_note", "arguments": '{"note_id": 12}'}
+    assert call["parsed_arguments"] == {"note_id": 12}
+
+
+def test_long_fragmented_payload_parsed_once_and_intact():
+    content = "第一段内容\n" * 2000 + '含有"引号"和\\反斜杠'
+    arguments = json.dumps({"note_id": 1, "content": content}, ensure_ascii=False)
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, "call_a", "edit_note"))
+    for part in fragments(arguments, 7):
+        acc.add(delta(0, arguments=part))
+
+    [call] = acc.finalize()
+    assert call["function"]["arguments"] == arguments
+    assert call["parsed_arguments"]["content"] == content
+
+
+def test_interleaved_indexes_finalize_in_index_order():
+    acc = ToolCallAccumulator()
+    acc.add(delta(1, "call_b", "second"))
+    acc.add(delta(0, "call_a", "first"))
+    acc.add(delta(1, arguments='{"b":'))
+    acc.add(delta(0, arguments='{"a": 1}'))
+    acc.add(delta(1, arguments=' 2}'))
+
+    calls = acc.finalize()
+    assert [c["id"] for c in calls] == ["call_a", "call_b"]
+    assert [c["parsed_arguments"] for c in calls] == [{"a": 1}, {"b": 2}]
+
+
+def test_index_less_deltas_follow_last_call():
+    acc = ToolCallAccumulator()
+    acc.add(delta(None, "call_a", "first", '{"x"'))
+    acc.add(delta(None, arguments=": 1}"))
+    acc.add(delta(None, "call_b", "second", "{}"))
+
+    calls = acc.finalize()
+    assert [c["id"] for c in calls] == ["call_a", "call_b"]
+    assert calls[0]["parsed_arguments"] == {"x": 1}
+    assert calls[1]["parsed_arguments"] == {}
+
+
+def test_index_less_deltas_match_by_id():
+    acc = ToolCallAccumulator()
+    acc.add(delta(None, "call_a", "first", '{"a":'))
+    acc.add(delta(None, "call_b", "second", '{"b":'))
+    acc.add(delta(None, "call_a", arguments=" 1}"))
+    acc.add(delta(None, "call_b", arguments=" 2}"))
+
+    calls = acc.finalize()
+    assert [c["parsed_arguments"] for c in calls] == [{"a": 1}, {"b": 2}]
+
+
+def test_index_less_delta_without_id_starts_first_call():
+    acc = ToolCallAccumulator()
+    acc.add(delta(None, None, "only", "{}"))
+
+    [call] = acc.finalize()
+    assert call["id"] == "call_0"
+    assert call["function"]["name"] == "only"
+
+
+def test_indexed_calls_come_before_index_less_calls():
+    acc = ToolCallAccumulator()
+    acc.add(delta(None, "call_x", "unindexed", "{}"))
+    acc.add(delta(0, "call_a", "indexed", "{}"))
+
+    assert [c["id"] for c in acc.finalize()] == ["call_a", "call_x"]
+
+
+def test_late_id_replaces_generated_id():
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, None, "tool", "{}"))
+    acc.add(delta(0, "call_real"))
+
+    assert acc.finalize()[0]["id"] == "call_real"
+
+
+def test_empty_arguments_parse_to_empty_dict():
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, "call_a", "note_reader"))
+
+    [call] = acc.finalize()
+    assert call["function"]["arguments"] == ""
+    assert call["parsed_arguments"] == {}
+
+
+def test_calls_without_name_are_dropped():
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, "call_a", None, "{}"))
+    acc.add(delta(1, "call_b", "named", "{}"))
+
+    assert [c["id"] for c in acc.finalize()] == ["call_b"]
+    assert len(acc) == 2
+
+
+def test_invalid_json_records_parse_error():
+    acc = ToolCallAccumulator()
+    acc.add(delta(0, "call_a", "tool", '{"a": '))
+
+    [call] = acc.finalize()
+    assert call["parsed_arguments"] is None
+    assert call["parse_error"]
+
+
+def test_non_object_json_is_rejected():
+    for arguments in ("[1, 2]", '"text"', "42", "null"):
+        acc = ToolCallAccumulator()
+        acc.add(delta(0, "call_a", "tool", arguments))
+
+        [call] = acc.finalize()
+        assert call["parsed_arguments"] is None, arguments
+        assert call["parse_error"] == "工具参数必须是JSON对象"
+
+
+def test_parse_arguments_reuses_cached_result():
+    tool_call = {"id": "c", "function": {"name": "t", "arguments": '{"a": 1}'}, "parsed_arguments": {"cached": True}}
+    assert parse_arguments(tool_call) == {"cached": True}
+
+    tool_call = {"id": "c", "function": {"name": "t", "arguments": '  {"a": 1}  '}}
+    assert parse_arguments(tool_call) == {"a": 1}
+    assert tool_call["parsed_arguments"] == {"a": 1}
@@ -0,0 +1,88 @@
+"""内置工具测试：Tavily流式内容提取"""
+
+import threading
+import time
+
+from backend.core.config import settings
+from backend.services.tools import TavilyTool, ToolsService
+
+
+URLS = [f"https://example.com/{i}" for i in range(6)]
+
+
+class CountingExtract:
+    """替换 TavilyTool.extract，记录请求和最大并发数"""
+
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, urls, include_images=False):
+        with self._lock:
+            self.calls.append(list(urls))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        with self._lock:
+            self.active -= 1
+        if urls[0].endswith("/3"):
+            return {"error": "API错误: 500"}
+        return {"results": [{"url": url, "raw_content": url} for url in urls], "failed_results": []}
+
+
+def make_tool(monkeypatch, api_key="tvly-test"):
+    tool = TavilyTool(api_key=api_key)
+    extract = CountingExtract()
+    monkeypatch.setattr(tool, "extract", extract)
+    return tool, extract
+
+
+async def collect(stream):
+    partials, result = [], None
+    async for item in stream:
+        if "partial" in item:
+            partials.append(item["partial"])
+        if "result" in item:
+            result = item["result"]
+    return partials, result
+
+
+async def test_extract_stream_caps_concurrency(monkeypatch):
+    monkeypatch.setattr(settings, "TAVILY_EXTRACT_CONCURRENCY", 2)
+    tool, extract = make_tool(monkeypatch)
+
+    partials, result = await collect(tool.extract_stream(URLS))
+
+    assert extract.max_active == 2
+    assert len(extract.calls) == len(URLS)
+    assert len(partials) == len(URLS)
+    assert sorted(r["url"] for r in result["results"]) == sorted(u for u in URLS if not u.endswith("/3"))
+    assert result["failed_results"] == [{"url": URLS[3], "error": "API错误: 500"}]
+
+
+async def test_extract_stream_without_api_key_matches_extract(monkeypatch):
+    tool = TavilyTool(api_key=None)
+    monkeypatch.setattr(tool, "api_key", None)
+
+    partials, result = await collect(tool.extract_stream(URLS))
+
+    assert partials == []
+    assert result == tool.extract(URLS) == {"error": "未提供API密钥"}
+
+
+async def test_extract_uses_one_request_without_progress_listener(monkeypatch):
+    service = ToolsService()
+    tool, extract = make_tool(monkeypatch)
+    monkeypatch.setattr(service, "get_tool", lambda name, config=None: tool)
+
+    result = await service.execute_tool_async("tavily", "extract", {"urls": URLS})
+    assert extract.calls == [URLS]
+    assert len(result["results"]) == len(URLS)
+
+    # 有调用方需要进度时才按URL流式提取
+    progress = []
+    await service.execute_tool_async("tavily", "extract", {"urls": URLS}, on_progress=progress.append)
+    assert len(extract.calls) == 1 + len(URLS)
+    assert len(progress) == len(URLS)